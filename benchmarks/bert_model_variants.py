@@ -0,0 +1,99 @@
+"""
+ONNX 版 BERT モデルのバリアント (fp16 / fp32 / int8) ごとの推論速度と精度を比較するベンチマーク。
+固定のコーパスの各テキストについて、トークン単位の BERT 特徴量を fp16 版の出力と比較し、推論時間とともに表示する。
+
+使用例:
+    python benchmarks/bert_model_variants.py --model tsukumijima/deberta-v2-large-japanese-char-wwm-onnx --language JP
+    python benchmarks/bert_model_variants.py --model /path/to/local/model --language JP --corpus corpus.txt
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+
+from kabosu_plus.sbv2.constants import Languages
+from kabosu_plus.sbv2.nlp import onnx_bert_models
+
+
+# --corpus を指定しない場合に利用する固定のコーパス
+DEFAULT_CORPUS: dict[Languages, list[str]] = {
+    Languages.JP: [
+        "こんにちは、今日はいい天気ですね。",
+        "吾輩は猫である。名前はまだ無い。どこで生れたかとんと見当がつかぬ。",
+        "音声合成の品質は、テキスト処理の精度に大きく左右されます。",
+        "明日の会議は午後三時から、第二会議室で行われる予定です。",
+        "えっ、本当に？それは知らなかった！",
+    ],
+    Languages.EN: [
+        "Hello, it's a nice day today.",
+        "The quick brown fox jumps over the lazy dog.",
+        "Speech synthesis quality depends heavily on text processing accuracy.",
+        "Tomorrow's meeting will be held in the second conference room at three.",
+        "Wait, really? I didn't know that!",
+    ],
+    Languages.ZH: [
+        "你好，今天天气很好。",
+        "语音合成的质量很大程度上取决于文本处理的准确性。",
+        "明天的会议将于下午三点在第二会议室举行。",
+        "真的吗？我都不知道！",
+    ],
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)  # fmt: skip
+    parser.add_argument("--model", required=True, help="Hugging Face repository name or local model directory")  # fmt: skip
+    parser.add_argument("--language", default="JP", choices=["JP", "EN", "ZH"])
+    parser.add_argument("--corpus", type=Path, default=None, help="text file with one sentence per line")  # fmt: skip
+    parser.add_argument("--variants", nargs="+", default=["fp16", "fp32", "int8"])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    language = Languages[args.language]
+    if args.corpus is not None:
+        corpus = [line.strip() for line in args.corpus.read_text(encoding="utf-8").splitlines() if line.strip()]  # fmt: skip
+    else:
+        corpus = DEFAULT_CORPUS[language]
+
+    onnx_providers = ["CPUExecutionProvider"]
+    onnx_bert_models.load_tokenizer(language, args.model)
+
+    reference: list[np.ndarray] | None = None
+    print(f"{'variant':<8} {'load [s]':>9} {'mean [ms]':>10} {'p90 [ms]':>9} {'cos sim':>8} {'max abs err':>12}")  # fmt: skip
+    for variant in args.variants:
+        onnx_bert_models.unload_model(language)
+        start_time = time.perf_counter()
+        onnx_bert_models.load_model(language, args.model, onnx_providers=onnx_providers, variant=variant)  # fmt: skip
+        load_time = time.perf_counter() - start_time
+        bert_session = onnx_bert_models.get_bert_session(language, onnx_providers)
+
+        outputs: list[np.ndarray] = []
+        latencies: list[float] = []
+        for text in corpus:
+            inputs = bert_session.tokenizer(text, return_tensors="np")
+            # 1 回目はウォームアップとして計測から除外する
+            output = bert_session.run(inputs["input_ids"], inputs["attention_mask"], inputs.get("token_type_ids"))  # fmt: skip
+            for _ in range(args.repeat):
+                start_time = time.perf_counter()
+                bert_session.run(inputs["input_ids"], inputs["attention_mask"], inputs.get("token_type_ids"))  # fmt: skip
+                latencies.append((time.perf_counter() - start_time) * 1000)
+            outputs.append(np.asarray(output, dtype=np.float32).reshape(-1, output.shape[-1]))  # fmt: skip
+
+        # 最初のバリアント (通常は fp16) の出力を基準に精度を比較する
+        if reference is None:
+            reference = outputs
+        cos_sims = [
+            float(np.mean(np.sum(a * b, axis=-1) / (np.linalg.norm(a, axis=-1) * np.linalg.norm(b, axis=-1) + 1e-12)))  # fmt: skip
+            for a, b in zip(outputs, reference)
+        ]
+        max_abs_err = max(float(np.max(np.abs(a - b))) for a, b in zip(outputs, reference))  # fmt: skip
+        print(
+            f"{variant:<8} {load_time:>9.2f} {np.mean(latencies):>10.2f} {np.percentile(latencies, 90):>9.2f} "
+            f"{np.mean(cos_sims):>8.5f} {max_abs_err:>12.5f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+ONNX 版 BERT モデルの重みを推論セッション・ワーカープロセス間で共有した場合 (load_model() の share_initializers=True) のメモリ削減量を計測するベンチマーク。
+各設定について --workers 個のワーカープロセスを同時に起動し、それぞれで --sessions 個の推論セッションをロードして 1 回推論した時点の
+RSS と PSS (共有ページをプロセス数で按分した値) を表示する。ホスト全体のメモリ消費量は PSS の合計に近い。
+/proc を参照するため Linux でのみ動作する。
+
+使用例:
+    python benchmarks/bert_shared_weights.py --model tsukumijima/deberta-v2-large-japanese-char-wwm-onnx --language JP --variant fp32
+    python benchmarks/bert_shared_weights.py --model /path/to/local/model --language JP --variant int8 --workers 4 --sessions 2
+"""
+
+import argparse
+import multiprocessing
+from typing import Any
+
+from kabosu_plus.sbv2.constants import Languages
+
+
+def read_memory_usage() -> tuple[float, float]:
+    """
+    現在のプロセスの RSS と PSS (MiB) を返す。
+    """
+
+    usage: dict[str, float] = {}
+    with open("/proc/self/smaps_rollup", encoding="utf-8") as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] in ("Rss:", "Pss:"):
+                usage[fields[0]] = int(fields[1]) / 1024
+    return usage["Rss:"], usage["Pss:"]
+
+
+def run_worker(
+    model: str,
+    language: str,
+    load_model_kwargs: dict[str, Any],
+    barrier: Any,
+    results: Any,
+) -> None:
+    """
+    BERT モデルをロードして 1 回推論し、すべてのワーカープロセスが揃った時点のメモリ使用量を報告する。
+    """
+
+    from kabosu_plus.sbv2.nlp import onnx_bert_models
+
+    onnx_providers = ["CPUExecutionProvider"]
+    rss_before, pss_before = read_memory_usage()
+    onnx_bert_models.load_tokenizer(Languages[language], model)
+    onnx_bert_models.load_model(Languages[language], model, onnx_providers=onnx_providers, **load_model_kwargs)  # fmt: skip
+    bert_session = onnx_bert_models.get_bert_session(Languages[language], onnx_providers)  # fmt: skip
+    inputs = bert_session.tokenizer("BERT のメモリ使用量を計測します。", return_tensors="np")
+    for _ in range(len(bert_session.pool)):
+        bert_session.run(inputs["input_ids"], inputs["attention_mask"], inputs.get("token_type_ids"))  # fmt: skip
+
+    # 共有ページの按分は同時に生存しているプロセス数に依存するため、全員が揃ってから計測する
+    barrier.wait()
+    rss_after, pss_after = read_memory_usage()
+    results.put((rss_after - rss_before, pss_after - pss_before))
+    barrier.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)  # fmt: skip
+    parser.add_argument("--model", required=True, help="Hugging Face repository name or local model directory")  # fmt: skip
+    parser.add_argument("--language", default="JP", choices=["JP", "EN", "ZH"])
+    parser.add_argument("--variant", default="fp32", choices=["fp16", "fp32", "int8"])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--sessions", type=int, default=2, help="number of sessions per worker")  # fmt: skip
+    args = parser.parse_args()
+
+    # モデルのダウンロードと外部データ版のモデルの生成を先に済ませておき、計測に含めない
+    from kabosu_plus.sbv2.nlp import onnx_bert_models
+
+    onnx_bert_models.load_model(Languages[args.language], args.model, variant=args.variant, share_initializers=True)  # fmt: skip
+    onnx_bert_models.unload_model(Languages[args.language])
+
+    context = multiprocessing.get_context("spawn")
+    print(f"{'share':<6} {'workers':>7} {'sessions':>8} {'RSS / worker [MiB]':>19} {'PSS total [MiB]':>16}")  # fmt: skip
+    for share_initializers in (False, True):
+        load_model_kwargs = {
+            "variant": args.variant,
+            "num_sessions": args.sessions,
+            "share_initializers": share_initializers,
+        }
+        barrier = context.Barrier(args.workers)
+        results = context.Queue()
+        workers = [
+            context.Process(target=run_worker, args=(args.model, args.language, load_model_kwargs, barrier, results))  # fmt: skip
+            for _ in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        usages = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+
+        rss_per_worker = sum(rss for rss, _ in usages) / len(usages)
+        pss_total = sum(pss for _, pss in usages)
+        print(f"{str(share_initializers):<6} {args.workers:>7} {args.sessions:>8} {rss_per_worker:>19.1f} {pss_total:>16.1f}")  # fmt: skip
+
+
+if __name__ == "__main__":
+    main()
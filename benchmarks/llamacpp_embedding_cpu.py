@@ -0,0 +1,97 @@
+"""
+llama.cpp の埋め込みモデル (MULTI) を CPU で推論する際の設定ごとのスループットを比較するベンチマーク。
+--threads と --batch-sizes のすべての組み合わせについてモデルをロードし直し、固定のコーパスを 1 文ずつ埋め込んだ場合と
+まとめて埋め込んだ場合のレイテンシ・スループットを表示する。埋め込みのキャッシュは無効化した状態で計測する。
+
+使用例:
+    python benchmarks/llamacpp_embedding_cpu.py --model /path/to/local/model --threads 4 8 --batch-sizes 512 2048
+    python benchmarks/llamacpp_embedding_cpu.py --model /path/to/local/model --model-filename qwen3-embedding-0.6b-q8_0.gguf --use-mlock
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+
+from kabosu_plus.sbv2.constants import Languages
+from kabosu_plus.sbv2.nlp import llamacpp_embedding_models
+
+
+# --corpus を指定しない場合に利用する固定のコーパス
+DEFAULT_CORPUS: list[str] = [
+    "こんにちは、今日はいい天気ですね。",
+    "吾輩は猫である。名前はまだ無い。どこで生れたかとんと見当がつかぬ。",
+    "音声合成の品質は、テキスト処理の精度に大きく左右されます。",
+    "The quick brown fox jumps over the lazy dog.",
+    "Speech synthesis quality depends heavily on text processing accuracy.",
+    "语音合成的质量很大程度上取决于文本处理的准确性。",
+    "明天的会议将于下午三点在第二会议室举行。",
+    "안녕하세요, 오늘은 날씨가 좋네요.",
+]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)  # fmt: skip
+    parser.add_argument("--model", required=True, help="Hugging Face repository name or local model directory")  # fmt: skip
+    parser.add_argument("--model-filename", default=llamacpp_embedding_models.DEFAULT_MODEL_FILENAME)  # fmt: skip
+    parser.add_argument("--corpus", type=Path, default=None, help="text file with one sentence per line")  # fmt: skip
+    parser.add_argument("--threads", type=int, nargs="+", default=[None], help="values of n_threads / n_threads_batch")  # fmt: skip
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[512], help="values of n_batch (n_ctx is set to the same value)")  # fmt: skip
+    parser.add_argument("--n-gpu-layers", type=int, default=0)
+    parser.add_argument("--no-mmap", action="store_true")
+    parser.add_argument("--use-mlock", action="store_true")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.corpus is not None:
+        corpus = [line.strip() for line in args.corpus.read_text(encoding="utf-8").splitlines() if line.strip()]  # fmt: skip
+    else:
+        corpus = DEFAULT_CORPUS
+
+    # キャッシュにヒットすると埋め込みの計算が省略されてしまうため、キャッシュを無効化する
+    llamacpp_embedding_models.set_embedding_cache_size(0)
+
+    print(f"{'threads':>7} {'n_batch':>7} {'load [s]':>9} {'single [ms/text]':>17} {'batched [ms/text]':>18} {'texts/s':>8}")  # fmt: skip
+    for n_threads in args.threads:
+        for n_batch in args.batch_sizes:
+            llamacpp_embedding_models.unload_model(Languages.MULTI)
+            start_time = time.perf_counter()
+            llamacpp_embedding_models.load_model(
+                Languages.MULTI,
+                args.model,
+                model_filename=args.model_filename,
+                n_gpu_layers=args.n_gpu_layers,
+                n_threads=n_threads,
+                n_threads_batch=n_threads,
+                n_batch=n_batch,
+                n_ctx=n_batch,
+                use_mmap=not args.no_mmap,
+                use_mlock=args.use_mlock,
+            )
+            load_time = time.perf_counter() - start_time
+
+            # 1 回目はウォームアップとして計測から除外する
+            llamacpp_embedding_models.embed_texts(corpus)
+
+            single_latencies: list[float] = []
+            batched_latencies: list[float] = []
+            for _ in range(args.repeat):
+                start_time = time.perf_counter()
+                for text in corpus:
+                    llamacpp_embedding_models.embed_texts([text])
+                single_latencies.append((time.perf_counter() - start_time) * 1000 / len(corpus))  # fmt: skip
+
+                start_time = time.perf_counter()
+                llamacpp_embedding_models.embed_texts(corpus)
+                batched_latencies.append((time.perf_counter() - start_time) * 1000 / len(corpus))  # fmt: skip
+
+            batched_latency = float(np.mean(batched_latencies))
+            print(
+                f"{str(n_threads or 'auto'):>7} {n_batch:>7} {load_time:>9.2f} {np.mean(single_latencies):>17.2f} "
+                f"{batched_latency:>18.2f} {1000 / batched_latency:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
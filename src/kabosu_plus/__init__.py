@@ -10,6 +10,9 @@ import jpreprocess
 def load_marine_model(model_dir: Union[str, None] = None, dict_dir: Union[str, None] = None):
     pyopenjtalk.load_marine_model(model_dir=model_dir, dict_dir=dict_dir)
 
+# incremented every time the global openjtalk dictionary is replaced (used to invalidate the g2p cache)
+__user_dict_version = 0
+
 def update_global_jtalk_with_user_dict(
         user_dictionary: str | Path | None = None
         ) -> None:
@@ -18,7 +21,17 @@ def update_global_jtalk_with_user_dict(
     Note that this will change the global state of the openjtalk module.
 
     """
+    global __user_dict_version
     pyopenjtalk.update_global_jtalk_with_user_dict(user_dictionary=user_dictionary)
+    __user_dict_version += 1
+
+def get_user_dict_version() -> int:
+    """Return the version of the global openjtalk dictionary
+
+    The version is incremented by every call of update_global_jtalk_with_user_dict().
+
+    """
+    return __user_dict_version
 
 def extract_fullcontext(
         text: str,
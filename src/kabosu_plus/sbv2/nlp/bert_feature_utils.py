@@ -0,0 +1,491 @@
+"""
+各言語の BERT 特徴量抽出処理 (bert_feature.py) から共通で利用される処理をまとめたモジュール。
+"""
+
+from __future__ import annotations
+
+from collections.abc import Callable, Mapping, Sequence
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import numpy as np
+from numpy.typing import DTypeLike, NDArray
+
+from kabosu_plus.sbv2.constants import Languages
+from kabosu_plus.sbv2.nlp import onnx_bert_models
+from kabosu_plus.sbv2.utils.lru_cache import LRUCache
+from kabosu_plus.sbv2.utils.metrics import get_metrics, timed
+
+
+# 補助テキスト (assist_text) の BERT 特徴量の平均を格納するキャッシュ
+## 補助テキストは話者ごとのスタイル指定用の定型文であることがほとんどなので、(言語, モデルの識別子, 補助テキスト, 窓の設定) をキーにキャッシュする
+## 長い補助テキストは max_length と window_overlap によって特徴量が変わるため、窓の設定もキーに含める
+__assist_text_embedding_cache: LRUCache[tuple[Languages, str, str, Optional[tuple[int, int]]], NDArray[Any]] = LRUCache(maxsize=64)  # fmt: skip
+get_metrics().register_cache("bert.assist_text_embedding", __assist_text_embedding_cache.stats)  # fmt: skip
+
+
+def bucket_indices_by_length(
+    lengths: Sequence[int],
+    bucket_width: int = 8,
+    max_batch_size: int = 16,
+) -> list[list[int]]:
+    """
+    系列長のリストを受け取り、系列長が近いもの同士が同じバッチになるようにインデックスをグループ化する。
+    系列長を bucket_width 単位で切り上げた値が同じものを 1 つのバケットとし、バケットごとに最大 max_batch_size 件ずつに分割する。
+
+    Args:
+        lengths (Sequence[int]): 各系列の長さ
+        bucket_width (int, optional): バケットの幅 (1 の場合は系列長が完全に一致するもののみ同じバッチになる) (デフォルト: 8)
+        max_batch_size (int, optional): 1 バッチあたりの最大件数 (デフォルト: 16)
+
+    Returns:
+        list[list[int]]: バッチごとの元のインデックスのリスト
+    """
+
+    assert bucket_width > 0 and max_batch_size > 0
+
+    batches: list[list[int]] = []
+    current_batch: list[int] = []
+    current_bucket = -1
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        bucket = (lengths[index] + bucket_width - 1) // bucket_width
+        if len(current_batch) > 0 and (bucket != current_bucket or len(current_batch) >= max_batch_size):  # fmt: skip
+            batches.append(current_batch)
+            current_batch = []
+        current_batch.append(index)
+        current_bucket = bucket
+    if len(current_batch) > 0:
+        batches.append(current_batch)
+
+    return batches
+
+
+def pad_token_batch(
+    input_ids_list: Sequence[Sequence[int]],
+    pad_token_id: int = 0,
+) -> tuple[NDArray[np.int64], NDArray[np.int64]]:
+    """
+    長さの異なるトークン ID 列を右側パディングし、(batch, max_length) の input_ids と attention_mask を返す。
+
+    Args:
+        input_ids_list (Sequence[Sequence[int]]): トークン ID 列のリスト
+        pad_token_id (int, optional): パディングに用いるトークン ID (デフォルト: 0)
+
+    Returns:
+        tuple[NDArray[np.int64], NDArray[np.int64]]: input_ids と attention_mask
+    """
+
+    max_length = max(len(input_ids) for input_ids in input_ids_list)
+    input_ids_array = np.full((len(input_ids_list), max_length), pad_token_id, dtype=np.int64)  # fmt: skip
+    attention_mask = np.zeros((len(input_ids_list), max_length), dtype=np.int64)
+    for row, input_ids in enumerate(input_ids_list):
+        input_ids_array[row, : len(input_ids)] = input_ids
+        attention_mask[row, : len(input_ids)] = 1
+
+    return input_ids_array, attention_mask
+
+
+def split_sliding_windows(
+    num_tokens: int,
+    max_length: int,
+    window_overlap: int = 64,
+) -> list[tuple[int, int]]:
+    """
+    先頭の [CLS] と末尾の [SEP] を除いたトークン列を、重なりを持つ窓に分割する。
+    各窓は前後に [CLS] と [SEP] を付け直して推論されることを想定し、窓あたりのトークン数は max_length - 2 となる。
+    最後の窓は、可能な限り文脈を確保するため末尾から max_length - 2 トークン分を取る。
+
+    Args:
+        num_tokens (int): [CLS] と [SEP] を含むトークン列の長さ
+        max_length (int): モデルに入力できる最大トークン数 ([CLS] と [SEP] を含む)
+        window_overlap (int, optional): 隣り合う窓同士で重なるトークン数 (デフォルト: 64)
+
+    Returns:
+        list[tuple[int, int]]: [CLS] と [SEP] を除いたトークン列における、各窓の (開始位置, 終了位置)
+    """
+
+    window_length = max_length - 2
+    assert window_length > 0, "max_length must be greater than 2"
+    assert 0 <= window_overlap < window_length, "window_overlap must be smaller than max_length - 2"
+
+    num_inner_tokens = num_tokens - 2
+    if num_inner_tokens <= window_length:
+        return [(0, max(num_inner_tokens, 0))]
+
+    stride = window_length - window_overlap
+    spans: list[tuple[int, int]] = []
+    start = 0
+    while start + window_length < num_inner_tokens:
+        spans.append((start, start + window_length))
+        start += stride
+    spans.append((num_inner_tokens - window_length, num_inner_tokens))
+
+    return spans
+
+
+def stitch_sliding_windows(
+    window_outputs: Sequence[NDArray[Any]],
+    spans: Sequence[tuple[int, int]],
+) -> NDArray[Any]:
+    """
+    split_sliding_windows() で分割した窓ごとの (窓のトークン数 + 2, 隠れ層の次元数) の特徴量を、元のトークン列の特徴量に繋ぎ合わせる。
+    窓同士が重なる部分は重なりの中央で切り替え、各トークンについて文脈がより広く取れている側の窓の特徴量を採用する。
+    [CLS] の特徴量は最初の窓から、[SEP] の特徴量は最後の窓から取る。
+
+    Args:
+        window_outputs (Sequence[NDArray[Any]]): 窓ごとの特徴量
+        spans (Sequence[tuple[int, int]]): split_sliding_windows() の戻り値
+
+    Returns:
+        NDArray[Any]: ([CLS] と [SEP] を含むトークン数, 隠れ層の次元数) の特徴量
+    """
+
+    assert len(window_outputs) == len(spans) > 0
+    num_inner_tokens = spans[-1][1]
+    first_output = window_outputs[0]
+    stitched = np.empty((num_inner_tokens + 2, first_output.shape[-1]), dtype=first_output.dtype)  # fmt: skip
+
+    stitched[0] = first_output[0]
+    stitched[-1] = window_outputs[-1][-1]
+    begin = 0
+    for index, ((start, end), output) in enumerate(zip(spans, window_outputs)):
+        # 次の窓との重なりの中央までを、この窓から採用する
+        if index + 1 < len(spans):
+            boundary = (spans[index + 1][0] + end) // 2
+        else:
+            boundary = end
+        stitched[begin + 1 : boundary + 1] = output[begin - start + 1 : boundary - start + 1]
+        begin = boundary
+
+    return stitched
+
+
+def run_onnx_bert(
+    bert_session: onnx_bert_models.BertSession,
+    inputs: Mapping[str, NDArray[Any]],
+    max_length: Optional[int] = None,
+    window_overlap: int = 64,
+) -> NDArray[Any]:
+    """
+    トークナイザーで変換した 1 系列分の入力テンソルを ONNX 版 BERT モデルで推論し、(系列長, 隠れ層の次元数) の特徴量を返す。
+    max_length を指定した場合、max_length を超える系列は重なりを持つ窓に分割して推論する (run_onnx_bert_batch() を参照) 。
+
+    Args:
+        bert_session (onnx_bert_models.BertSession): get_bert_session() で取得した BertSession
+        inputs (Mapping[str, NDArray[Any]]): tokenizer(text, return_tensors="np") の戻り値
+        max_length (Optional[int], optional): 1 回の推論で入力する最大トークン数。指定しない場合は系列を分割しない (デフォルト: None)
+        window_overlap (int, optional): 系列を分割する際に、隣り合う窓同士で重なるトークン数 (デフォルト: 64)
+
+    Returns:
+        NDArray[Any]: (系列長, 隠れ層の次元数) の特徴量
+    """
+
+    input_ids = inputs["input_ids"]
+    if max_length is not None and input_ids.shape[-1] > max_length:
+        return run_onnx_bert_batch(
+            bert_session,
+            input_ids.tolist(),
+            max_length=max_length,
+            window_overlap=window_overlap,
+        )[0]
+
+    res = bert_session.run(input_ids, inputs["attention_mask"], inputs.get("token_type_ids"))  # fmt: skip
+    return res[0] if bert_session.is_batched_output else res
+
+
+def run_onnx_bert_batch(
+    bert_session: onnx_bert_models.BertSession,
+    input_ids_list: Sequence[Sequence[int]],
+    bucket_width: int = 8,
+    max_batch_size: int = 16,
+    max_length: Optional[int] = None,
+    window_overlap: int = 64,
+) -> list[NDArray[Any]]:
+    """
+    複数のトークン ID 列を ONNX 版 BERT モデルでまとめて推論し、系列ごとの (系列長, 隠れ層の次元数) の特徴量を返す。
+    系列長の近いもの同士をバケットにまとめ、バケットごとに attention_mask 付きでパディングして 1 回だけ推論を行う。
+
+    Style-Bert-VITS2 の ONNX 版 BERT モデルはバッチ次元を落とした (系列長, 隠れ層の次元数) の出力を返すようにエクスポートされているため、
+    出力にバッチ次元が存在しないモデルの場合は、パディングせずに系列ごとに推論を行う (推論の準備処理はバッチ全体で共有される) 。
+
+    max_length を指定した場合、max_length を超える系列は重なりを持つ窓に分割して推論し、窓ごとの特徴量を繋ぎ合わせて返す。
+    窓は他の系列と同様にバケットにまとめて推論されるため、長い系列でもメモリ消費量は max_length の系列の推論分に抑えられる。
+
+    Args:
+        bert_session (onnx_bert_models.BertSession): get_bert_session() で取得した BertSession
+        input_ids_list (Sequence[Sequence[int]]): トークナイズ済みのトークン ID 列のリスト
+        bucket_width (int, optional): 系列長のバケット幅 (デフォルト: 8)
+        max_batch_size (int, optional): 1 回の推論あたりの最大系列数 (デフォルト: 16)
+        max_length (Optional[int], optional): 1 回の推論で入力する最大トークン数。指定しない場合は系列を分割しない (デフォルト: None)
+        window_overlap (int, optional): max_length を超える系列を分割する際に、隣り合う窓同士で重なるトークン数 (デフォルト: 64)
+
+    Returns:
+        list[NDArray[Any]]: input_ids_list と同じ順序の、系列ごとの特徴量のリスト
+    """
+
+    # max_length を超える系列を窓に分割する
+    ## 窓は [CLS] + 窓内のトークン列 + [SEP] として、通常の系列と同じように推論する
+    window_spans: list[Optional[list[tuple[int, int]]]] = [None] * len(input_ids_list)
+    if max_length is not None:
+        expanded_input_ids_list: list[Sequence[int]] = []
+        for index, input_ids in enumerate(input_ids_list):
+            if len(input_ids) <= max_length:
+                expanded_input_ids_list.append(input_ids)
+                continue
+            spans = split_sliding_windows(len(input_ids), max_length, window_overlap)
+            window_spans[index] = spans
+            for start, end in spans:
+                expanded_input_ids_list.append(
+                    [input_ids[0], *input_ids[start + 1 : end + 1], input_ids[-1]]
+                )
+        input_ids_list = expanded_input_ids_list
+
+    results: list[NDArray[Any]] = [np.empty(0)] * len(input_ids_list)
+
+    if not bert_session.is_batched_output:
+        for index, input_ids in enumerate(input_ids_list):
+            results[index] = bert_session.run(np.asarray([input_ids], dtype=np.int64))
+    else:
+        lengths = [len(input_ids) for input_ids in input_ids_list]
+        for batch_indices in bucket_indices_by_length(lengths, bucket_width, max_batch_size):  # fmt: skip
+            input_ids_array, attention_mask = pad_token_batch(
+                [input_ids_list[index] for index in batch_indices], bert_session.pad_token_id
+            )
+            output = bert_session.run(input_ids_array, attention_mask)
+            # パディング部分を取り除いて元の順序に戻す
+            for row, index in enumerate(batch_indices):
+                results[index] = output[row, : lengths[index]]
+
+    if max_length is None:
+        return results
+
+    # 窓ごとの特徴量を繋ぎ合わせ、元の系列ごとの特徴量に戻す
+    stitched_results: list[NDArray[Any]] = []
+    position = 0
+    for spans in window_spans:
+        if spans is None:
+            stitched_results.append(results[position])
+            position += 1
+        else:
+            stitched_results.append(
+                stitch_sliding_windows(results[position : position + len(spans)], spans)
+            )
+            position += len(spans)
+
+    return stitched_results
+
+
+@timed("bert.expand_word2ph")
+def expand_word2ph_feature(
+    res: NDArray[Any],
+    word2ph: Sequence[int],
+    style_res_mean: Optional[NDArray[Any]] = None,
+    assist_text_weight: float = 0.7,
+    out: Optional[NDArray[Any]] = None,
+    output_dtype: Optional[DTypeLike] = None,
+    contiguous: bool = False,
+) -> NDArray[Any]:
+    """
+    トークン単位の BERT 特徴量を word2ph に従って音素単位に展開し、(隠れ層の次元数, 音素数) の特徴量を返す。
+    補助テキストの特徴量とのブレンドは展開前のトークン単位で行うため、音素単位の一時配列は作られない。
+
+    out に (隠れ層の次元数, 音素数) の配列を渡した場合は、その配列に直接書き込んで返す (dtype は out の dtype に変換される) 。
+    out を渡さず、contiguous が True か output_dtype が指定された場合は、C-contiguous な (隠れ層の次元数, 音素数) の配列を新たに確保して返す。
+    いずれでもない場合は、従来通り (音素数, 隠れ層の次元数) の配列を転置したビューを返す。
+
+    Args:
+        res (NDArray[Any]): (トークン数, 隠れ層の次元数) の BERT 特徴量
+        word2ph (Sequence[int]): 各トークンに音素が何個割り当てられるかを表すリスト
+        style_res_mean (Optional[NDArray[Any]], optional): 補助テキストの BERT 特徴量の平均 (デフォルト: None)
+        assist_text_weight (float, optional): 補助テキストの重み (デフォルト: 0.7)
+        out (Optional[NDArray[Any]], optional): 書き込み先の (隠れ層の次元数, 音素数) の配列 (デフォルト: None)
+        output_dtype (Optional[DTypeLike], optional): 出力の dtype (np.float16 を指定するとメモリ消費量と保存サイズが半分になる) 。指定した場合は contiguous=True とみなす (デフォルト: None)
+        contiguous (bool, optional): C-contiguous な配列を返すかどうか (デフォルト: False)
+
+    Returns:
+        NDArray[Any]: (隠れ層の次元数, 音素数) の音素単位の BERT 特徴量
+    """
+
+    repeats = np.asarray(word2ph, dtype=np.int64)
+    token_feature = res[: len(repeats)]
+    if style_res_mean is not None:
+        token_feature = (
+            token_feature * (1 - assist_text_weight)
+            + style_res_mean * assist_text_weight
+        )
+
+    if out is None:
+        if not contiguous and output_dtype is None:
+            return np.repeat(token_feature, repeats, axis=0).T
+        out = np.empty(
+            (token_feature.shape[1], int(repeats.sum())),
+            dtype=output_dtype if output_dtype is not None else token_feature.dtype,
+        )
+
+    assert out.shape == (token_feature.shape[1], int(repeats.sum())), \
+        f"out.shape must be {(token_feature.shape[1], int(repeats.sum()))}, but got {out.shape}"  # fmt: skip
+    # 音素ごとに参照するトークンのインデックスを作り、転置済みの特徴量から out に直接書き込む
+    token_indices = np.repeat(np.arange(len(repeats)), repeats)
+    np.take(token_feature.T.astype(out.dtype, copy=False), token_indices, axis=1, out=out, mode="clip")  # fmt: skip
+
+    return out
+
+
+@dataclass(frozen=True)
+class SparsePhoneLevelFeature:
+    """
+    先頭と末尾のトークンにだけ特徴量が入り、それ以外のトークンの特徴量が 0 になる音素単位の BERT 特徴量 (MULTI) の疎な表現。
+    (隠れ層の次元数, 音素数) の密な配列の代わりに 1 本の埋め込みと先頭・末尾の音素数だけを保持し、密な配列が必要になった時点で to_dense() で展開する。
+    """
+
+    # 先頭と末尾のトークンの (隠れ層の次元数,) の特徴量
+    edge_feature: NDArray[Any]
+    # 先頭のトークンに割り当てられる音素数 (word2ph[0])
+    head_length: int
+    # 末尾のトークンに割り当てられる音素数 (word2ph[-1])
+    tail_length: int
+    # 全体の音素数 (sum(word2ph))
+    n_phones: int
+
+    @classmethod
+    def from_word2ph(cls, edge_feature: NDArray[Any], word2ph: Sequence[int]) -> SparsePhoneLevelFeature:  # fmt: skip
+        """
+        先頭と末尾のトークンの特徴量と word2ph から、疎な音素単位の BERT 特徴量を作る。
+        """
+
+        assert len(word2ph) > 0
+        return cls(edge_feature, int(word2ph[0]), int(word2ph[-1]), int(sum(word2ph)))
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        """
+        展開後の (隠れ層の次元数, 音素数) の形状。
+        """
+
+        return (self.edge_feature.shape[-1], self.n_phones)
+
+    def to_dense(self, output_dtype: Optional[DTypeLike] = None, contiguous: bool = False) -> NDArray[Any]:  # fmt: skip
+        """
+        (隠れ層の次元数, 音素数) の密な配列に展開する。
+        expand_word2ph_feature() と同様に、contiguous が True か output_dtype が指定された場合は C-contiguous な配列を、
+        いずれでもない場合は (音素数, 隠れ層の次元数) の配列を転置したビューを返す。
+
+        Args:
+            output_dtype (Optional[DTypeLike], optional): 出力の dtype (デフォルト: None)
+            contiguous (bool, optional): C-contiguous な配列を返すかどうか (デフォルト: False)
+
+        Returns:
+            NDArray[Any]: (隠れ層の次元数, 音素数) の音素単位の BERT 特徴量
+        """
+
+        dtype = output_dtype if output_dtype is not None else self.edge_feature.dtype
+        tail_start = self.n_phones - self.tail_length
+        if not contiguous and output_dtype is None:
+            dense = np.zeros((self.n_phones, self.edge_feature.shape[-1]), dtype=dtype)
+            dense[: self.head_length] = self.edge_feature
+            dense[tail_start:] = self.edge_feature
+            return dense.T
+
+        dense = np.zeros((self.edge_feature.shape[-1], self.n_phones), dtype=dtype)
+        edge_feature = self.edge_feature.astype(dtype, copy=False)[:, np.newaxis]
+        dense[:, : self.head_length] = edge_feature
+        dense[:, tail_start:] = edge_feature
+        return dense
+
+
+def get_assist_text_embedding(
+    language: Languages,
+    assist_text: str,
+    compute: Callable[[], NDArray[Any]],
+    max_length: Optional[int] = None,
+    window_overlap: int = 64,
+) -> NDArray[Any]:
+    """
+    補助テキストの BERT 特徴量の平均をキャッシュから取得する。キャッシュにない場合は compute() で計算してキャッシュに格納する。
+    キャッシュされた配列は書き込み不可になる。
+
+    Args:
+        language (Languages): 補助テキストの言語 (当該言語の BERT モデルはロード済みである必要がある)
+        assist_text (str): 補助テキスト
+        compute (Callable[[], NDArray[Any]]): キャッシュにない場合に BERT 特徴量の平均を計算する関数
+        max_length (Optional[int], optional): compute() で補助テキストを推論する際の最大トークン数 (デフォルト: None)
+        window_overlap (int, optional): compute() で補助テキストを窓に分割する際に、隣り合う窓同士で重なるトークン数 (デフォルト: 64)
+
+    Returns:
+        NDArray[Any]: 補助テキストの BERT 特徴量の平均
+    """
+
+    style_res_mean = lookup_assist_text_embedding(language, assist_text, max_length, window_overlap)  # fmt: skip
+    if style_res_mean is None:
+        style_res_mean = compute()
+        store_assist_text_embedding(language, assist_text, style_res_mean, max_length, window_overlap)  # fmt: skip
+    return style_res_mean
+
+
+def lookup_assist_text_embedding(
+    language: Languages,
+    assist_text: str,
+    max_length: Optional[int] = None,
+    window_overlap: int = 64,
+) -> Optional[NDArray[Any]]:
+    """
+    キャッシュされた補助テキストの BERT 特徴量の平均を返す。キャッシュにない場合は None を返す。
+    max_length と window_overlap は、補助テキストを推論する際の窓の設定 (run_onnx_bert() を参照) 。
+    """
+
+    return __assist_text_embedding_cache.get(__make_assist_text_embedding_key(language, assist_text, max_length, window_overlap))  # fmt: skip
+
+
+def store_assist_text_embedding(
+    language: Languages,
+    assist_text: str,
+    style_res_mean: NDArray[Any],
+    max_length: Optional[int] = None,
+    window_overlap: int = 64,
+) -> None:
+    """
+    補助テキストの BERT 特徴量の平均をキャッシュに格納する。
+    max_length と window_overlap は、補助テキストを推論した際の窓の設定 (run_onnx_bert() を参照) 。
+    """
+
+    style_res_mean.flags.writeable = False
+    __assist_text_embedding_cache.put(__make_assist_text_embedding_key(language, assist_text, max_length, window_overlap), style_res_mean)  # fmt: skip
+
+
+def __make_assist_text_embedding_key(
+    language: Languages,
+    assist_text: str,
+    max_length: Optional[int],
+    window_overlap: int,
+) -> tuple[Languages, str, str, Optional[tuple[int, int]]]:
+    """
+    補助テキストの BERT 特徴量のキャッシュのキーを作る。
+    max_length を指定しない場合は窓に分割されないため、window_overlap はキーに影響しない。
+    """
+
+    window = (max_length, window_overlap) if max_length is not None else None
+    return (language, onnx_bert_models.get_model_id(language), assist_text, window)
+
+
+def set_assist_text_embedding_cache_size(maxsize: int) -> None:
+    """
+    補助テキストの BERT 特徴量のキャッシュの最大エントリ数を変更する (0 を指定するとキャッシュを無効化する) 。
+    """
+
+    __assist_text_embedding_cache.resize(maxsize)
+
+
+def get_assist_text_embedding_cache_stats() -> dict[str, int]:
+    """
+    補助テキストの BERT 特徴量のキャッシュの統計情報 (ヒット数・ミス数・現在のエントリ数・最大エントリ数) を返す。
+    """
+
+    return __assist_text_embedding_cache.stats()
+
+
+def clear_assist_text_embedding_cache() -> None:
+    """
+    補助テキストの BERT 特徴量のキャッシュをすべて破棄する。
+    """
+
+    __assist_text_embedding_cache.clear()
@@ -0,0 +1,283 @@
+"""
+複数のスレッド・コルーチンから同時に届く BERT 特徴量の抽出リクエストをまとめて推論するためのモジュール。
+
+TTS サーバーのように多数のリクエストを並行して処理する環境では、各スレッドが個別に extract_bert_feature_onnx() を呼び出すと
+1 つの推論セッションを奪い合うことになり、推論 1 回あたりのオーバーヘッドも積み重なる。
+BertMicroBatcher はリクエストをキューに溜め、最大バッチサイズに達するか最大待ち時間が経過した時点でまとめて
+extract_bert_feature_onnx_batch() に渡し、結果を concurrent.futures.Future 経由で各リクエストに返す。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import queue
+import threading
+import time
+from collections.abc import Callable, Sequence
+from concurrent.futures import Future
+from typing import Any, Optional, Union
+
+from numpy.typing import NDArray
+
+from kabosu_plus.sbv2.constants import Languages
+from kabosu_plus.sbv2.logging import logger
+
+
+def get_batch_extractor(language: Languages) -> Callable[..., list[NDArray[Any]]]:
+    """
+    指定された言語の extract_bert_feature_onnx_batch() を返す。
+    各言語の BERT 特徴量抽出処理は依存ライブラリが多いため、必要になった時点でインポートする。
+
+    Args:
+        language (Languages): テキストの言語
+
+    Returns:
+        Callable[..., list[NDArray[Any]]]: 当該言語の extract_bert_feature_onnx_batch()
+    """
+
+    if language == Languages.JP:
+        from kabosu_plus.sbv2.nlp.japanese.bert_feature import extract_bert_feature_onnx_batch  # fmt: skip
+    elif language == Languages.EN:
+        from kabosu_plus.sbv2.nlp.english.bert_feature import extract_bert_feature_onnx_batch  # fmt: skip
+    elif language == Languages.ZH:
+        from kabosu_plus.sbv2.nlp.chinese.bert_feature import extract_bert_feature_onnx_batch  # fmt: skip
+    else:
+        raise ValueError(f"Language {language} is not supported by the ONNX BERT micro-batcher")  # fmt: skip
+
+    return extract_bert_feature_onnx_batch
+
+
+class BertMicroBatcher:
+    """
+    BERT 特徴量の抽出リクエストをキューに溜め、まとめて推論するマイクロバッチャー。
+    リクエストは submit() で投入し、戻り値の Future から結果を受け取る。asyncio から利用する場合は extract() を await する。
+    推論はバックグラウンドのワーカースレッド 1 本で行われるため、推論セッションへのアクセスは常に直列化される。
+
+    使用例:
+        batcher = BertMicroBatcher(Languages.JP, onnx_providers, max_batch_size=16, max_wait_ms=5.0)
+        feature = batcher.submit(norm_text, word2ph).result()
+        batcher.close()
+    """
+
+    def __init__(
+        self,
+        language: Languages,
+        onnx_providers: Sequence[Union[str, tuple[str, dict[str, Any]]]],
+        max_batch_size: int = 16,
+        max_wait_ms: float = 5.0,
+        assist_text_weight: float = 0.7,
+        **extract_kwargs: Any,
+    ) -> None:
+        """
+        Args:
+            language (Languages): テキストの言語 (JP, EN, ZH のいずれか)
+            onnx_providers (list[str]): ONNX 推論で利用する ExecutionProvider (CPUExecutionProvider, CUDAExecutionProvider など)
+            max_batch_size (int, optional): 1 回の推論でまとめる最大リクエスト数 (デフォルト: 16)
+            max_wait_ms (float, optional): 最初のリクエストが届いてから、後続のリクエストを待つ最大時間 (ミリ秒) (デフォルト: 5.0)
+            assist_text_weight (float, optional): 補助テキストの重み (デフォルト: 0.7)
+            **extract_kwargs (Any): extract_bert_feature_onnx_batch() に渡すその他の引数 (bucket_width, max_length など)
+        """
+
+        assert max_batch_size > 0 and max_wait_ms >= 0
+
+        self.language = language
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.__extract_batch = get_batch_extractor(language)
+        self.__onnx_providers = onnx_providers
+        self.__assist_text_weight = assist_text_weight
+        self.__extract_kwargs = extract_kwargs
+
+        # キューには (テキスト, word2ph, 補助テキスト, sep_text, Future) のタプルが格納される
+        ## 終了時は None を投入してワーカースレッドに通知する
+        self.__queue: queue.Queue[Optional[tuple[str, list[int], Optional[str], Optional[list[str]], Future[NDArray[Any]]]]] = queue.Queue()  # fmt: skip
+        self.__closed = False
+        ## submit() の判定・投入と close() の終了通知の投入を排他し、終了通知の後にリクエストが投入されないようにする
+        self.__lock = threading.Lock()
+        self.__worker = threading.Thread(
+            target=self.__run_worker,
+            name=f"BertMicroBatcher-{language.name}",
+            daemon=True,
+        )
+        self.__worker.start()
+
+    def submit(
+        self,
+        text: str,
+        word2ph: list[int],
+        assist_text: Optional[str] = None,
+        sep_text: Optional[list[str]] = None,
+    ) -> Future[NDArray[Any]]:
+        """
+        BERT 特徴量の抽出リクエストをキューに投入する。
+
+        Args:
+            text (str): テキスト
+            word2ph (list[int]): 元のテキストの各文字に音素が何個割り当てられるかを表すリスト
+            assist_text (Optional[str], optional): 補助テキスト (デフォルト: None)
+            sep_text (Optional[list[str]], optional): g2p() で得られた単語単位の単語のリスト (日本語のみ有効) (デフォルト: None)
+
+        Returns:
+            Future[NDArray[Any]]: extract_bert_feature_onnx() と同じ形式の BERT 特徴量を返す Future
+        """
+
+        future: Future[NDArray[Any]] = Future()
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError("BertMicroBatcher is already closed")
+            self.__queue.put((text, word2ph, assist_text, sep_text, future))
+        return future
+
+    async def extract(
+        self,
+        text: str,
+        word2ph: list[int],
+        assist_text: Optional[str] = None,
+        sep_text: Optional[list[str]] = None,
+    ) -> NDArray[Any]:
+        """
+        submit() の asyncio 版。イベントループをブロックせずに BERT 特徴量の抽出結果を待つ。
+        引数は submit() と同じ。
+        """
+
+        return await asyncio.wrap_future(self.submit(text, word2ph, assist_text, sep_text))  # fmt: skip
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """
+        ワーカースレッドを終了する。キューに残っているリクエストは処理してから終了する。
+
+        Args:
+            timeout (Optional[float], optional): ワーカースレッドの終了を待つ最大時間 (秒) (デフォルト: None)
+        """
+
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__queue.put(None)
+        self.__worker.join(timeout)
+
+    def __enter__(self) -> BertMicroBatcher:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def __run_worker(self) -> None:
+        """
+        キューからリクエストを取り出し、最大バッチサイズか最大待ち時間に達するまで溜めてからまとめて推論する。
+        """
+
+        try:
+            self.__process_queue()
+        finally:
+            # ワーカースレッドの終了後にキューに残ったリクエストは、結果が返らず待ち続けることになるため失敗させる
+            ## 想定外の例外でワーカースレッドが終了した場合も、以降の submit() が例外になるよう終了済みにしておく
+            with self.__lock:
+                self.__closed = True
+            self.__fail_pending_requests()
+
+    def __process_queue(self) -> None:
+        """
+        終了通知を受け取るまで、キューのリクエストをまとめて推論し続ける。
+        """
+
+        while True:
+            request = self.__queue.get()
+            if request is None:
+                return
+
+            # 最初のリクエストが届いた時点から max_wait_ms だけ後続のリクエストを待つ
+            requests = [request]
+            deadline = time.perf_counter() + self.max_wait_ms / 1000
+            stop = False
+            while len(requests) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    request = self.__queue.get(timeout=max(timeout, 0)) if timeout > 0 else self.__queue.get_nowait()  # fmt: skip
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                requests.append(request)
+
+            self.__process(requests)
+            if stop:
+                return
+
+    def __fail_pending_requests(self) -> None:
+        """
+        キューに残っているリクエストをすべて RuntimeError で失敗させる。
+        """
+
+        while True:
+            try:
+                request = self.__queue.get_nowait()
+            except queue.Empty:
+                return
+            if request is not None and request[4].set_running_or_notify_cancel():
+                request[4].set_exception(RuntimeError("BertMicroBatcher is already closed"))  # fmt: skip
+
+    def __process(
+        self,
+        requests: list[tuple[str, list[int], Optional[str], Optional[list[str]], Future[NDArray[Any]]]],
+    ) -> None:  # fmt: skip
+        """
+        溜まったリクエストをまとめて推論し、結果を各 Future に設定する。
+        """
+
+        # キャンセル済みのリクエストは推論しない
+        requests = [request for request in requests if request[4].set_running_or_notify_cancel()]  # fmt: skip
+        if len(requests) == 0:
+            return
+
+        extract_kwargs = dict(self.__extract_kwargs)
+        if self.language == Languages.JP:
+            extract_kwargs["sep_texts"] = [request[3] for request in requests]
+
+        try:
+            features = self.__extract_batch(
+                [(text, word2ph, assist_text) for text, word2ph, assist_text, _, _ in requests],
+                self.__onnx_providers,
+                assist_text_weight=self.__assist_text_weight,
+                **extract_kwargs,
+            )
+        except Exception as ex:
+            # 1 件の不正なリクエストのせいで他のリクエストまで失敗しないよう、1 件ずつ推論し直す
+            if len(requests) > 1:
+                for request in requests:
+                    self.__retry(request)
+                return
+            logger.error(f"Failed to extract {self.language.name} BERT features: {ex}")
+            requests[0][4].set_exception(ex)
+            return
+
+        for request, feature in zip(requests, features):
+            request[4].set_result(feature)
+
+    def __retry(
+        self,
+        request: tuple[str, list[int], Optional[str], Optional[list[str]], Future[NDArray[Any]]],
+    ) -> None:  # fmt: skip
+        """
+        まとめて推論できなかったリクエストを 1 件だけで推論し直し、結果を Future に設定する。
+        """
+
+        text, word2ph, assist_text, sep_text, future = request
+        extract_kwargs = dict(self.__extract_kwargs)
+        if self.language == Languages.JP:
+            extract_kwargs["sep_texts"] = [sep_text]
+
+        try:
+            feature = self.__extract_batch(
+                [(text, word2ph, assist_text)],
+                self.__onnx_providers,
+                assist_text_weight=self.__assist_text_weight,
+                **extract_kwargs,
+            )[0]
+        except Exception as ex:
+            logger.error(f"Failed to extract {self.language.name} BERT features: {ex}")
+            future.set_exception(ex)
+            return
+        future.set_result(feature)
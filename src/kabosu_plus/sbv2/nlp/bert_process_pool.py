@@ -0,0 +1,281 @@
+"""
+大量のテキストの BERT 特徴量を、複数のプロセスで並列に抽出するためのモジュール。
+
+スレッドによる並列化は GIL と推論セッションの奪い合いによって頭打ちになるため、学習データの前処理などの一括処理では
+プロセスごとに BERT モデルをロードして並列に推論する方が高速になる。
+各ワーカープロセスは抽出した音素単位の特徴量を multiprocessing.shared_memory の共有メモリに書き込み、
+メインプロセスには共有メモリの名前・形状・dtype だけを返すため、大きな float 配列が pickle されてプロセス間を転送されることはない。
+"""
+
+from __future__ import annotations
+
+import multiprocessing
+import sys
+from collections.abc import Sequence
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Any, Optional, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+from kabosu_plus.sbv2.constants import Languages
+
+
+@dataclass(frozen=True)
+class SharedFeatureHandle:
+    """
+    共有メモリに書き込まれた BERT 特徴量の所在を表すハンドル。
+    """
+
+    name: str
+    shape: tuple[int, ...]
+    dtype: str
+
+
+def write_shared_feature(feature: NDArray[Any]) -> SharedFeatureHandle:
+    """
+    特徴量を新しく確保した共有メモリに書き込み、そのハンドルを返す。
+    共有メモリは read_shared_feature() で読み出されるまで解放されない。
+
+    Args:
+        feature (NDArray[Any]): 書き込む特徴量
+
+    Returns:
+        SharedFeatureHandle: 共有メモリのハンドル
+    """
+
+    # Python オブジェクトへの参照はプロセス間で共有できない
+    if feature.dtype.hasobject:
+        raise TypeError(f"Cannot write a feature of dtype {feature.dtype} to shared memory")  # fmt: skip
+
+    # 0 バイトの共有メモリは確保できないため、最低 1 バイト確保する
+    size = max(feature.nbytes, 1)
+    ## 共有メモリの解放は読み出し側が行うため、書き込み側のプロセスの終了時に resource_tracker によって解放されないようにする
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(create=True, size=size, track=False)
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        from multiprocessing import resource_tracker
+
+        resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore
+
+    try:
+        np.ndarray(feature.shape, dtype=feature.dtype, buffer=shm.buf)[...] = feature
+        return SharedFeatureHandle(shm.name, tuple(feature.shape), feature.dtype.str)
+    except BaseException:
+        ## 書き込みに失敗した場合は、読み出し側に渡らない共有メモリをここで解放する
+        shm.unlink()
+        raise
+    finally:
+        shm.close()
+
+
+def read_shared_feature(handle: SharedFeatureHandle) -> NDArray[Any]:
+    """
+    共有メモリから特徴量を読み出し、共有メモリを解放する。
+
+    Args:
+        handle (SharedFeatureHandle): write_shared_feature() で得られたハンドル
+
+    Returns:
+        NDArray[Any]: 読み出した特徴量 (共有メモリとは独立した配列)
+    """
+
+    shm = shared_memory.SharedMemory(name=handle.name)
+    try:
+        return np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=shm.buf).copy()  # fmt: skip
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+class BertProcessPool:
+    """
+    ワーカープロセスごとに BERT モデルを 1 度だけロードし、BERT 特徴量の抽出を複数のプロセスで並列に行うプール。
+
+    使用例:
+        with BertProcessPool(Languages.JP, onnx_providers, num_workers=4, pretrained_model_name_or_path="...") as pool:
+            features = pool.map([(norm_text, word2ph, None) for norm_text, word2ph in items])
+    """
+
+    def __init__(
+        self,
+        language: Languages,
+        onnx_providers: Sequence[Union[str, tuple[str, dict[str, Any]]]],
+        num_workers: int = 2,
+        pretrained_model_name_or_path: Optional[str] = None,
+        load_model_kwargs: Optional[dict[str, Any]] = None,
+        **extract_kwargs: Any,
+    ) -> None:
+        """
+        Args:
+            language (Languages): テキストの言語 (JP, EN, ZH のいずれか)
+            onnx_providers (list[str]): ONNX 推論で利用する ExecutionProvider (CPUExecutionProvider, CUDAExecutionProvider など)
+            num_workers (int, optional): ワーカープロセスの数 (デフォルト: 2)
+            pretrained_model_name_or_path (Optional[str], optional): 各ワーカープロセスでロードする BERT モデル・トークナイザーの名前またはパス (デフォルト: None)
+            load_model_kwargs (Optional[dict[str, Any]], optional): onnx_bert_models.load_model() に渡すその他の引数 (デフォルト: None)
+            **extract_kwargs (Any): extract_bert_feature_onnx_batch() に渡すその他の引数 (assist_text_weight, max_length など)
+        """
+
+        assert num_workers > 0
+
+        self.language = language
+        self.__onnx_providers = list(onnx_providers)
+        self.__extract_kwargs = extract_kwargs
+        # CUDA を利用するワーカープロセスでも安全に初期化できるよう、fork ではなく spawn でプロセスを起動する
+        self.__executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(language, self.__onnx_providers, pretrained_model_name_or_path, load_model_kwargs or {}),  # fmt: skip
+        )
+
+    def submit(
+        self,
+        batch: Sequence[tuple[str, list[int], Optional[str]]],
+        sep_texts: Optional[Sequence[Optional[list[str]]]] = None,
+    ) -> Future[list[NDArray[Any]]]:
+        """
+        (テキスト, word2ph, 補助テキスト) のタプルのリストを 1 つのワーカープロセスに渡し、BERT 特徴量をまとめて抽出する。
+
+        Args:
+            batch (Sequence[tuple[str, list[int], Optional[str]]]): (テキスト, word2ph, 補助テキスト) のタプルのリスト
+            sep_texts (Optional[Sequence[Optional[list[str]]]], optional): g2p() で得られた各テキストの sep_text のリスト (日本語のみ有効) (デフォルト: None)
+
+        Returns:
+            Future[list[NDArray[Any]]]: batch と同じ順序の BERT の特徴量のリストを返す Future
+        """
+
+        extract_kwargs = dict(self.__extract_kwargs)
+        if sep_texts is not None and self.language == Languages.JP:
+            extract_kwargs["sep_texts"] = list(sep_texts)
+
+        handles_future = self.__executor.submit(
+            _extract_to_shared_memory,
+            self.language,
+            self.__onnx_providers,
+            list(batch),
+            extract_kwargs,
+        )
+
+        # 結果が受け取られなくても共有メモリが解放されるよう、完了時点で必ず読み出す
+        result: Future[list[NDArray[Any]]] = Future()
+
+        def on_done(future: Future[list[SharedFeatureHandle]]) -> None:
+            try:
+                handles = future.result()
+            except BaseException as ex:
+                result.set_exception(ex)
+                return
+            features: list[NDArray[Any]] = []
+            error: Optional[BaseException] = None
+            for handle in handles:
+                try:
+                    features.append(read_shared_feature(handle))
+                except BaseException as ex:
+                    error = error or ex
+            if error is not None:
+                result.set_exception(error)
+            else:
+                result.set_result(features)
+
+        handles_future.add_done_callback(on_done)
+        return result
+
+    def map(
+        self,
+        batch: Sequence[tuple[str, list[int], Optional[str]]],
+        chunk_size: int = 32,
+        sep_texts: Optional[Sequence[Optional[list[str]]]] = None,
+    ) -> list[NDArray[Any]]:
+        """
+        batch を chunk_size 件ずつに分割して各ワーカープロセスに振り分け、すべての BERT 特徴量を batch と同じ順序で返す。
+
+        Args:
+            batch (Sequence[tuple[str, list[int], Optional[str]]]): (テキスト, word2ph, 補助テキスト) のタプルのリスト
+            chunk_size (int, optional): 1 つのワーカープロセスにまとめて渡す件数 (デフォルト: 32)
+            sep_texts (Optional[Sequence[Optional[list[str]]]], optional): g2p() で得られた各テキストの sep_text のリスト (日本語のみ有効) (デフォルト: None)
+
+        Returns:
+            list[NDArray[Any]]: batch と同じ順序の BERT の特徴量のリスト
+        """
+
+        assert chunk_size > 0
+        futures = [
+            self.submit(
+                batch[start : start + chunk_size],
+                sep_texts[start : start + chunk_size] if sep_texts is not None else None,
+            )
+            for start in range(0, len(batch), chunk_size)
+        ]
+        return [feature for future in futures for feature in future.result()]
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        すべてのワーカープロセスを終了する。
+
+        Args:
+            wait (bool, optional): 実行中の処理が完了するまで待つかどうか (デフォルト: True)
+        """
+
+        self.__executor.shutdown(wait=wait)
+
+    def __enter__(self) -> BertProcessPool:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.shutdown()
+
+
+# 以下の関数は ProcessPoolExecutor に渡され、spawn されたワーカープロセスではモジュール名と関数名から読み込み直される
+## BertProcessPool のクラス内で __ から始まる名前を参照すると _BertProcessPool__ に置き換えられて見つからなくなるため、_ 1 つの名前にしている
+
+
+def _init_worker(
+    language: Languages,
+    onnx_providers: list[Union[str, tuple[str, dict[str, Any]]]],
+    pretrained_model_name_or_path: Optional[str],
+    load_model_kwargs: dict[str, Any],
+) -> None:
+    """
+    ワーカープロセスの起動時に、BERT モデルとトークナイザーを 1 度だけロードする。
+    """
+
+    from kabosu_plus.sbv2.nlp import onnx_bert_models
+
+    onnx_bert_models.load_model(
+        language,
+        pretrained_model_name_or_path,
+        onnx_providers=onnx_providers,
+        **load_model_kwargs,
+    )
+    onnx_bert_models.load_tokenizer(language, pretrained_model_name_or_path)
+
+
+def _extract_to_shared_memory(
+    language: Languages,
+    onnx_providers: list[Union[str, tuple[str, dict[str, Any]]]],
+    batch: list[tuple[str, list[int], Optional[str]]],
+    extract_kwargs: dict[str, Any],
+) -> list[SharedFeatureHandle]:
+    """
+    ワーカープロセス内で BERT 特徴量をまとめて抽出し、共有メモリに書き込んだハンドルのリストを返す。
+    """
+
+    from kabosu_plus.sbv2.nlp.bert_micro_batcher import get_batch_extractor
+
+    features = get_batch_extractor(language)(batch, onnx_providers, **extract_kwargs)
+
+    handles: list[SharedFeatureHandle] = []
+    try:
+        for feature in features:
+            handles.append(write_shared_feature(np.ascontiguousarray(feature)))
+    except BaseException:
+        # 途中で失敗した場合は、書き込み済みの共有メモリを解放してから例外を送出する
+        for handle in handles:
+            read_shared_feature(handle)
+        raise
+
+    return handles
@@ -0,0 +1,214 @@
+"""
+サーバーの起動時に BERT モデルをバックグラウンドでロードし、ダミーの推論で暖機運転 (ウォームアップ) するためのモジュール。
+
+デプロイ直後の最初のリクエストでは、トークナイザーのロード・推論セッションの作成・初回推論時のメモリ確保がまとめて発生し、数秒かかることがある。
+warmup() は指定された言語のモデルを別スレッドでロードし、代表的な系列長でダミーの推論を行ってメモリアリーナやカーネルを準備しておく。
+戻り値の WarmupHandle から言語ごとの準備状況とロード・ウォームアップにかかった時間を取得できるため、
+readiness probe などで「最初のリクエストが遅くならない状態」になったかどうかを判定できる。
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections.abc import Sequence
+from dataclasses import asdict, dataclass
+from typing import Any, Literal, Optional, Union
+
+import numpy as np
+
+from kabosu_plus.sbv2.constants import Languages
+from kabosu_plus.sbv2.logging import logger
+
+
+@dataclass
+class WarmupStatus:
+    """
+    言語ごとのウォームアップの状況。
+    """
+
+    language: str
+    state: Literal["pending", "loading", "warming_up", "ready", "failed"] = "pending"
+    load_seconds: Optional[float] = None
+    warmup_seconds: Optional[float] = None
+    error: Optional[str] = None
+
+
+class WarmupHandle:
+    """
+    warmup() の戻り値。言語ごとのウォームアップの状況を保持する。
+    """
+
+    def __init__(self, languages: Sequence[Languages]) -> None:
+        self.__lock = threading.Lock()
+        self.__statuses = {language: WarmupStatus(language.name) for language in languages}  # fmt: skip
+        self.__done = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def is_ready(self, language: Optional[Languages] = None) -> bool:
+        """
+        指定された言語 (指定しない場合はすべての言語) のウォームアップが完了しているかどうかを返す。
+        """
+
+        with self.__lock:
+            if language is not None:
+                return self.__statuses[language].state == "ready"
+            return all(status.state == "ready" for status in self.__statuses.values())
+
+    def is_done(self) -> bool:
+        """
+        すべての言語のウォームアップが (成功・失敗に関わらず) 終了しているかどうかを返す。
+        """
+
+        return self.__done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        すべての言語のウォームアップが終了するまで待つ。
+
+        Args:
+            timeout (Optional[float], optional): 最大待ち時間 (秒) (デフォルト: None)
+
+        Returns:
+            bool: すべての言語のウォームアップが成功したかどうか
+        """
+
+        self.__done.wait(timeout)
+        return self.is_ready()
+
+    def report(self) -> dict[str, dict[str, Any]]:
+        """
+        言語ごとの状況とロード・ウォームアップにかかった時間を、JSON に変換可能な辞書として返す。
+        """
+
+        with self.__lock:
+            return {language.name: asdict(status) for language, status in self.__statuses.items()}  # fmt: skip
+
+    def _update(self, language: Languages, **kwargs: Any) -> None:
+        with self.__lock:
+            for key, value in kwargs.items():
+                setattr(self.__statuses[language], key, value)
+
+    def _set_done(self) -> None:
+        self.__done.set()
+
+
+def warmup(
+    languages: Sequence[Languages],
+    onnx_providers: Sequence[Union[str, tuple[str, dict[str, Any]]]],
+    pretrained_model_name_or_paths: Optional[dict[Languages, str]] = None,
+    sequence_lengths: Sequence[int] = (16, 64, 128),
+    load_model_kwargs: Optional[dict[str, Any]] = None,
+    llamacpp_load_model_kwargs: Optional[dict[str, Any]] = None,
+    background: bool = True,
+) -> WarmupHandle:
+    """
+    指定された言語の BERT モデル (JP・EN・ZH は ONNX 版 BERT モデル、MULTI は llama.cpp の埋め込みモデル) をロードし、
+    代表的な系列長でダミーの推論を行ってウォームアップする。
+
+    Args:
+        languages (Sequence[Languages]): ウォームアップする言語のリスト
+        onnx_providers (list[str]): ONNX 推論で利用する ExecutionProvider (CPUExecutionProvider, CUDAExecutionProvider など)
+        pretrained_model_name_or_paths (Optional[dict[Languages, str]], optional): 言語ごとのモデルの名前またはパス。指定しない場合はデフォルトのパスが利用される (デフォルト: None)
+        sequence_lengths (Sequence[int], optional): ダミーの推論を行う系列長のリスト (デフォルト: (16, 64, 128))
+        load_model_kwargs (Optional[dict[str, Any]], optional): JP・EN・ZH の onnx_bert_models.load_model() に渡すその他の引数 (デフォルト: None)
+        llamacpp_load_model_kwargs (Optional[dict[str, Any]], optional): MULTI の llamacpp_embedding_models.load_model() に渡すその他の引数 (n_gpu_layers, n_threads など)。
+            ウォームアップでロードされたモデルは以降の load_model() の呼び出しでもそのまま返されるため、ここで本番と同じ設定を指定すること (デフォルト: None)
+        background (bool, optional): バックグラウンドのスレッドで実行するかどうか。False の場合は完了するまでブロックする (デフォルト: True)
+
+    Returns:
+        WarmupHandle: ウォームアップの状況を取得するためのハンドル
+    """
+
+    handle = WarmupHandle(languages)
+
+    def run() -> None:
+        try:
+            for language in languages:
+                model_name_or_path = (pretrained_model_name_or_paths or {}).get(language)  # fmt: skip
+                try:
+                    __warmup_language(
+                        handle,
+                        language,
+                        onnx_providers,
+                        model_name_or_path,
+                        sequence_lengths,
+                        (llamacpp_load_model_kwargs if language == Languages.MULTI else load_model_kwargs) or {},
+                    )
+                except Exception as ex:
+                    logger.error(f"Failed to warm up the {language.name} BERT model: {ex}")  # fmt: skip
+                    handle._update(language, state="failed", error=str(ex))
+        finally:
+            handle._set_done()
+
+    if background:
+        handle.thread = threading.Thread(target=run, name="BertWarmup", daemon=True)
+        handle.thread.start()
+    else:
+        run()
+
+    return handle
+
+
+def __warmup_language(
+    handle: WarmupHandle,
+    language: Languages,
+    onnx_providers: Sequence[Union[str, tuple[str, dict[str, Any]]]],
+    pretrained_model_name_or_path: Optional[str],
+    sequence_lengths: Sequence[int],
+    load_model_kwargs: dict[str, Any],
+) -> None:
+    """
+    1 つの言語のモデルをロードし、ウォームアップする。
+    load_model_kwargs は言語に応じて onnx_bert_models.load_model() または llamacpp_embedding_models.load_model() に渡される。
+    """
+
+    handle._update(language, state="loading")
+    start_time = time.perf_counter()
+
+    # llama.cpp の埋め込みモデル
+    if language == Languages.MULTI:
+        from kabosu_plus.sbv2.nlp import llamacpp_embedding_models
+
+        llamacpp_embedding_models.load_model(language, pretrained_model_name_or_path, **load_model_kwargs)  # fmt: skip
+        handle._update(language, state="warming_up", load_seconds=time.perf_counter() - start_time)  # fmt: skip
+
+        start_time = time.perf_counter()
+        ## リクエストの処理と同じロックで直列化されるよう、embed_texts() を経由して推論する
+        ## ダミーのテキストの埋め込みがキャッシュを占有しないよう、キャッシュは利用しない
+        for sequence_length in sequence_lengths:
+            llamacpp_embedding_models.embed_texts(["あ" * sequence_length], language, use_cache=False)  # fmt: skip
+
+    # ONNX 版 BERT モデル
+    else:
+        from kabosu_plus.sbv2.nlp import onnx_bert_models
+
+        onnx_bert_models.load_tokenizer(language, pretrained_model_name_or_path)
+        onnx_bert_models.load_model(
+            language,
+            pretrained_model_name_or_path,
+            onnx_providers=onnx_providers,
+            **load_model_kwargs,
+        )
+        bert_session = onnx_bert_models.get_bert_session(language, onnx_providers)
+        handle._update(language, state="warming_up", load_seconds=time.perf_counter() - start_time)  # fmt: skip
+
+        start_time = time.perf_counter()
+        # トークナイザーの初回呼び出し時の遅延初期化も済ませておく
+        special_ids: list[int] = bert_session.tokenizer("")["input_ids"]  # type: ignore
+        filler_id = bert_session.tokenizer.unk_token_id if hasattr(bert_session.tokenizer, "unk_token_id") else None  # fmt: skip
+        if filler_id is None:
+            filler_id = bert_session.pad_token_id
+        # 推論セッションのプール内のすべての推論セッションをウォームアップする
+        ## 空いている推論セッションを選ぶ checkout_strategy に任せると、直列に推論する限り常に同じ推論セッションが選ばれるため、インデックスを指定する
+        for session_index in range(len(bert_session.pool)):
+            for sequence_length in sequence_lengths:
+                input_ids = np.full((1, max(sequence_length, len(special_ids))), filler_id, dtype=np.int64)  # fmt: skip
+                if len(special_ids) > 0:
+                    input_ids[0, 0] = special_ids[0]
+                    input_ids[0, -1] = special_ids[-1]
+                bert_session.run(input_ids, session_index=session_index)
+
+    warmup_seconds = time.perf_counter() - start_time
+    handle._update(language, state="ready", warmup_seconds=warmup_seconds)
+    logger.info(f"Warmed up the {language.name} BERT model ({warmup_seconds:.2f}s)")  # fmt: skip
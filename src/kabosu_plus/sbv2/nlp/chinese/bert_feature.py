@@ -4,22 +4,34 @@ from collections.abc import Sequence
 from typing import TYPE_CHECKING, Any, Optional, Union
 
 import numpy as np
-import onnxruntime
-from numpy.typing import NDArray
+from numpy.typing import DTypeLike, NDArray
 
 from kabosu_plus.sbv2.constants import Languages
 from kabosu_plus.sbv2.nlp import onnx_bert_models
-from kabosu_plus.sbv2.utils import get_onnx_device_options
+from kabosu_plus.sbv2.nlp.bert_feature_utils import (
+    expand_word2ph_feature,
+    get_assist_text_embedding,
+    lookup_assist_text_embedding,
+    run_onnx_bert,
+    run_onnx_bert_batch,
+    store_assist_text_embedding,
+)
+from kabosu_plus.sbv2.utils.metrics import get_metrics, timed
 
 
 
 
+@timed("bert.extract.chinese")
 def extract_bert_feature_onnx(
     text: str,
     word2ph: list[int],
     onnx_providers: Sequence[Union[str, tuple[str, dict[str, Any]]]],
     assist_text: Optional[str] = None,
     assist_text_weight: float = 0.7,
+    max_length: Optional[int] = None,
+    window_overlap: int = 64,
+    output_dtype: Optional[DTypeLike] = None,
+    contiguous: bool = False,
 ) -> NDArray[Any]:
     """
     中国語のテキストから BERT の特徴量を抽出する (ONNX 推論)
@@ -30,82 +42,116 @@ def extract_bert_feature_onnx(
         onnx_providers (list[str]): ONNX 推論で利用する ExecutionProvider (CPUExecutionProvider, CUDAExecutionProvider など)
         assist_text (Optional[str], optional): 補助テキスト (デフォルト: None)
         assist_text_weight (float, optional): 補助テキストの重み (デフォルト: 0.7)
+        max_length (Optional[int], optional): 1 回の推論で入力する最大トークン数。これを超えるテキストは重なりを持つ窓に分割して推論される。指定しない場合は分割しない (デフォルト: None)
+        window_overlap (int, optional): テキストを分割する際に、隣り合う窓同士で重なるトークン数 (デフォルト: 64)
+        output_dtype (Optional[DTypeLike], optional): 出力の dtype (np.float16 を指定するとメモリ消費量と保存サイズが半分になる) 。指定した場合は C-contiguous な配列が返される (デフォルト: None)
+        contiguous (bool, optional): 転置ビューではなく C-contiguous な (隠れ層の次元数, 音素数) の配列を返すかどうか (デフォルト: False)
 
     Returns:
         NDArray[Any]: BERT の特徴量
     """
 
-    # トークナイザーとモデルの読み込み
-    tokenizer = onnx_bert_models.load_tokenizer(Languages.ZH)
-    session = onnx_bert_models.load_model(
-        language=Languages.ZH,
-    )
-    input_names = [input.name for input in session.get_inputs()]
-    output_name = session.get_outputs()[0].name
-
-    # 入力テンソルの転送に使用するデバイス種別, デバイス ID, 実行オプションを取得
-    device_type, device_id, run_options = get_onnx_device_options(session, onnx_providers)  # fmt: skip
-
-    # 入力をテンソルに変換
-    inputs = tokenizer(text, return_tensors="np")
-    input_tensor = [
-        inputs["input_ids"].astype(np.int64),  # type: ignore
-        inputs["token_type_ids"].astype(np.int64),  # type: ignore
-        inputs["attention_mask"].astype(np.int64),  # type: ignore
-    ]
-    # 推論デバイスに入力テンソルを割り当て
-    ## GPU 推論の場合、device_type + device_id に対応する GPU デバイスに入力テンソルが割り当てられる
-    io_binding = session.io_binding()
-    for name, value in zip(input_names, input_tensor):
-        gpu_tensor = onnxruntime.OrtValue.ortvalue_from_numpy(
-            value, device_type, device_id
-        )
-        io_binding.bind_ortvalue_input(name, gpu_tensor)
+    # 推論の準備が完了した BERT モデル・トークナイザーを取得
+    bert_session = onnx_bert_models.get_bert_session(Languages.ZH, onnx_providers)
+    tokenizer = bert_session.tokenizer
+
     # text から BERT 特徴量を抽出
-    io_binding.bind_output(output_name, device_type)
-    session.run_with_iobinding(io_binding, run_options=run_options)
-    res = io_binding.get_outputs()[0].numpy()
+    with get_metrics().stage("bert.tokenize"):
+        inputs = tokenizer(text, return_tensors="np")
+    res = run_onnx_bert(bert_session, inputs, max_length, window_overlap)
 
     style_res_mean = None
     if assist_text:
-        # 入力をテンソルに変換
-        style_inputs = tokenizer(assist_text, return_tensors="np")
-        style_input_tensor = [
-            style_inputs["input_ids"].astype(np.int64),  # type: ignore
-            style_inputs["token_type_ids"].astype(np.int64),  # type: ignore
-            style_inputs["attention_mask"].astype(np.int64),  # type: ignore
-        ]
-        # 推論デバイスに入力テンソルを割り当て
-        ## GPU 推論の場合、device_type + device_id に対応する GPU デバイスに入力テンソルが割り当てられる
-        io_binding = session.io_binding()  # IOBinding は作り直す必要がある
-        for name, value in zip(input_names, style_input_tensor):
-            gpu_tensor = onnxruntime.OrtValue.ortvalue_from_numpy(
-                value, device_type, device_id
-            )
-            io_binding.bind_ortvalue_input(name, gpu_tensor)
-        # assist_text から BERT 特徴量を抽出
-        io_binding.bind_output(output_name, device_type)
-        session.run_with_iobinding(io_binding, run_options=run_options)
-        style_res = io_binding.get_outputs()[0].numpy()
-        style_res_mean = np.mean(style_res, axis=0)
+
+        def compute_style_res_mean() -> NDArray[Any]:
+            # 入力をテンソルに変換
+            with get_metrics().stage("bert.tokenize"):
+                style_inputs = tokenizer(assist_text, return_tensors="np")
+            # assist_text から BERT 特徴量を抽出
+            style_res = run_onnx_bert(bert_session, style_inputs, max_length, window_overlap)
+            return np.mean(style_res, axis=0)
+
+        # 補助テキストの BERT 特徴量の平均はキャッシュされ、同じ補助テキストでは再計算されない
+        style_res_mean = get_assist_text_embedding(Languages.ZH, assist_text, compute_style_res_mean, max_length, window_overlap)  # fmt: skip
 
     assert len(word2ph) == len(text) + 2
-    word2phone = word2ph
-    phone_level_feature = []
-    for i in range(len(word2phone)):
-        if assist_text:
-            assert style_res_mean is not None
-            repeat_feature = (
-                np.tile(res[i], (word2phone[i], 1)) * (1 - assist_text_weight)
-                + np.tile(style_res_mean, (word2phone[i], 1)) * assist_text_weight
-            )
-        else:
-            repeat_feature = np.tile(res[i], (word2phone[i], 1))
-        phone_level_feature.append(repeat_feature)
 
-    phone_level_feature = np.concatenate(phone_level_feature, axis=0)
+    return expand_word2ph_feature(res, word2ph, style_res_mean, assist_text_weight, output_dtype=output_dtype, contiguous=contiguous)  # fmt: skip
+
+
+@timed("bert.extract_batch.chinese")
+def extract_bert_feature_onnx_batch(
+    batch: Sequence[tuple[str, list[int], Optional[str]]],
+    onnx_providers: Sequence[Union[str, tuple[str, dict[str, Any]]]],
+    assist_text_weight: float = 0.7,
+    bucket_width: int = 8,
+    max_batch_size: int = 16,
+    max_length: Optional[int] = None,
+    window_overlap: int = 64,
+    output_dtype: Optional[DTypeLike] = None,
+    contiguous: bool = False,
+) -> list[NDArray[Any]]:
+    """
+    複数の中国語のテキストから BERT の特徴量をまとめて抽出する (ONNX 推論)
+    系列長の近いテキスト同士をまとめて推論し、テキストごとに extract_bert_feature_onnx() と同じ形式の特徴量を返す。
+
+    Args:
+        batch (Sequence[tuple[str, list[int], Optional[str]]]): (テキスト, word2ph, 補助テキスト) のタプルのリスト
+        onnx_providers (list[str]): ONNX 推論で利用する ExecutionProvider (CPUExecutionProvider, CUDAExecutionProvider など)
+        assist_text_weight (float, optional): 補助テキストの重み (デフォルト: 0.7)
+        bucket_width (int, optional): 系列長のバケット幅 (デフォルト: 8)
+        max_batch_size (int, optional): 1 回の推論あたりの最大系列数 (デフォルト: 16)
+        max_length (Optional[int], optional): 1 回の推論で入力する最大トークン数。これを超えるテキストは重なりを持つ窓に分割して推論される。指定しない場合は分割しない (デフォルト: None)
+        window_overlap (int, optional): テキストを分割する際に、隣り合う窓同士で重なるトークン数 (デフォルト: 64)
+        output_dtype (Optional[DTypeLike], optional): 出力の dtype (np.float16 を指定するとメモリ消費量と保存サイズが半分になる) 。指定した場合は C-contiguous な配列が返される (デフォルト: None)
+        contiguous (bool, optional): 転置ビューではなく C-contiguous な (隠れ層の次元数, 音素数) の配列を返すかどうか (デフォルト: False)
+
+    Returns:
+        list[NDArray[Any]]: batch と同じ順序の BERT の特徴量のリスト
+    """
+
+    texts = [text for text, _, _ in batch]
+
+    # 推論の準備が完了した BERT モデル・トークナイザーを取得
+    bert_session = onnx_bert_models.get_bert_session(Languages.ZH, onnx_providers)
+    tokenizer = bert_session.tokenizer
+
+    # 同じ補助テキストは 1 回だけ推論し、キャッシュ済みの補助テキストは推論しない
+    style_res_means: dict[str, NDArray[Any]] = {}
+    assist_texts: list[str] = []
+    for _, _, assist_text in batch:
+        if not assist_text or assist_text in style_res_means or assist_text in assist_texts:  # fmt: skip
+            continue
+        style_res_mean = lookup_assist_text_embedding(Languages.ZH, assist_text, max_length, window_overlap)
+        if style_res_mean is not None:
+            style_res_means[assist_text] = style_res_mean
+        else:
+            assist_texts.append(assist_text)
+
+    # テキストと補助テキストをまとめて推論
+    with get_metrics().stage("bert.tokenize"):
+        input_ids_list = tokenizer(texts + assist_texts)["input_ids"]
+    outputs = run_onnx_bert_batch(
+        bert_session,
+        input_ids_list,  # type: ignore
+        bucket_width=bucket_width,
+        max_batch_size=max_batch_size,
+        max_length=max_length,
+        window_overlap=window_overlap,
+    )
+    for assist_text, output in zip(assist_texts, outputs[len(texts) :]):
+        style_res_means[assist_text] = np.mean(output, axis=0)
+        store_assist_text_embedding(Languages.ZH, assist_text, style_res_means[assist_text], max_length, window_overlap)  # fmt: skip
+
+    phone_level_features: list[NDArray[Any]] = []
+    for text, res, (_, word2ph, assist_text) in zip(texts, outputs, batch):
+        style_res_mean = style_res_means[assist_text] if assist_text else None
+        assert len(word2ph) == len(text) + 2
+        phone_level_features.append(
+            expand_word2ph_feature(res, word2ph, style_res_mean, assist_text_weight, output_dtype=output_dtype, contiguous=contiguous)  # fmt: skip
+        )
 
-    return phone_level_feature.T
+    return phone_level_features
 
 
 if __name__ == "__main__":
@@ -7,6 +7,7 @@ from pypinyin import Style, lazy_pinyin
 from kabosu_plus.sbv2.nlp.chinese.tone_sandhi import ToneSandhi
 from kabosu_plus.sbv2.nlp.chinese.normalizer import normalize_text  
 from kabosu_plus.sbv2.nlp.symbols import PUNCTUATIONS
+from kabosu_plus.sbv2.utils.metrics import timed
 
 
 with open(Path(__file__).parent / "opencpop-strict.txt", encoding="utf-8") as f:
@@ -15,6 +16,7 @@ with open(Path(__file__).parent / "opencpop-strict.txt", encoding="utf-8") as f:
     }
 
 
+@timed("chinese.g2p")
 def g2p(text: str, raise_yomi_error: bool = False) -> tuple[str, list[str], list[int], list[int]]:
     norm_text = normalize_text(text)
     pattern = r"(?<=[{0}])\s*".format("".join(PUNCTUATIONS))
@@ -3,6 +3,7 @@ import re
 import cn2an
 
 from kabosu_plus.sbv2.nlp.symbols import PUNCTUATIONS
+from kabosu_plus.sbv2.utils.metrics import timed
 
 
 __REPLACE_MAP = {
@@ -40,6 +41,7 @@ __REPLACE_MAP = {
 }
 
 
+@timed("chinese.normalize")
 def normalize_text(text: str) -> str:
     numbers = re.findall(r"\d+(?:\.?\d+)?", text)
     for number in numbers:
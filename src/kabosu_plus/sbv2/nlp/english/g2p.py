@@ -7,6 +7,7 @@ from kabosu_plus.sbv2.nlp import onnx_bert_models
 from kabosu_plus.sbv2.nlp.english.cmudict import get_dict, get_shortform_dict
 from kabosu_plus.sbv2.nlp.english.normalizer import normalize_text 
 from kabosu_plus.sbv2.nlp.symbols import PUNCTUATIONS, SYMBOLS
+from kabosu_plus.sbv2.utils.metrics import timed
 
 
 # Initialize global variables once
@@ -88,6 +89,7 @@ eng_dict = get_dict()
 short_form_dict = get_shortform_dict()
 
 
+@timed("english.g2p")
 def g2p(text: str, raise_yomi_error: bool = False) -> tuple[str, list[str], list[int], list[int]]:
     norm_text = normalize_text(text)
     phones = []
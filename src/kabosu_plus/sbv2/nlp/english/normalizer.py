@@ -2,6 +2,8 @@ import re
 
 import inflect
 
+from kabosu_plus.sbv2.utils.metrics import timed
+
 
 __INFLECT = inflect.engine()
 __COMMA_NUMBER_PATTERN = re.compile(r"([0-9][0-9\,]+[0-9])")
@@ -12,6 +14,7 @@ __ORDINAL_PATTERN = re.compile(r"[0-9]+(st|nd|rd|th)")
 __NUMBER_PATTERN = re.compile(r"[0-9]+")
 
 
+@timed("english.normalize")
 def normalize_text(text: str) -> str:
     text = __normalize_numbers(text)
     text = replace_punctuation(text)
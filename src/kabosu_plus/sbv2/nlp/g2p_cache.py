@@ -0,0 +1,101 @@
+"""
+g2p の結果をテキストとオプションごとにキャッシュするモジュール。
+UI の定型文や挨拶など同じフレーズが繰り返し読み上げられる場合に、正規化・run_frontend()・アクセントの割り当てを省略するために利用する。
+キャッシュは既定では無効になっており、set_g2p_cache_size() で最大エントリ数を指定すると有効になる。
+キャッシュのキーには辞書のバージョン (kabosu_plus.get_user_dict_version()) を含めているため、
+update_global_jtalk_with_user_dict() や user_dict.update_dict() で辞書が差し替えられると、それ以前のエントリにはヒットしなくなる。
+"""
+
+from collections.abc import Hashable
+from typing import Any, Optional
+
+from kabosu_plus import get_user_dict_version
+from kabosu_plus.sbv2.utils.lru_cache import LRUCache
+from kabosu_plus.sbv2.utils.metrics import get_metrics
+
+
+# g2p の結果のキャッシュ (既定では無効)
+__g2p_cache: LRUCache[tuple[Hashable, ...], tuple[Any, ...]] = LRUCache(maxsize=0)
+get_metrics().register_cache("g2p", __g2p_cache.stats)
+
+
+def make_g2p_cache_key(*args: Hashable) -> Optional[tuple[Hashable, ...]]:
+    """
+    g2p の入力 (テキスト・言語・各種オプション) と現在の辞書のバージョンから、キャッシュのキーを作る。
+
+    Args:
+        *args (Hashable): g2p の結果を左右するすべての入力
+
+    Returns:
+        Optional[tuple[Hashable, ...]]: キャッシュのキー (キャッシュが無効な場合は None)
+    """
+
+    if __g2p_cache.maxsize == 0:
+        return None
+    return (get_user_dict_version(), *args)
+
+
+def get_cached_g2p(key: Optional[tuple[Hashable, ...]]) -> Optional[tuple[Any, ...]]:
+    """
+    キャッシュされた g2p の結果を返す。
+    呼び出し元が結果のリストを書き換えてもキャッシュに影響しないよう、リストはコピーして返す。
+
+    Args:
+        key (Optional[tuple[Hashable, ...]]): make_g2p_cache_key() で作ったキー
+
+    Returns:
+        Optional[tuple[Any, ...]]: g2p の結果 (キャッシュが無効な場合やキャッシュにない場合は None)
+    """
+
+    if key is None:
+        return None
+    result = __g2p_cache.get(key)
+    if result is None:
+        return None
+    return __copy_result(result)
+
+
+def put_cached_g2p(key: Optional[tuple[Hashable, ...]], result: tuple[Any, ...]) -> None:
+    """
+    g2p の結果をキャッシュに格納する。キャッシュが無効な場合は何もしない。
+
+    Args:
+        key (Optional[tuple[Hashable, ...]]): make_g2p_cache_key() で作ったキー
+        result (tuple[Any, ...]): g2p の結果
+    """
+
+    if key is None:
+        return
+    __g2p_cache.put(key, __copy_result(result))
+
+
+def set_g2p_cache_size(maxsize: int) -> None:
+    """
+    g2p の結果のキャッシュの最大エントリ数を変更する (0 を指定するとキャッシュを無効化する) 。
+    """
+
+    __g2p_cache.resize(maxsize)
+
+
+def get_g2p_cache_stats() -> dict[str, int]:
+    """
+    g2p の結果のキャッシュの統計情報 (ヒット数・ミス数・現在のエントリ数・最大エントリ数) を返す。
+    """
+
+    return __g2p_cache.stats()
+
+
+def clear_g2p_cache() -> None:
+    """
+    g2p の結果のキャッシュをすべて破棄する。
+    """
+
+    __g2p_cache.clear()
+
+
+def __copy_result(result: tuple[Any, ...]) -> tuple[Any, ...]:
+    """
+    g2p の結果に含まれるリストをコピーする。
+    """
+
+    return tuple(list(value) if isinstance(value, list) else value for value in result)
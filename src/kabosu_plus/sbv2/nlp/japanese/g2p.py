@@ -13,11 +13,16 @@ from kabosu_plus import (
 from kabosu_plus.types import NjdObject
 
 from kabosu_plus.sbv2.nlp.japanese.mora_list import MORA_KATA_TO_MORA_PHONEMES, VOWELS
+from kabosu_plus.sbv2.nlp.japanese.njd_prosody import njd_features_to_prosody
 from kabosu_plus.sbv2.nlp.japanese.normalizer import replace_punctuation
 
+from kabosu_plus.sbv2.constants import Languages
+from kabosu_plus.sbv2.nlp.g2p_cache import get_cached_g2p, make_g2p_cache_key, put_cached_g2p
 from kabosu_plus.sbv2.nlp.symbols import PUNCTUATIONS
+from kabosu_plus.sbv2.utils.metrics import get_metrics, timed
 
 
+@timed("japanese.g2p")
 def g2p(
     norm_text: str,
     use_jp_extra: bool = True,
@@ -52,6 +57,12 @@ def g2p(
             - sep_kata_with_joshi: 単語単位の単語のカタカナ読みのリスト (助詞を直前の単語に連結している)
     """
 
+    # g2p のキャッシュが有効な場合は、同じテキスト・オプションに対する結果を再利用する
+    cache_key = make_g2p_cache_key(Languages.JP, norm_text, use_jp_extra, raise_yomi_error, keihan, babytalk, dakuten)  # fmt: skip
+    cached_result = get_cached_g2p(cache_key)
+    if cached_result is not None:
+        return cached_result  # type: ignore
+
     # pyopenjtalk のフルコンテキストラベルを使ってアクセントを取り出すと、punctuation の位置が消えてしまい情報が失われてしまう：
     # 「こんにちは、世界。」と「こんにちは！世界。」と「こんにちは！！！？？？世界……。」は全て同じになる。
     # よって、まず punctuation 無しの音素とアクセントのリストを作り、
@@ -59,7 +70,8 @@ def g2p(
     # アクセント割当をしなおすことによって punctuation を含めた音素とアクセントのリストを作る。
 
     # kabosu_plus から NJDFeature のリストを取得
-    njd_features = run_frontend(norm_text, keihan=keihan, babytalk=babytalk, dakuten=dakuten)
+    with get_metrics().stage("japanese.g2p.run_frontend"):
+        njd_features = run_frontend(norm_text, keihan=keihan, babytalk=babytalk, dakuten=dakuten)
 
     # punctuation がすべて消えた、音素とアクセントのタプルのリスト（「ん」は「N」）
     phone_tone_list_wo_punct = __g2phone_tone_wo_punct(njd_features)
@@ -85,7 +97,8 @@ def g2p(
         phone_w_punct += i
 
     # punctuation 無しのアクセント情報を使って、punctuation を含めたアクセント情報を作る
-    phone_tone_list = __align_tones(phone_w_punct, phone_tone_list_wo_punct)
+    with get_metrics().stage("japanese.g2p.align_tones"):
+        phone_tone_list = __align_tones(phone_w_punct, phone_tone_list_wo_punct)
     # logger.debug(f"phone_tone_list:\n{phone_tone_list}")
 
     # word2ph は厳密な解答は不可能なので（「今日」「眼鏡」等の熟字訓が存在）、
@@ -121,9 +134,12 @@ def g2p(
     if not use_jp_extra:
         phones = [phone if phone != "N" else "n" for phone in phones]
 
-    return norm_text, phones, tones, word2ph, sep_text, sep_kata, sep_kata_with_joshi
+    result = (norm_text, phones, tones, word2ph, sep_text, sep_kata, sep_kata_with_joshi)
+    put_cached_g2p(cache_key, result)
+    return result
 
 
+@timed("japanese.g2p.text_to_sep_kata")
 def text_to_sep_kata(
     norm_text: str,
     njd_features: list[NjdObject] | None = None,
@@ -507,9 +523,16 @@ def __g2phone_tone_wo_punct(
         list[tuple[str, int]]: 音素とアクセントのペアのリスト
     """
 
-    prosodies = __pyopenjtalk_g2p_prosody(
-        njd_features, drop_unvoiced_vowels=True
-    )
+    # フルコンテキストラベルを生成せずに、NJDFeature から直接アクセント記号の列を求める
+    ## 想定外の NJDFeature で失敗した場合は、従来のフルコンテキストラベルを経由する実装にフォールバックする
+    try:
+        with get_metrics().stage("japanese.g2p.njd_prosody"):
+            prosodies = njd_features_to_prosody(njd_features, drop_unvoiced_vowels=True)  # fmt: skip
+    except Exception as ex:
+        logger.warning(f"Failed to derive prosody from NJD features, falling back to full-context labels: {ex}")  # fmt: skip
+        prosodies = __pyopenjtalk_g2p_prosody(
+            njd_features, drop_unvoiced_vowels=True
+        )
     # logger.debug(f"prosodies: {prosodies}")
     result: list[tuple[str, int]] = []
     current_phrase: list[tuple[str, int]] = []
@@ -564,6 +587,7 @@ def __pyopenjtalk_g2p_prosody(
 ) -> list[str]:
     """
     ESPnet の実装から引用。直接 NJDFeature のリストを受け取る形に変更した。「ん」は「N」なことに注意。
+    通常は同じ結果をフルコンテキストラベルを経由せずに求める njd_prosody.njd_features_to_prosody() が使われ、こちらはそのフォールバックとして残している。
     ref: https://github.com/espnet/espnet/blob/master/espnet2/text/phoneme_tokenizer.py
     ------------------------------------------------------------------------------------------
 
@@ -594,7 +618,8 @@ def __pyopenjtalk_g2p_prosody(
             return -50
         return int(match.group(1))
 
-    labels = make_label(njd_features) #type: ignore
+    with get_metrics().stage("japanese.g2p.make_label"):
+        labels = make_label(njd_features) #type: ignore
     N = len(labels)
 
     phones = []
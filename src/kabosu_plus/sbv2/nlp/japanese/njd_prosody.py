@@ -0,0 +1,199 @@
+"""
+NJDFeature のリストから、フルコンテキストラベルを経由せずに音素とアクセント記号 (^ [ ] # _ $ ?) の列を直接求めるモジュール。
+
+g2p.__pyopenjtalk_g2p_prosody() は make_label() で音素ごとのフルコンテキストラベル文字列を生成し、
+そこから正規表現でアクセント句内のモーラ位置 (A1/A2/A3) ・アクセント句のモーラ数 (F1) ・疑問形フラグ (E3) を取り出している。
+これらの値は NJDFeature の pron・acc・chain_flag だけから決まるため、ここでは pyopenjtalk-plus に内蔵されている OpenJTalk の
+JPCommonLabel_push_word() (jpcommon_label.c) と同じ規則でモーラ・単語・アクセント句の対応関係を組み立て、同じ記号列を直接求める。
+"""
+
+from kabosu_plus.sbv2.nlp.japanese.mora_list import MORA_KATA_TO_MORA_PHONEMES
+from kabosu_plus.types import NjdObject
+
+
+# OpenJTalk (jpcommon_rule_utf_8.h) の特殊な発音記号
+__MORA_UNVOICE = "’"
+__MORA_LONG_VOWEL = "ー"
+__MORA_SHORT_PAUSE = "、"
+__MORA_QUESTION = "？"
+__MORA_EXCLAMATION = "！"
+
+# OpenJTalk のモーラ対応表 (カタカナ -> 音素のタプル)
+## mora_list.py の対応表から、OpenJTalk では「cl」の「ッ」を戻し、独自に追加された「ヂャ」「ヂュ」「ヂョ」「ヂェ」を除いたもの
+__JPCOMMON_MORA_PHONEMES: dict[str, tuple[str, ...]] = {
+    kata: ("cl",) if kata == "ッ" else tuple(phoneme for phoneme in phonemes if phoneme is not None)  # fmt: skip
+    for kata, phonemes in MORA_KATA_TO_MORA_PHONEMES.items()
+    if not (len(kata) == 2 and kata[0] == "ヂ")
+}
+
+# 無声化できる母音
+__UNVOICE_MAP = {"a": "A", "i": "I", "u": "U", "e": "E", "o": "O"}
+
+# フルコンテキストラベルの A1/A2/A3/F1 の値の上限 (jpcommon_label.c の MAX_M)
+__MAX_M = 49
+
+
+def njd_features_to_prosody(
+    njd_features: list[NjdObject],
+    drop_unvoiced_vowels: bool = True,
+) -> list[str]:
+    """
+    NJDFeature のリストから、g2p.__pyopenjtalk_g2p_prosody() と同じ音素とアクセント記号の列を求める。
+
+    Args:
+        njd_features (list[NjdObject]): kabosu_plus.run_frontend() の結果
+        drop_unvoiced_vowels (bool): 無声化された母音を通常の母音として扱うかどうか (デフォルト: True)
+
+    Returns:
+        list[str]: 音素とアクセント記号のリスト
+    """
+
+    # 音素のリスト ([音素, モーラのインデックス] 、ポーズの場合はモーラのインデックスが None)
+    phonemes: list[list] = []  # type: ignore
+    # モーラごとの所属する単語のインデックス
+    mora_words: list[int] = []
+    # 単語ごとの所属するアクセント句のインデックス
+    word_accent_phrases: list[int] = []
+    # アクセント句ごとのアクセント核の位置・疑問形かどうか
+    accent_phrase_accents: list[int] = []
+    accent_phrase_questions: list[bool] = []
+    short_pause_flag = False
+
+    for njd_feature in njd_features:
+        pron = njd_feature["pron"]
+
+        # 「、」「？」「！」は直後の音素の前にポーズを入れるためのフラグを立てるだけで、音素は追加しない
+        if pron == __MORA_SHORT_PAUSE:
+            short_pause_flag = True
+            continue
+        if pron in (__MORA_QUESTION, __MORA_EXCLAMATION):
+            ## 「？」の場合は直前の音素 (ポーズの場合はその 1 つ前の音素) が所属するアクセント句を疑問形にする
+            if pron == __MORA_QUESTION and len(phonemes) > 0:
+                phoneme = phonemes[-1] if phonemes[-1][1] is not None else phonemes[-2]
+                accent_phrase_questions[word_accent_phrases[mora_words[phoneme[1]]]] = True  # fmt: skip
+            short_pause_flag = True
+            continue
+
+        word_index: int | None = None
+        position = 0
+        while position < len(pron):
+            # 長音: 直前の音素と同じ音素を、直前のモーラと同じ単語に所属する新しいモーラとして追加する
+            ## 先頭やポーズの直後の長音は無視される
+            if pron.startswith(__MORA_LONG_VOWEL, position):
+                if len(phonemes) > 0 and not short_pause_flag:
+                    mora_words.append(mora_words[-1])
+                    phonemes.append([phonemes[-1][0], len(mora_words) - 1])
+                position += len(__MORA_LONG_VOWEL)
+                continue
+
+            # 無声化: この単語内の直前の音素を無声化する (母音以外は変化しない)
+            if pron.startswith(__MORA_UNVOICE, position):
+                if len(phonemes) > 0 and word_index is not None:
+                    phonemes[-1][0] = __UNVOICE_MAP.get(phonemes[-1][0], phonemes[-1][0])
+                position += len(__MORA_UNVOICE)
+                continue
+
+            # 通常のモーラ: 2 文字のモーラを優先して照合する
+            mora = pron[position : position + 2]
+            mora_phonemes = __JPCOMMON_MORA_PHONEMES.get(mora) if len(mora) == 2 else None
+            if mora_phonemes is None:
+                mora = pron[position]
+                mora_phonemes = __JPCOMMON_MORA_PHONEMES.get(mora)
+            ## 対応表にない発音が出現した場合は、この単語の残りの発音を読み飛ばす
+            if mora_phonemes is None:
+                break
+
+            # 保留中のポーズを挿入する (文頭のポーズは挿入されない)
+            if short_pause_flag:
+                if len(phonemes) > 0:
+                    phonemes.append(["pau", None])
+                short_pause_flag = False
+            if word_index is None:
+                word_index = len(word_accent_phrases)
+                word_accent_phrases.append(-1)
+            mora_words.append(word_index)
+            for mora_phoneme in mora_phonemes:
+                phonemes.append([mora_phoneme, len(mora_words) - 1])
+            position += len(mora)
+
+        # モーラを 1 つも追加しなかった単語は、単語として扱われない
+        if word_index is None:
+            continue
+
+        # 最初の単語と、直前の単語に連結されない単語は新しいアクセント句を作る
+        if word_index == 0 or njd_feature["chain_flag"] != 1:
+            word_accent_phrases[word_index] = len(accent_phrase_accents)
+            accent_phrase_accents.append(njd_feature["acc"])
+            accent_phrase_questions.append(False)
+        else:
+            word_accent_phrases[word_index] = word_accent_phrases[word_index - 1]
+
+    if len(phonemes) == 0:
+        return []
+
+    # アクセント句ごとの先頭のモーラのインデックスとモーラ数 (アクセント句内のモーラは連続している)
+    accent_phrase_first_moras: list[int] = [-1] * len(accent_phrase_accents)
+    accent_phrase_mora_counts: list[int] = [0] * len(accent_phrase_accents)
+    for mora_index, word_index in enumerate(mora_words):
+        accent_phrase_index = word_accent_phrases[word_index]
+        if accent_phrase_mora_counts[accent_phrase_index] == 0:
+            accent_phrase_first_moras[accent_phrase_index] = mora_index
+        accent_phrase_mora_counts[accent_phrase_index] += 1
+
+    def mora_position(mora_index: int) -> tuple[int, int, int]:
+        """
+        モーラのアクセント句内の位置 (1 始まり) ・アクセント句のモーラ数・アクセント句のアクセント核の位置を返す。
+        """
+
+        accent_phrase_index = word_accent_phrases[mora_words[mora_index]]
+        return (
+            mora_index - accent_phrase_first_moras[accent_phrase_index] + 1,
+            accent_phrase_mora_counts[accent_phrase_index],
+            accent_phrase_accents[accent_phrase_index],
+        )
+
+    result = ["^"]
+    for index, (phoneme, mora_index) in enumerate(phonemes):
+        if mora_index is None:
+            result.append("_")
+            continue
+
+        if drop_unvoiced_vowels and phoneme in "AEIOU":
+            phoneme = phoneme.lower()
+        result.append(phoneme)
+
+        # フルコンテキストラベルの A1/A2/A3/F1 に相当する値
+        position, mora_count, accent = mora_position(mora_index)
+        a1 = __limit(position - (mora_count if accent == 0 else accent), -__MAX_M, __MAX_M)
+        a2 = __limit(position, 1, __MAX_M)
+        a3 = __limit(mora_count - position + 1, 1, __MAX_M)
+        f1 = __limit(mora_count, 1, __MAX_M)
+        # 次の音素がポーズか文末の場合、ラベルの A2 は xx になる
+        if index + 1 < len(phonemes) and phonemes[index + 1][1] is not None:
+            a2_next = __limit(mora_position(phonemes[index + 1][1])[0], 1, __MAX_M)
+        else:
+            a2_next = -50
+
+        # accent phrase border
+        if a3 == 1 and a2_next == 1 and phoneme in "aeiouAEIOUNcl":
+            result.append("#")
+        # pitch falling
+        elif a1 == 0 and a2_next == a2 + 1 and a2 != f1:
+            result.append("]")
+        # pitch rising
+        elif a2 == 1 and a2_next == 2:
+            result.append("[")
+
+    # 最後の音素が所属するアクセント句が疑問形かどうか
+    last_accent_phrase_index = word_accent_phrases[mora_words[phonemes[-1][1]]]
+    result.append("?" if accent_phrase_questions[last_accent_phrase_index] else "$")
+
+    return result
+
+
+def __limit(value: int, minimum: int, maximum: int) -> int:
+    """
+    値を minimum 以上 maximum 以下に収める。
+    """
+
+    return min(max(value, minimum), maximum)
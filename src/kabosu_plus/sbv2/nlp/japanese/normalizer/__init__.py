@@ -10,6 +10,7 @@ from num2words import num2words
 from kabosu_plus.sbv2.nlp.japanese.normalizer.katakana_map import KATAKANA_MAP
 from kabosu_plus.sbv2.nlp.japanese.normalizer.romkan import to_katakana
 from kabosu_plus.sbv2.nlp.symbols import PUNCTUATIONS
+from kabosu_plus.sbv2.utils.metrics import timed
 
 
 # C2K の初期化
@@ -465,6 +466,7 @@ __ENGLISH_WORD_WITH_NUMBER_PATTERN = re.compile(
 __ALPHABET_PATTERN = re.compile(r"[a-zA-Z]")
 
 
+@timed("japanese.normalize")
 def normalize_text(text: str) -> str:
     """
     日本語のテキストを正規化する。
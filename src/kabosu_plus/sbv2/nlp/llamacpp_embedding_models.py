@@ -10,22 +10,41 @@ Style-Bert-VITS2 の ONNX 推論に必要な各言語ごとの ONNX 版 BERT モ
 """
 
 import gc
+import os
+import threading
 import time
 from collections.abc import Sequence
 from pathlib import Path
 from typing import Any, Optional, Union
 
 
+import numpy as np
 from huggingface_hub import hf_hub_download
 from llama_cpp import Llama
+from numpy.typing import NDArray
 
 from kabosu_plus.sbv2.constants import Languages, DEFAULT_ONNX_BERT_MODEL_PATHS
 from kabosu_plus.sbv2.logging import logger
+from kabosu_plus.sbv2.utils.lru_cache import LRUCache
+from kabosu_plus.sbv2.utils.metrics import get_metrics
+from kabosu_plus.sbv2.utils.model_registry import get_model_registry
 
 
 
-# 各言語ごとのロード済みの BERT モデルを格納する辞書
-__loaded_models: dict[Languages, Any] = {}
+# 各言語ごとのロード済みの BERT モデルは、kabosu_plus.sbv2.utils.model_registry のモデルのレジストリに下記のキーで格納される
+## メモリ予算を超えた場合は最も長い間利用されていないモデルからアンロードされ、次に利用される際に同じ引数で再ロードされる
+__MODEL_KEY = "llamacpp_embedding_model"
+
+# デフォルトで利用する GGUF ファイルの名前
+DEFAULT_MODEL_FILENAME = "qwen3-embedding-0.6b-q4_k_m.gguf"
+
+# (モデルファイルのパス, テキスト) をキーとした、テキストの埋め込みのキャッシュ
+## 同じ補助テキストや同じ発話が繰り返し入力された場合に、埋め込みの計算を省略する
+__embedding_cache: LRUCache[tuple[str, str], NDArray[np.float32]] = LRUCache(maxsize=256)  # fmt: skip
+get_metrics().register_cache("llamacpp.embedding", __embedding_cache.stats)
+
+# llama.cpp のコンテキストはスレッドセーフではないため、埋め込みの計算はこのロックで直列化する
+__embed_lock = threading.Lock()
 
 
 def load_model(
@@ -34,6 +53,15 @@ def load_model(
     cache_dir: Optional[str] = None,
     revision: str = "main",
     enable_cpu_mem_arena: bool | None = None,
+    model_filename: str = DEFAULT_MODEL_FILENAME,
+    n_gpu_layers: int = -1,
+    flash_attn: bool = True,
+    n_threads: Optional[int] = None,
+    n_threads_batch: Optional[int] = None,
+    n_batch: int = 512,
+    n_ctx: int = 512,
+    use_mmap: bool = True,
+    use_mlock: bool = False,
 ) -> Any:  # fmt: skip
     """
     指定された言語の ONNX 版 BERT モデルをロードし、ロード済みの ONNX 版 BERT モデルを返す。
@@ -53,53 +81,191 @@ def load_model(
         cache_dir (Optional[str]): モデルのキャッシュディレクトリ。指定しない場合はデフォルトのキャッシュディレクトリが利用される (デフォルト: None)
         revision (str): モデルの Hugging Face 上の Git リビジョン。指定しない場合は最新の main ブランチの内容が利用される (デフォルト: None)
         enable_cpu_mem_arena (bool | None): CPU 推論時にもメモリアリーナを有効化するかどうか。デフォルトでは GPU 推論時のみ有効化される (デフォルト: None)
+        model_filename (str): ロードする GGUF ファイルの名前。量子化の異なるファイルを選ぶ場合に指定する (デフォルト: "qwen3-embedding-0.6b-q4_k_m.gguf")
+        n_gpu_layers (int): GPU にオフロードするレイヤー数。-1 の場合はすべてのレイヤーをオフロードする。GPU のない環境では 0 を指定する (デフォルト: -1)
+        flash_attn (bool): Flash Attention を利用するかどうか (デフォルト: True)
+        n_threads (Optional[int]): 推論に利用するスレッド数。None の場合は論理コア数の半分になる (デフォルト: None)
+        n_threads_batch (Optional[int]): バッチ処理 (埋め込みの計算) に利用するスレッド数。None の場合は論理コア数になる (デフォルト: None)
+        n_batch (int): 1 回の llama.cpp の呼び出しで処理する最大トークン数。1 つのテキストのトークン数はこれを超えられない (デフォルト: 512)
+        n_ctx (int): コンテキスト長。n_batch 以上にする必要がある (デフォルト: 512)
+        use_mmap (bool): GGUF ファイルを mmap でロードするかどうか。有効な場合、同じファイルをロードした複数のプロセスで重みのページキャッシュが共有される (デフォルト: True)
+        use_mlock (bool): ロードした重みを mlock で物理メモリに固定し、スワップアウトされないようにするかどうか (デフォルト: False)
+
+    CPU のみのノードでは、n_gpu_layers=0 とした上で n_threads と n_threads_batch に物理コア数 (複数のワーカープロセスを起動する場合は 1 プロセスあたりの物理コア数) を指定すると、
+    ハイパースレッディングによる競合を避けられるため多くの場合でスループットが向上する。
+    複数のテキストをまとめて埋め込む場合は n_batch と n_ctx を大きくするとよい。各設定の効果は benchmarks/llamacpp_embedding_cpu.py で計測できる。
 
     Returns:
         onnxruntime.InferenceSession: ロード済みの BERT モデル
     """
 
     # すでにロード済みの場合はそのまま返す
-    if language in __loaded_models:
-        return __loaded_models[language]
+    model_registry = get_model_registry()
+    loaded_model = model_registry.get((__MODEL_KEY, language))
+    if loaded_model is not None:
+        return loaded_model
 
-    # pretrained_model_name_or_path が指定されていない場合はデフォルトのパスを利用
+    # メモリ予算の超過によってアンロードされたモデルを引数なしで再ロードする場合は、前回のロード時の引数を引き継ぐ
     if pretrained_model_name_or_path is None:
-        assert DEFAULT_ONNX_BERT_MODEL_PATHS[language].exists(), \
-            f"The default {language.name} BERT tokenizer does not exist on the file system. Please specify the path to the pre-trained model."  # fmt: skip
-        pretrained_model_name_or_path = str(DEFAULT_ONNX_BERT_MODEL_PATHS[language])
-
-
-    # pretrained_model_name_or_path に Hugging Face のリポジトリ名が指定された場合 (aaaa/bbbb のフォーマットを想定):
-    # 指定された revision の ONNX 版 BERT モデルを cache_dir にダウンロードする (既にダウンロード済みの場合は何も行われない)
-    if len(pretrained_model_name_or_path.split("/")) == 2:
-        model_path = Path(
-            hf_hub_download(
-                repo_id=pretrained_model_name_or_path,
-                filename="qwen3-embedding-0.6b-q4_k_m.gguf",
-                cache_dir=cache_dir,
-                revision=revision,
+        previous_load_kwargs = model_registry.get_load_kwargs((__MODEL_KEY, language))
+        if previous_load_kwargs is not None:
+            return load_model(language, **previous_load_kwargs)
+
+    # 複数のスレッドが同時に同じモデルをロードしないよう、ロードは 1 つのスレッドだけが行い、他のスレッドはその完了を待ってロード済みのモデルを利用する
+    with model_registry.load_lock((__MODEL_KEY, language)):
+        loaded_model = model_registry.get((__MODEL_KEY, language))
+        if loaded_model is not None:
+            return loaded_model
+
+        # pretrained_model_name_or_path が指定されていない場合はデフォルトのパスを利用
+        if pretrained_model_name_or_path is None:
+            assert DEFAULT_ONNX_BERT_MODEL_PATHS[language].exists(), \
+                f"The default {language.name} BERT tokenizer does not exist on the file system. Please specify the path to the pre-trained model."  # fmt: skip
+            pretrained_model_name_or_path = str(DEFAULT_ONNX_BERT_MODEL_PATHS[language])
+
+
+        # pretrained_model_name_or_path に Hugging Face のリポジトリ名が指定された場合 (aaaa/bbbb のフォーマットを想定):
+        # 指定された revision の ONNX 版 BERT モデルを cache_dir にダウンロードする (既にダウンロード済みの場合は何も行われない)
+        if len(pretrained_model_name_or_path.split("/")) == 2:
+            model_path = Path(
+                hf_hub_download(
+                    repo_id=pretrained_model_name_or_path,
+                    filename=model_filename,
+                    cache_dir=cache_dir,
+                    revision=revision,
+                )
             )
+
+        # pretrained_model_name_or_path にファイルパスが指定された場合:
+        # 既にダウンロード済みという前提のもと、モデルへのローカルパスを model_path に格納する
+        else:
+            model_path = Path(pretrained_model_name_or_path).resolve() / model_filename
+
+
+        # BERT モデルをロードし、レジストリに格納して返す
+        start_time = time.time()
+        assert n_ctx >= n_batch, f"n_ctx ({n_ctx}) must be greater than or equal to n_batch ({n_batch})"  # fmt: skip
+        model = Llama(
+            model_path=str(model_path), #stringでないと読まない
+            embedding=True,
+            flash_attn=flash_attn,
+            n_gpu_layers=n_gpu_layers,
+            n_threads=n_threads,
+            n_threads_batch=n_threads_batch,
+            n_ctx=n_ctx,
+            n_batch=n_batch,
+            ## 埋め込みの計算では 1 つのテキストが 1 回の物理バッチに収まる必要があるため、物理バッチサイズも n_batch に揃える
+            n_ubatch=n_batch,
+            use_mmap=use_mmap,
+            use_mlock=use_mlock,
         )
+        ## メモリ使用量は GGUF ファイルのサイズで見積もる
+        model_registry.put(
+            (__MODEL_KEY, language),
+            model,
+            footprint=os.path.getsize(model_path),
+            load_kwargs={
+                "pretrained_model_name_or_path": pretrained_model_name_or_path,
+                "cache_dir": cache_dir,
+                "revision": revision,
+                "enable_cpu_mem_arena": enable_cpu_mem_arena,
+                "model_filename": model_filename,
+                "n_gpu_layers": n_gpu_layers,
+                "flash_attn": flash_attn,
+                "n_threads": n_threads,
+                "n_threads_batch": n_threads_batch,
+                "n_batch": n_batch,
+                "n_ctx": n_ctx,
+                "use_mmap": use_mmap,
+                "use_mlock": use_mlock,
+            },
+            on_remove=__on_model_removed,
+        )
+        logger.info(
+            f"Loaded the {language.name} ONNX BERT model from {pretrained_model_name_or_path} ({time.time() - start_time:.2f}s)"
+        )
+
+        return model
+
+
+def embed_texts(
+    texts: Sequence[str],
+    language: Languages = Languages.MULTI,
+    use_cache: bool = True,
+) -> list[NDArray[np.float32]]:
+    """
+    複数のテキストの埋め込みをまとめて計算する。
+    キャッシュにないテキストだけを重複を除いて 1 回の Llama.embed() 呼び出しに渡し、llama.cpp のバッチに複数のシーケンスとして詰めて計算する。
+    返される配列はキャッシュと共有されるため、読み取り専用になっている。
+    llama.cpp のコンテキストはスレッドセーフではないため、埋め込みモデルで推論する場合は必ずこの関数を経由すること。
+
+    Args:
+        texts (Sequence[str]): 埋め込みを計算するテキストのリスト
+        language (Languages): 利用する埋め込みモデルの言語 (デフォルト: Languages.MULTI)
+        use_cache (bool): キャッシュを参照・更新するかどうか。ウォームアップなど、結果を再利用しない推論では False にする (デフォルト: True)
+
+    Returns:
+        list[NDArray[np.float32]]: texts と同じ順序の埋め込みのリスト
+    """
 
-    # pretrained_model_name_or_path にファイルパスが指定された場合:
-    # 既にダウンロード済みという前提のもと、モデルへのローカルパスを model_path に格納する
-    else:
-        model_path = Path(pretrained_model_name_or_path).resolve() / "qwen3-embedding-0.6b-q4_k_m.gguf"
+    model = load_model(language)
+    model_path = str(model.model_path)
+
+    # キャッシュ済みのテキストは埋め込みを計算しない
+    embeddings: list[Optional[NDArray[np.float32]]] = [None] * len(texts)
+    missing_indices: dict[str, list[int]] = {}
+    for index, text in enumerate(texts):
+        embedding = __embedding_cache.get((model_path, text)) if use_cache else None
+        if embedding is not None:
+            embeddings[index] = embedding
+        else:
+            missing_indices.setdefault(text, []).append(index)
+
+    if len(missing_indices) > 0:
+        with __embed_lock, get_metrics().stage("bert.llamacpp_embed"):
+            missing_embeddings = model.embed(list(missing_indices.keys()))
+        for (text, indices), embedding_list in zip(missing_indices.items(), missing_embeddings):  # fmt: skip
+            embedding = np.asarray(embedding_list, dtype=np.float32)
+            embedding.flags.writeable = False
+            if use_cache:
+                __embedding_cache.put((model_path, text), embedding)
+            for index in indices:
+                embeddings[index] = embedding
+
+    return embeddings  # type: ignore
+
+
+def set_embedding_cache_size(maxsize: int) -> None:
+    """
+    テキストの埋め込みのキャッシュの最大エントリ数を変更する (0 を指定するとキャッシュを無効化する) 。
+    """
+
+    __embedding_cache.resize(maxsize)
+
+
+def get_embedding_cache_stats() -> dict[str, int]:
+    """
+    テキストの埋め込みのキャッシュの統計情報 (ヒット数・ミス数・現在のエントリ数・最大エントリ数) を返す。
+    """
+
+    return __embedding_cache.stats()
 
 
-    # BERT モデルをロードし、辞書に格納して返す
-    start_time = time.time()
-    __loaded_models[language] = Llama(
-        model_path=str(model_path), #stringでないと読まない
-        embedding=True,
-        flash_attn=True,
-        n_gpu_layers=-1
-    )
-    logger.info(
-        f"Loaded the {language.name} ONNX BERT model from {pretrained_model_name_or_path} ({time.time() - start_time:.2f}s)"
-    )
+def clear_embedding_cache() -> None:
+    """
+    テキストの埋め込みのキャッシュをすべて破棄する。
+    """
+
+    __embedding_cache.clear()
+
+
+def __on_model_removed(key: tuple[str, Languages], model: Any) -> None:
+    """
+    BERT モデルがアンロードされた (レジストリから削除された) 際に、メモリを解放する。
+    """
 
-    return __loaded_models[language]
+    gc.collect()
+    logger.info(f"Unloaded the {key[1].name} ONNX BERT model")
 
 
 
@@ -108,7 +274,7 @@ def is_model_loaded(language: Languages) -> bool:
     指定された言語の ONNX 版 BERT モデルがロード済みかどうかを返す。
     """
 
-    return language in __loaded_models
+    return (__MODEL_KEY, language) in get_model_registry()
 
 
 
@@ -120,16 +286,15 @@ def unload_model(language: Languages) -> None:
         language (Languages): アンロードする BERT モデルの言語
     """
 
-    if language in __loaded_models:
-        del __loaded_models[language]
-        gc.collect()
-        logger.info(f"Unloaded the {language.name} ONNX BERT model")
+    ## メモリの解放は __on_model_removed() で行われる
+    get_model_registry().remove((__MODEL_KEY, language))
 
 def unload_all_models() -> None:
     """
     すべての ONNX 版 BERT モデルをアンロードする。
     """
 
-    for language in list(__loaded_models.keys()):
-        unload_model(language)
+    for kind, language in get_model_registry().keys():
+        if kind == __MODEL_KEY:
+            unload_model(language)
     logger.info("Unloaded all ONNX BERT models")
@@ -4,21 +4,32 @@ from collections.abc import Sequence
 from typing import  Any, Optional, Union
 
 import numpy as np
-from numpy.typing import NDArray
+from numpy.typing import DTypeLike, NDArray
 
 from kabosu_plus.sbv2.constants import Languages
 from kabosu_plus.sbv2.nlp import llamacpp_embedding_models
 from kabosu_plus.sbv2.nlp import onnx_bert_models
+from kabosu_plus.sbv2.nlp.bert_feature_utils import SparsePhoneLevelFeature
+from kabosu_plus.sbv2.utils.metrics import timed
 
 from kabosu_plus.sbv2.nlp import language_selector
 
 
+# 韓国語のテキストのトークン数を数えるための MeCab の Tagger (初回利用時に作成され、以降は使い回される)
+__korean_tagger: Optional[Any] = None
+
+
+@timed("bert.extract.multiringual")
 def extract_bert_feature_lammacpp(
     text: str,
     word2ph: list[int],
     assist_text: Optional[str] = None,
     assist_text_weight: float = 0.7,
-) -> NDArray[Any]:
+    output_dtype: Optional[DTypeLike] = None,
+    contiguous: bool = False,
+    language: Optional[Languages] = None,
+    sparse: bool = False,
+) -> Union[NDArray[Any], SparsePhoneLevelFeature]:
     """
     日本語のテキストから BERT の特徴量を抽出する (ONNX 推論)
 
@@ -28,64 +39,166 @@ def extract_bert_feature_lammacpp(
         onnx_providers (list[str]): ONNX 推論で利用する ExecutionProvider (CPUExecutionProvider, CUDAExecutionProvider など)
         assist_text (Optional[str], optional): 補助テキスト (デフォルト: None)
         assist_text_weight (float, optional): 補助テキストの重み (デフォルト: 0.7)
+        output_dtype (Optional[DTypeLike], optional): 出力の dtype (np.float16 を指定するとメモリ消費量と保存サイズが半分になる) 。指定した場合は C-contiguous な配列が返される (デフォルト: None)
+        contiguous (bool, optional): 転置ビューではなく C-contiguous な (隠れ層の次元数, 音素数) の配列を返すかどうか (デフォルト: False)
+        language (Optional[Languages], optional): multiringual.g2p.g2p() で判定済みのテキストの言語。
+            指定した場合は word2ph も同じ g2p() の結果とみなし、言語の判定と word2ph の検証のためのトークナイズを省略する (デフォルト: None)
+        sparse (bool, optional): 密な配列の代わりに SparsePhoneLevelFeature を返すかどうか。密な配列が必要になった時点で to_dense() で展開できる (デフォルト: False)
+
+    Returns:
+        Union[NDArray[Any], SparsePhoneLevelFeature]: BERT の特徴量
+    """
+
+    # テキストと補助テキストの埋め込みをまとめて計算 (キャッシュ済みの場合は計算しない)
+    texts = [text, assist_text] if assist_text else [text]
+    embeddings = llamacpp_embedding_models.embed_texts(texts, Languages.MULTI)
+
+    return __build_phone_level_feature(
+        text,
+        word2ph,
+        embeddings[0],
+        embeddings[1] if assist_text else None,
+        assist_text_weight,
+        language=language,
+        output_dtype=output_dtype,
+        contiguous=contiguous,
+        sparse=sparse,
+    )
+
+
+def extract_bert_feature_from_g2p(
+    g2p_result: tuple[Languages, str, list[str], list[int], list[int], Optional[list[str]], Optional[list[str]], Optional[list[str]]],
+    assist_text: Optional[str] = None,
+    assist_text_weight: float = 0.7,
+    output_dtype: Optional[DTypeLike] = None,
+    contiguous: bool = False,
+    sparse: bool = False,
+) -> Union[NDArray[Any], SparsePhoneLevelFeature]:
+    """
+    multiringual.g2p.g2p() の結果から BERT の特徴量を抽出する (llama.cpp 推論)
+    g2p() で判定済みの言語を extract_bert_feature_lammacpp() に渡すため、言語の判定とトークナイズをやり直さない。
+
+    Args:
+        g2p_result (tuple): multiringual.g2p.g2p() の戻り値
+        assist_text (Optional[str], optional): 補助テキスト (デフォルト: None)
+        assist_text_weight (float, optional): 補助テキストの重み (デフォルト: 0.7)
+        output_dtype (Optional[DTypeLike], optional): 出力の dtype (デフォルト: None)
+        contiguous (bool, optional): 転置ビューではなく C-contiguous な (隠れ層の次元数, 音素数) の配列を返すかどうか (デフォルト: False)
+        sparse (bool, optional): 密な配列の代わりに SparsePhoneLevelFeature を返すかどうか (デフォルト: False)
 
     Returns:
-        NDArray[Any]: BERT の特徴量
+        Union[NDArray[Any], SparsePhoneLevelFeature]: BERT の特徴量
     """
 
-    # モデルの読み込み
-    model = llamacpp_embedding_models.load_model(
-        language=Languages.MULTI,
+    language, norm_text, _, _, word2ph, _, _, _ = g2p_result
+    return extract_bert_feature_lammacpp(
+        norm_text,
+        word2ph,
+        assist_text,
+        assist_text_weight,
+        output_dtype=output_dtype,
+        contiguous=contiguous,
+        language=language,
+        sparse=sparse,
     )
 
-    if assist_text:
-        # 入力をテンソルに変換
-        
-        embed_list = model.embed(assist_text)
-        style_res = np.array(embed_list, dtype=np.float32)
-
-    embed_list = model.embed(text)
-    res = np.array(embed_list, dtype=np.float32)
-
-    zero_array = np.zeros((1, 1024), dtype=np.float32)
-
-    language_type = language_selector(text, [Languages.JP, Languages.ZH, Languages.EN, Languages.KO])
-    
-    if language_type in ("JP", "ZH"):
-        assert len(word2ph) == len(text) + 2, text
-    
-    elif language_type == "EN":
-        tokenizer = onnx_bert_models.load_tokenizer(Languages.EN)
-        tokens = tokenizer.tokenize(text)
-        assert len(word2ph) == len(tokens) +2 , (text, tokens, len(word2ph), len(tokens))
-    
-    elif language_type == "KO":
+
+@timed("bert.extract_batch.multiringual")
+def extract_bert_feature_lammacpp_batch(
+    batch: Sequence[tuple[str, list[int], Optional[str]]],
+    assist_text_weight: float = 0.7,
+    output_dtype: Optional[DTypeLike] = None,
+    contiguous: bool = False,
+    languages: Optional[Sequence[Optional[Languages]]] = None,
+    sparse: bool = False,
+) -> list[Union[NDArray[Any], SparsePhoneLevelFeature]]:
+    """
+    複数のテキストから BERT の特徴量をまとめて抽出する (llama.cpp 推論)
+    すべてのテキストと補助テキストの埋め込みを 1 回の llama.cpp の呼び出しでまとめて計算し、テキストごとに extract_bert_feature_lammacpp() と同じ形式の特徴量を返す。
+
+    Args:
+        batch (Sequence[tuple[str, list[int], Optional[str]]]): (テキスト, word2ph, 補助テキスト) のタプルのリスト
+        assist_text_weight (float, optional): 補助テキストの重み (デフォルト: 0.7)
+        output_dtype (Optional[DTypeLike], optional): 出力の dtype (np.float16 を指定するとメモリ消費量と保存サイズが半分になる) 。指定した場合は C-contiguous な配列が返される (デフォルト: None)
+        contiguous (bool, optional): 転置ビューではなく C-contiguous な (隠れ層の次元数, 音素数) の配列を返すかどうか (デフォルト: False)
+        languages (Optional[Sequence[Optional[Languages]]], optional): batch と同じ順序の、multiringual.g2p.g2p() で判定済みの各テキストの言語のリスト。
+            指定したテキストは言語の判定と word2ph の検証のためのトークナイズを省略する (デフォルト: None)
+        sparse (bool, optional): 密な配列の代わりに SparsePhoneLevelFeature を返すかどうか (デフォルト: False)
+
+    Returns:
+        list[Union[NDArray[Any], SparsePhoneLevelFeature]]: batch と同じ順序の BERT の特徴量のリスト
+    """
+
+    # 重複するテキスト・補助テキストは embed_texts() 内で 1 回だけ計算される
+    texts = [text for text, _, _ in batch] + [assist_text for _, _, assist_text in batch if assist_text]  # fmt: skip
+    embeddings = dict(zip(texts, llamacpp_embedding_models.embed_texts(texts, Languages.MULTI)))  # fmt: skip
+
+    return [
+        __build_phone_level_feature(
+            text,
+            word2ph,
+            embeddings[text],
+            embeddings[assist_text] if assist_text else None,
+            assist_text_weight,
+            language=languages[index] if languages is not None else None,
+            output_dtype=output_dtype,
+            contiguous=contiguous,
+            sparse=sparse,
+        )
+        for index, (text, word2ph, assist_text) in enumerate(batch)
+    ]
+
+
+def __build_phone_level_feature(
+    text: str,
+    word2ph: list[int],
+    res: NDArray[np.float32],
+    style_res: Optional[NDArray[np.float32]],
+    assist_text_weight: float,
+    language: Optional[Languages] = None,
+    output_dtype: Optional[DTypeLike] = None,
+    contiguous: bool = False,
+    sparse: bool = False,
+) -> Union[NDArray[Any], SparsePhoneLevelFeature]:
+    """
+    テキストと補助テキストの埋め込みから、音素単位の BERT の特徴量を作る。
+    """
+
+    # g2p() で判定済みの言語が渡されていない場合のみ、テキストから言語を判定し、トークナイズし直して word2ph を検証する
+    ## 判定済みの言語が渡された場合、word2ph は同じ g2p() の結果から得られたものなので検証を省略する
+    if language is None or language == Languages.MULTI:
+        language = language_selector(text, [Languages.JP, Languages.ZH, Languages.EN, Languages.KO])  # fmt: skip
+        n_tokens: Optional[int] = None
+        if language in (Languages.JP, Languages.ZH):
+            n_tokens = len(text)
+        elif language == Languages.EN:
+            n_tokens = len(onnx_bert_models.load_tokenizer(Languages.EN).tokenize(text))
+        elif language == Languages.KO:
+            n_tokens = len(__get_korean_tagger().parse(text).split())
+        if n_tokens is not None:
+            assert len(word2ph) == n_tokens + 2, (text, language, len(word2ph), n_tokens)
+
+    #先頭と終端のみ埋め込みを入れ、それ以外は0を入れる
+    ## 0 のトークンを含む密な配列は作らず、密な配列が必要な場合のみ疎な表現から展開する
+    if style_res is not None:
+        edge_feature = res * (1 - assist_text_weight) + style_res * assist_text_weight
+    else:
+        edge_feature = res
+    feature = SparsePhoneLevelFeature.from_word2ph(edge_feature, word2ph)
+    if sparse:
+        return feature
+
+    return feature.to_dense(output_dtype=output_dtype, contiguous=contiguous)
+
+
+def __get_korean_tagger() -> Any:
+    """
+    韓国語のテキストのトークン数を数えるための MeCab の Tagger を返す。初回呼び出し時のみ作成する。
+    """
+
+    global __korean_tagger
+    if __korean_tagger is None:
         import mecab_ko as MeCab
-        tagger = MeCab.Tagger("-Owakati")
-        tokens = tagger.parse(text).split()
-        assert len(word2ph) == len(tokens) +2 , (text, tokens, len(word2ph), len(tokens))
-
-    phone_level_feature = []
-    for i in range(len(word2ph)):
-        #先頭と終端のみ埋め込みを入れる
-        if i in (0, len(word2ph)-1 ):
-
-            if assist_text:
-                assert style_res is not None
-                repeat_feature = (
-                    np.tile(res, (word2ph[i], 1)) * (1 - assist_text_weight)
-                    + np.tile(style_res, (word2ph[i], 1)) * assist_text_weight
-                )
-            else:
-                #先頭と終端のみ埋め込みを入れる
-                repeat_feature = np.tile(res, (word2ph[i], 1))
-
-        else:
-            #先頭と終端以外は0を入れる
-            repeat_feature = np.tile(zero_array, (word2ph[i], 1))
-
-        phone_level_feature.append(repeat_feature)
-
-    phone_level_feature = np.concatenate(phone_level_feature, axis=0)
-
-    return phone_level_feature.T
+
+        __korean_tagger = MeCab.Tagger("-Owakati")
+    return __korean_tagger
@@ -1,6 +1,8 @@
 from kabosu_plus.sbv2.nlp import language_selector
 from kabosu_plus.sbv2.constants import Languages
 from kabosu_plus import normalize_text
+from kabosu_plus.sbv2.nlp.g2p_cache import get_cached_g2p, make_g2p_cache_key, put_cached_g2p
+from kabosu_plus.sbv2.utils.metrics import get_metrics
 
 def g2p(text: str,
         raise_yomi_error: bool = False,
@@ -11,13 +13,21 @@ def g2p(text: str,
         use_jp_extra: bool = False,
         ) -> tuple[Languages, str, list[str], list[int], list[int], list[str] | None, list[str] | None, list[str] | None]:
 
-    if len(language_list) == 1:
-        language = language_list[0] 
-        if language == Languages.MULTI:
-            language = language_selector(text, [Languages.EN, Languages.JP, Languages.ZH, Languages.KO])
+    # g2p のキャッシュが有効な場合は、同じテキスト・オプションに対する結果を再利用する
+    ## 言語の判定結果もテキストと language_list だけで決まるため、判定前にキャッシュを参照する
+    cache_key = make_g2p_cache_key(Languages.MULTI, text, tuple(language_list), keihan, babytalk, dakuten, use_jp_extra, raise_yomi_error)  # fmt: skip
+    cached_result = get_cached_g2p(cache_key)
+    if cached_result is not None:
+        return cached_result  # type: ignore
 
-    else:
-        language = language_selector(text, language_list)
+    with get_metrics().stage("multiringual.language_selector"):
+        if len(language_list) == 1:
+            language = language_list[0] 
+            if language == Languages.MULTI:
+                language = language_selector(text, [Languages.EN, Languages.JP, Languages.ZH, Languages.KO])
+
+        else:
+            language = language_selector(text, language_list)
         
    
     if language == Languages.JP:
@@ -31,7 +41,6 @@ def g2p(text: str,
                                                                                                 babytalk=babytalk,
                                                                                                 dakuten=dakuten,                                                                                                
                                                                                                 )
-        return Languages.JP, norm_text, phones, tones, word2ph, sep_text, sep_kata ,sep_kata_with_joshi
 
     elif language == Languages.EN:
         from kabosu_plus.sbv2.nlp.english import g2p as g2p_en 
@@ -56,4 +65,6 @@ def g2p(text: str,
         sep_kata = None
         sep_kata_with_joshi = None
 
-    return language, norm_text, phones, tones, word2ph, sep_text, sep_kata ,sep_kata_with_joshi
\ No newline at end of file
+    result = (language, norm_text, phones, tones, word2ph, sep_text, sep_kata ,sep_kata_with_joshi)
+    put_cached_g2p(cache_key, result)
+    return result
@@ -9,14 +9,25 @@ Style-Bert-VITS2 の ONNX 推論に必要な各言語ごとの ONNX 版 BERT モ
 一度 load_model/tokenizer() で当該言語の BERT モデルがロードされていれば、ライブラリ内部のどこからでもロード済みのモデル/トークナイザーを取得できる。
 """
 
+from __future__ import annotations
+
 import gc
+import hashlib
+import json
+import os
+import threading
 import time
-from collections.abc import Sequence
+import unicodedata
+import uuid
+from collections.abc import Callable, Iterator, Sequence
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Optional, Union
+from typing import Any, Literal, Optional, Union
 
+import numpy as np
 import onnxruntime
 from huggingface_hub import hf_hub_download
+from numpy.typing import DTypeLike, NDArray
 from transformers import (
     AutoTokenizer,
     DebertaV2TokenizerFast,
@@ -26,16 +37,40 @@ from transformers import (
 
 from kabosu_plus.sbv2.constants import Languages, DEFAULT_ONNX_BERT_MODEL_PATHS
 from kabosu_plus.sbv2.logging import logger
+from kabosu_plus.sbv2.utils import get_onnx_device_options
+from kabosu_plus.sbv2.utils.metrics import get_metrics, timed
+from kabosu_plus.sbv2.utils.model_registry import get_model_registry
+
+
+# 各言語ごとのロード済みの BERT モデル (推論セッションのプール) と BERT トークナイザーは、
+# kabosu_plus.sbv2.utils.model_registry のモデルのレジストリに下記のキーで格納される
+## メモリ予算を超えた場合は最も長い間利用されていない BERT モデルからアンロードされ、次に利用される際に同じ引数で再ロードされる
+__MODEL_KEY = "onnx_bert_model"
+__TOKENIZER_KEY = "onnx_bert_tokenizer"
+
+# 各言語ごとの、ロード済みの BERT トークナイザーから構築した CharVocabTokenizer を格納する辞書
+## load_tokenizer() で char_vocab_fast_path=True が指定された言語のみ格納される
+__char_vocab_tokenizers: dict[Languages, CharVocabTokenizer] = {}
+
+# 各言語ごとのロード済みの BERT モデルの識別子 (モデルファイルのパス) を格納する辞書
+__loaded_model_ids: dict[Languages, str] = {}
+
+# load_model() の graph_optimization_level と ONNX Runtime のグラフ最適化レベルの対応
+__GRAPH_OPTIMIZATION_LEVELS = {
+    "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
 
+# (言語, ExecutionProvider のリスト) ごとに構築済みの BertSession を格納する辞書
+__bert_sessions: dict[tuple[Languages, str], BertSession] = {}
 
-# 各言語ごとのロード済みの BERT モデルを格納する辞書
-__loaded_models: dict[Languages, onnxruntime.InferenceSession] = {}
+# 初期化子のインデックスのパスごとに、外部データファイルを memmap した配列と、そこから作成した共有の初期化子を格納する辞書
+## load_model() で share_initializers=True が指定された場合のみ格納される
+__shared_initializers: dict[str, tuple[Optional[np.memmap], list[tuple[str, onnxruntime.OrtValue]]]] = {}  # fmt: skip
 
-# 各言語ごとのロード済みの BERT トークナイザーを格納する辞書
-__loaded_tokenizers: dict[
-    Languages,
-    Union[PreTrainedTokenizer, PreTrainedTokenizerFast, DebertaV2TokenizerFast],
-] = {}
+# 各言語ごとの、ロード済みの BERT モデルが利用している共有の初期化子のキー (初期化子のインデックスのパス) を格納する辞書
+__shared_initializer_keys: dict[Languages, str] = {}
 
 
 def load_model(
@@ -45,6 +80,15 @@ def load_model(
     cache_dir: Optional[str] = None,
     revision: str = "main",
     enable_cpu_mem_arena: bool | None = None,
+    graph_optimization_level: Optional[Literal["basic", "extended", "all"]] = None,
+    variant: Literal["fp16", "fp32", "int8"] = "fp16",
+    num_sessions: int = 1,
+    intra_op_num_threads: Optional[int] = None,
+    inter_op_num_threads: Optional[int] = None,
+    allow_spinning: Optional[bool] = None,
+    checkout_strategy: Literal["round_robin", "least_busy"] = "least_busy",
+    share_initializers: bool = False,
+    disable_prepacking: Optional[bool] = None,
 ) -> onnxruntime.InferenceSession:  # fmt: skip
     """
     指定された言語の ONNX 版 BERT モデルをロードし、ロード済みの ONNX 版 BERT モデルを返す。
@@ -52,6 +96,8 @@ def load_model(
     ライブラリ利用時は常に必ず pretrain_model_name_or_path (Hugging Face のリポジトリ名 or ローカルのファイルパス) を指定する必要がある。
     ロードにはそれなりに時間がかかるため、ライブラリ利用前に明示的に pretrained_model_name_or_path を指定してロードしておくべき。
     cache_dir と revision は pretrain_model_name_or_path がリポジトリ名の場合のみ有効。
+    get_model_registry().set_memory_budget() でメモリ予算が設定されている場合、予算を超えた時点で最も長い間利用されていない BERT モデルがアンロードされ、
+    次に利用される際 (または pretrained_model_name_or_path を指定せずに load_model() が呼ばれた際) に前回と同じ引数で再ロードされる。
 
     Style-Bert-VITS2 では、ONNX 版 BERT モデルに下記の 3 つが利用されている。
     これ以外の ONNX 版 BERT モデルを指定した場合は正常に動作しない可能性が高い。
@@ -64,89 +110,310 @@ def load_model(
         cache_dir (Optional[str]): モデルのキャッシュディレクトリ。指定しない場合はデフォルトのキャッシュディレクトリが利用される (デフォルト: None)
         revision (str): モデルの Hugging Face 上の Git リビジョン。指定しない場合は最新の main ブランチの内容が利用される (デフォルト: None)
         enable_cpu_mem_arena (bool | None): CPU 推論時にもメモリアリーナを有効化するかどうか。デフォルトでは GPU 推論時のみ有効化される (デフォルト: None)
+        graph_optimization_level (Optional[Literal["basic", "extended", "all"]]): 指定した場合、ONNX Runtime のグラフ最適化をこのレベルで 1 度だけ実行し、
+            最適化済みのモデルをモデルファイルと同じディレクトリに保存する。2 回目以降のロードでは保存済みのモデルを最適化なしでロードする (デフォルト: None)
+        variant (Literal["fp16", "fp32", "int8"]): ロードするモデルのバリアント。fp32 と int8 は CPU 推論向けで、初回ロード時に model_fp16.onnx から生成され、同じディレクトリにキャッシュされる。生成には kabosu-plus[cpu-variants] が必要 (デフォルト: "fp16")
+        num_sessions (int): 同時に推論できるよう、プールしておく推論セッションの数 (デフォルト: 1)
+        intra_op_num_threads (Optional[int]): 推論セッションごとの演算子内の並列スレッド数。指定しない場合は ONNX Runtime の既定値 (物理コア数) が利用される (デフォルト: None)
+        inter_op_num_threads (Optional[int]): 推論セッションごとの演算子間の並列スレッド数。指定しない場合は ONNX Runtime の既定値が利用される (デフォルト: None)
+        allow_spinning (Optional[bool]): スレッドプールのスレッドが、次の処理をスピンウェイトで待つかどうか。指定しない場合は ONNX Runtime の既定値 (有効) が利用される (デフォルト: None)
+        checkout_strategy (Literal["round_robin", "least_busy"]): 推論時にプールから推論セッションを選ぶ方法 (デフォルト: "least_busy")
+        share_initializers (bool): 重みを外部データファイルに分離したモデルを初回ロード時に生成し、外部データファイルを memmap して
+            プール内のすべての推論セッション (および同じモデルをロードする他の言語) で重みを共有するかどうか。
+            外部データファイルはページキャッシュ経由でワーカープロセス間でも共有され、fork する前にロードしておけば memmap 自体も引き継がれる。
+            外部データファイルの生成には kabosu-plus[cpu-variants] が必要。
+            CPU 推論時のみ効果があり、graph_optimization_level とは併用できない (デフォルト: False)
+        disable_prepacking (Optional[bool]): 重みの事前パッキングを無効にするかどうか。事前パッキングされた重みは推論セッションごとに複製されるため、
+            指定しない場合は share_initializers=True の時のみ無効にする (デフォルト: None)
 
     Returns:
-        onnxruntime.InferenceSession: ロード済みの BERT モデル
+        onnxruntime.InferenceSession: ロード済みの BERT モデル (num_sessions が 2 以上の場合はプールの先頭の推論セッション)
     """
 
     # すでにロード済みの場合はそのまま返す
-    if language in __loaded_models:
-        return __loaded_models[language]
+    model_registry = get_model_registry()
+    loaded_pool: Optional[OnnxSessionPool] = model_registry.get((__MODEL_KEY, language))
+    if loaded_pool is not None:
+        return loaded_pool.sessions[0]
 
-    # pretrained_model_name_or_path が指定されていない場合はデフォルトのパスを利用
+    # メモリ予算の超過によってアンロードされたモデルを引数なしで再ロードする場合は、前回のロード時の引数を引き継ぐ
     if pretrained_model_name_or_path is None:
-        assert DEFAULT_ONNX_BERT_MODEL_PATHS[language].exists(), \
-            f"The default {language.name} BERT tokenizer does not exist on the file system. Please specify the path to the pre-trained model."  # fmt: skip
-        pretrained_model_name_or_path = str(DEFAULT_ONNX_BERT_MODEL_PATHS[language])
-
-
-    # pretrained_model_name_or_path に Hugging Face のリポジトリ名が指定された場合 (aaaa/bbbb のフォーマットを想定):
-    # 指定された revision の ONNX 版 BERT モデルを cache_dir にダウンロードする (既にダウンロード済みの場合は何も行われない)
-    if len(pretrained_model_name_or_path.split("/")) == 2:
-        model_path = Path(
-            hf_hub_download(
-                repo_id=pretrained_model_name_or_path,
-                filename="model_fp16.onnx",
-                cache_dir=cache_dir,
-                revision=revision,
+        previous_load_kwargs = model_registry.get_load_kwargs((__MODEL_KEY, language))
+        if previous_load_kwargs is not None:
+            return load_model(language, **previous_load_kwargs)
+
+    # 複数のスレッドが同時に同じモデルをロードしないよう、ロードは 1 つのスレッドだけが行い、他のスレッドはその完了を待ってロード済みのモデルを利用する
+    with model_registry.load_lock((__MODEL_KEY, language)):
+        loaded_pool = model_registry.get((__MODEL_KEY, language))
+        if loaded_pool is not None:
+            return loaded_pool.sessions[0]
+
+        assert num_sessions > 0
+
+        # pretrained_model_name_or_path が指定されていない場合はデフォルトのパスを利用
+        if pretrained_model_name_or_path is None:
+            assert DEFAULT_ONNX_BERT_MODEL_PATHS[language].exists(), \
+                f"The default {language.name} BERT tokenizer does not exist on the file system. Please specify the path to the pre-trained model."  # fmt: skip
+            pretrained_model_name_or_path = str(DEFAULT_ONNX_BERT_MODEL_PATHS[language])
+
+        # アンロード後に同じ引数で再ロードできるよう、ロード時の引数を記録しておく
+        load_kwargs = {
+            "pretrained_model_name_or_path": pretrained_model_name_or_path,
+            "onnx_providers": list(onnx_providers),
+            "cache_dir": cache_dir,
+            "revision": revision,
+            "enable_cpu_mem_arena": enable_cpu_mem_arena,
+            "graph_optimization_level": graph_optimization_level,
+            "variant": variant,
+            "num_sessions": num_sessions,
+            "intra_op_num_threads": intra_op_num_threads,
+            "inter_op_num_threads": inter_op_num_threads,
+            "allow_spinning": allow_spinning,
+            "checkout_strategy": checkout_strategy,
+            "share_initializers": share_initializers,
+            "disable_prepacking": disable_prepacking,
+        }
+
+        # pretrained_model_name_or_path に Hugging Face のリポジトリ名が指定された場合 (aaaa/bbbb のフォーマットを想定):
+        # 指定された revision の ONNX 版 BERT モデルを cache_dir にダウンロードする (既にダウンロード済みの場合は何も行われない)
+        if len(pretrained_model_name_or_path.split("/")) == 2:
+            model_path = Path(
+                hf_hub_download(
+                    repo_id=pretrained_model_name_or_path,
+                    filename="model_fp16.onnx",
+                    cache_dir=cache_dir,
+                    revision=revision,
+                )
             )
+            # 英語用 BERT のみ、spm.model もダウンロードする
+            # Fast 版の BERT トークナイザーでは不要なはずだが、念のため
+            if language == Languages.EN:
+                hf_hub_download(
+                    repo_id=pretrained_model_name_or_path,
+                    filename="spm.model",
+                    cache_dir=cache_dir,
+                    revision=revision,
+                )
+        # pretrained_model_name_or_path にファイルパスが指定された場合:
+        # 既にダウンロード済みという前提のもと、モデルへのローカルパスを model_path に格納する
+        else:
+            model_path = Path(pretrained_model_name_or_path).resolve() / "model_fp16.onnx"
+
+        # fp16 以外のバリアントが指定された場合は、model_fp16.onnx から生成したモデルを利用する (生成済みの場合はそのまま利用する)
+        ## CPUExecutionProvider は fp16 の演算にほとんど対応しておらず、Cast ノードが大量に挟まるため、fp32 版や int8 版の方が高速に推論できる
+        if variant != "fp16":
+            from kabosu_plus.sbv2.nlp.onnx_bert_variants import ensure_model_variant
+
+            model_path = ensure_model_variant(model_path, variant)
+
+        original_model_path = model_path
+
+        # 重みを共有する場合は、重みを外部データファイルに分離したモデルを利用する (生成済みの場合はそのまま利用する)
+        ## 最適化済みのモデルを保存すると共有している重みがモデル内に書き出されてしまうため、graph_optimization_level は無視する
+        shared_initializers_index_path: Optional[Path] = None
+        if share_initializers:
+            from kabosu_plus.sbv2.nlp.onnx_bert_variants import ensure_external_data_model
+
+            model_path, shared_initializers_index_path = ensure_external_data_model(model_path)  # fmt: skip
+            if graph_optimization_level is not None:
+                logger.warning(f"graph_optimization_level is ignored because share_initializers is enabled for the {language.name} ONNX BERT model")  # fmt: skip
+                graph_optimization_level = None
+
+        # 推論時に一番優先される ExecutionProvider の名前を取得
+        assert len(onnx_providers) > 0
+        first_provider_name = (
+            onnx_providers[0] if type(onnx_providers[0]) is str else onnx_providers[0][0]
         )
-        # 英語用 BERT のみ、spm.model もダウンロードする
-        # Fast 版の BERT トークナイザーでは不要なはずだが、念のため
-        if language == Languages.EN:
-            hf_hub_download(
-                repo_id=pretrained_model_name_or_path,
-                filename="spm.model",
-                cache_dir=cache_dir,
-                revision=revision,
+
+        # 推論セッションの設定
+        sess_options = onnxruntime.SessionOptions()
+        ## ONNX モデルの作成時にすでに onnxsim により最適化されていることから、ロード高速化のため最適化を無効にする
+        sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL  # fmt: skip
+        ## graph_optimization_level が指定されている場合は、最適化済みのモデルを保存 or 再利用する
+        ## onnxsim による最適化では Attention や LayerNormalization の融合までは行われないため、特に CPU 推論時の高速化が見込める
+        ## 最適化済みのモデルは最適化レベルと ExecutionProvider によって内容が変わるため、それぞれ別のファイルとして保存する
+        optimized_model_tmp_path: Optional[Path] = None
+        if graph_optimization_level is not None:
+            optimized_model_path = get_optimized_model_path(model_path, graph_optimization_level, first_provider_name)  # fmt: skip
+            if optimized_model_path.exists():
+                ## 保存済みの最適化済みモデルは、最適化を無効にしたままロードする
+                model_path = optimized_model_path
+            else:
+                sess_options.graph_optimization_level = __GRAPH_OPTIMIZATION_LEVELS[graph_optimization_level]  # fmt: skip
+                ## 書き込み途中のファイルを他のプロセスが読み込まないよう、一時ファイルに保存してからリネームする
+                ## モデルのディレクトリに書き込み権限がない場合は、保存せずにその場で最適化したモデルをそのまま利用する
+                if os.access(optimized_model_path.parent, os.W_OK):
+                    optimized_model_tmp_path = optimized_model_path.with_suffix(f".{uuid.uuid4()}.tmp")  # fmt: skip
+                    sess_options.optimized_model_filepath = str(optimized_model_tmp_path)
+                else:
+                    logger.warning(f"Cannot save the optimized {language.name} ONNX BERT model to {optimized_model_path.parent}")  # fmt: skip
+        ## エラー以外のログを出力しない
+        ## 本来は log_severity_level = 3 だけで効くはずだが、なぜか CUDA 系のログが抑制できないので set_default_logger_severity() も呼び出している
+        sess_options.log_severity_level = 3
+        onnxruntime.set_default_logger_severity(3)
+
+        # CPU 推論時のみ enable_cpu_mem_arena を無効化し、BERT モデルの推論セッションより富豪的なメモリ消費を防止する
+        ## 既に RunOptions の memory.enable_memory_arena_shrinkage や、ProviderOptions の "arena_extend_strategy": "kSameAsRequested" を指定して
+        ## InferenceSession が構築するメモリアリーナを推論後に縮小するよう構成し、メモリアリーナによるメモリ消費量が漸進的に増加することを防いでいる
+        ## しかし、CPU 推論時の BERT モデルに関しては入力長や入力内容次第では依然大量のメモリが確保される傾向にあるため、CPU 推論時のみメモリアリーナ自体を無効化する
+        ## BERT 特徴量の抽出処理が 0.数秒遅くなるトレードオフがあるが、元々 CPU 推論は CUDA 推論よりかなり遅いこと、
+        ## BERT 特徴量の抽出処理自体は音声合成処理よりも遥かに軽量なこと、低メモリ環境での OOM エラー回避の観点から有益だと判断した
+        ## メモリアリーナを無効化することで、若干の速度低下と引き換えに、多量の推論処理を行ってもメモリリークのような挙動が発生しなくなる
+        ## なお CUDA 推論時は独自に VRAM 管理が行われているようで、CPU 推論時のように過剰に VRAM が消費されることはない
+        ## 明示的に enable_cpu_mem_arena が指定されている場合は、指定された値を利用する
+        if enable_cpu_mem_arena is not None:
+            sess_options.enable_cpu_mem_arena = enable_cpu_mem_arena
+        ## 明示的に enable_cpu_mem_arena が指定されていない場合は、推論セッションが CPUExecutionProvider の場合のみメモリアリーナを無効化する
+        elif first_provider_name == "CPUExecutionProvider":
+            sess_options.enable_cpu_mem_arena = False
+
+        # 推論セッションごとのスレッド数を設定する
+        ## 多コア環境で複数の推論セッションを並行して動かす場合は、推論セッションあたりのスレッド数を (コア数 / num_sessions) 程度に抑えないと
+        ## スレッドが過剰に生成されてかえって遅くなる
+        if intra_op_num_threads is not None:
+            sess_options.intra_op_num_threads = intra_op_num_threads
+        if inter_op_num_threads is not None:
+            sess_options.inter_op_num_threads = inter_op_num_threads
+        ## スピンウェイトを無効にすると、レイテンシがわずかに悪化する代わりにアイドル時の CPU 使用率が下がる
+        if allow_spinning is not None:
+            sess_options.add_session_config_entry("session.intra_op.allow_spinning", "1" if allow_spinning else "0")  # fmt: skip
+            sess_options.add_session_config_entry("session.inter_op.allow_spinning", "1" if allow_spinning else "0")  # fmt: skip
+
+        # 共有の初期化子を推論セッションの設定に追加する
+        ## 同じ SessionOptions から作成した推論セッションは、すべて同じ (memmap された) 重みを参照する
+        if shared_initializers_index_path is not None:
+            for name, ortvalue in __load_shared_initializers(shared_initializers_index_path):
+                sess_options.add_initializer(name, ortvalue)
+        ## 事前パッキングが有効だと、重みを共有していても推論セッションごとにパッキング済みの重みが確保されてしまう
+        if disable_prepacking if disable_prepacking is not None else share_initializers:
+            sess_options.add_session_config_entry("session.disable_prepacking", "1")
+
+        # BERT モデルをロードし、レジストリに格納して返す
+        start_time = time.time()
+        try:
+            first_session = onnxruntime.InferenceSession(
+                str(model_path),
+                sess_options=sess_options,
+                providers=onnx_providers,
             )
-    # pretrained_model_name_or_path にファイルパスが指定された場合:
-    # 既にダウンロード済みという前提のもと、モデルへのローカルパスを model_path に格納する
-    else:
-        model_path = Path(pretrained_model_name_or_path).resolve() / "model_fp16.onnx"
-
-    # 推論時に一番優先される ExecutionProvider の名前を取得
-    assert len(onnx_providers) > 0
-    first_provider_name = (
-        onnx_providers[0] if type(onnx_providers[0]) is str else onnx_providers[0][0]
-    )
-
-    # 推論セッションの設定
-    sess_options = onnxruntime.SessionOptions()
-    ## ONNX モデルの作成時にすでに onnxsim により最適化されていることから、ロード高速化のため最適化を無効にする
-    sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL  # fmt: skip
-    ## エラー以外のログを出力しない
-    ## 本来は log_severity_level = 3 だけで効くはずだが、なぜか CUDA 系のログが抑制できないので set_default_logger_severity() も呼び出している
-    sess_options.log_severity_level = 3
-    onnxruntime.set_default_logger_severity(3)
-
-    # CPU 推論時のみ enable_cpu_mem_arena を無効化し、BERT モデルの推論セッションより富豪的なメモリ消費を防止する
-    ## 既に RunOptions の memory.enable_memory_arena_shrinkage や、ProviderOptions の "arena_extend_strategy": "kSameAsRequested" を指定して
-    ## InferenceSession が構築するメモリアリーナを推論後に縮小するよう構成し、メモリアリーナによるメモリ消費量が漸進的に増加することを防いでいる
-    ## しかし、CPU 推論時の BERT モデルに関しては入力長や入力内容次第では依然大量のメモリが確保される傾向にあるため、CPU 推論時のみメモリアリーナ自体を無効化する
-    ## BERT 特徴量の抽出処理が 0.数秒遅くなるトレードオフがあるが、元々 CPU 推論は CUDA 推論よりかなり遅いこと、
-    ## BERT 特徴量の抽出処理自体は音声合成処理よりも遥かに軽量なこと、低メモリ環境での OOM エラー回避の観点から有益だと判断した
-    ## メモリアリーナを無効化することで、若干の速度低下と引き換えに、多量の推論処理を行ってもメモリリークのような挙動が発生しなくなる
-    ## なお CUDA 推論時は独自に VRAM 管理が行われているようで、CPU 推論時のように過剰に VRAM が消費されることはない
-    ## 明示的に enable_cpu_mem_arena が指定されている場合は、指定された値を利用する
-    if enable_cpu_mem_arena is not None:
-        sess_options.enable_cpu_mem_arena = enable_cpu_mem_arena
-    ## 明示的に enable_cpu_mem_arena が指定されていない場合は、推論セッションが CPUExecutionProvider の場合のみメモリアリーナを無効化する
-    elif first_provider_name == "CPUExecutionProvider":
-        sess_options.enable_cpu_mem_arena = False
-
-    # BERT モデルをロードし、辞書に格納して返す
-    start_time = time.time()
-    __loaded_models[language] = onnxruntime.InferenceSession(
-        model_path,
-        sess_options=sess_options,
-        providers=onnx_providers,
-    )
-    logger.info(
-        f"Loaded the {language.name} ONNX BERT model from {pretrained_model_name_or_path} ({time.time() - start_time:.2f}s)"
-    )
-
-    return __loaded_models[language]
+            if optimized_model_tmp_path is not None:
+                os.replace(optimized_model_tmp_path, optimized_model_path)
+                logger.info(f"Saved the optimized {language.name} ONNX BERT model to {optimized_model_path}")  # fmt: skip
+                ## 2 つ目以降の推論セッションは、保存した最適化済みのモデルを最適化なしでロードする
+                model_path = optimized_model_path
+                sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL  # fmt: skip
+                sess_options.optimized_model_filepath = ""
+        finally:
+            ## 推論セッションの作成に失敗した場合に、書き込み途中の一時ファイルがモデルのディレクトリに残らないようにする
+            ## (リネームに成功した場合は既に存在しないため何もしない)
+            if optimized_model_tmp_path is not None:
+                optimized_model_tmp_path.unlink(missing_ok=True)
+        ## 2 つ目以降の推論セッションを作成してプールに格納する
+        sessions = [first_session]
+        for _ in range(num_sessions - 1):
+            sessions.append(
+                onnxruntime.InferenceSession(
+                    str(model_path),
+                    sess_options=sess_options,
+                    providers=onnx_providers,
+                )
+            )
+        ## モデルの識別子には、最適化の有無に関わらず元のモデルファイル (バリアントごとに異なる) のパスを用いる
+        __loaded_model_ids[language] = str(original_model_path)
+        if shared_initializers_index_path is not None:
+            __shared_initializer_keys[language] = str(shared_initializers_index_path)
+        model_registry.put(
+            (__MODEL_KEY, language),
+            OnnxSessionPool(sessions, checkout_strategy),
+            footprint=__estimate_model_footprint(model_path, num_sessions, shared_initializers_index_path),  # fmt: skip
+            load_kwargs=load_kwargs,
+            on_remove=__on_model_removed,
+        )
+        logger.info(
+            f"Loaded the {language.name} ONNX BERT model from {pretrained_model_name_or_path} ({time.time() - start_time:.2f}s)"
+        )
+
+        return first_session
+
+
+def __estimate_model_footprint(
+    model_path: Path,
+    num_sessions: int,
+    shared_initializers_index_path: Optional[Path],
+) -> int:
+    """
+    ロードした BERT モデルのおおよそのメモリ使用量 (バイト) を、モデルファイルのサイズから見積もる。
+    重みを共有している場合、外部データファイルは推論セッションの数に関わらず 1 回だけ計上する。
+    """
+
+    footprint = os.path.getsize(model_path) * num_sessions
+    if shared_initializers_index_path is not None:
+        shared_initializers = __shared_initializers[str(shared_initializers_index_path)][0]
+        footprint += shared_initializers.nbytes if shared_initializers is not None else 0
+    return footprint
+
+
+def __on_model_removed(key: tuple[str, Languages], pool: OnnxSessionPool) -> None:
+    """
+    BERT モデルがアンロードされた (レジストリから削除された) 際に、関連するキャッシュを破棄する。
+    """
+
+    language = key[1]
+    __loaded_model_ids.pop(language, None)
+    __discard_bert_sessions(language)
+    ## 共有の初期化子は、それを利用するモデルがすべてアンロードされた時点で解放する
+    shared_initializer_key = __shared_initializer_keys.pop(language, None)
+    if shared_initializer_key is not None and shared_initializer_key not in __shared_initializer_keys.values():  # fmt: skip
+        __shared_initializers.pop(shared_initializer_key, None)
+    gc.collect()
+    logger.info(f"Unloaded the {language.name} ONNX BERT model")
+
+
+def get_optimized_model_path(
+    model_path: Path,
+    graph_optimization_level: Literal["basic", "extended", "all"],
+    provider_name: str,
+) -> Path:
+    """
+    load_model() で保存される最適化済みのモデルのパスを返す。
+    例: model_fp16.onnx -> model_fp16.optimized-all-CPUExecutionProvider.onnx
+
+    Args:
+        model_path (Path): 元のモデルファイルのパス
+        graph_optimization_level (Literal["basic", "extended", "all"]): グラフ最適化レベル
+        provider_name (str): 推論時に一番優先される ExecutionProvider の名前
+
+    Returns:
+        Path: 最適化済みのモデルのパス
+    """
+
+    return model_path.with_name(f"{model_path.stem}.optimized-{graph_optimization_level}-{provider_name}.onnx")  # fmt: skip
+
+
+def __load_shared_initializers(index_path: Path) -> list[tuple[str, onnxruntime.OrtValue]]:
+    """
+    ensure_external_data_model() で生成された外部データファイルを memmap し、各初期化子を OrtValue として返す。
+    プロセス内では外部データファイルごとに 1 度だけ memmap され、以降は同じ OrtValue が再利用される。
+    """
+
+    key = str(index_path)
+    if key not in __shared_initializers:
+        index = json.loads(index_path.read_text(encoding="utf-8"))
+        ## ONNX Runtime は重みを書き換えないため、読み取り専用でマップする
+        ## 空のファイルは memmap できないため、分離された初期化子がない場合はマップしない
+        data = np.memmap(index_path.with_name(index["data"]), dtype=np.uint8, mode="r") if len(index["initializers"]) > 0 else None  # fmt: skip
+        initializers: list[tuple[str, onnxruntime.OrtValue]] = []
+        for initializer in index["initializers"]:
+            assert data is not None
+            dtype = np.dtype(initializer["dtype"])
+            shape = tuple(initializer["shape"])
+            count = int(np.prod(shape, dtype=np.int64))
+            array = np.frombuffer(data, dtype=dtype, count=count, offset=initializer["offset"]).reshape(shape)  # fmt: skip
+            initializers.append((initializer["name"], onnxruntime.OrtValue.ortvalue_from_numpy(array)))  # fmt: skip
+        ## OrtValue は memmap した配列のメモリを直接参照するため、推論セッションが破棄されるまで memmap を保持しておく
+        __shared_initializers[key] = (data, initializers)
+
+    return __shared_initializers[key][1]
 
 
 def load_tokenizer(
@@ -154,6 +421,7 @@ def load_tokenizer(
     pretrained_model_name_or_path: Optional[str] = None,
     cache_dir: Optional[str] = None,
     revision: str = "main",
+    char_vocab_fast_path: bool = False,
 ) -> Union[PreTrainedTokenizer, PreTrainedTokenizerFast, DebertaV2TokenizerFast]:
     """
     指定された言語の ONNX 版 BERT トークナイザーをロードし、ロード済みの ONNX 版 BERT トークナイザーを返す。
@@ -171,43 +439,163 @@ def load_tokenizer(
         pretrained_model_name_or_path (Optional[str]): ロードする学習済みモデルの名前またはパス。指定しない場合はデフォルトのパスが利用される (デフォルト: None)
         cache_dir (Optional[str]): モデルのキャッシュディレクトリ。指定しない場合はデフォルトのキャッシュディレクトリが利用される (デフォルト: None)
         revision (str): モデルの Hugging Face 上の Git リビジョン。指定しない場合は最新の main ブランチの内容が利用される (デフォルト: None)
+        char_vocab_fast_path (bool): 1 文字 = 1 トークンの日本語 BERT 向けに、transformers を介さず語彙表を直接引いてトークナイズする
+            CharVocabTokenizer を併せて構築し、BERT 特徴量の抽出時に利用するかどうか (日本語のみ有効) (デフォルト: False)
 
     Returns:
         Union[PreTrainedTokenizer, PreTrainedTokenizerFast, DebertaV2TokenizerFast]: ロード済みの BERT トークナイザー
     """
 
     # すでにロード済みの場合はそのまま返す
-    if language in __loaded_tokenizers:
-        return __loaded_tokenizers[language]
+    model_registry = get_model_registry()
+    loaded_tokenizer = model_registry.get((__TOKENIZER_KEY, language))
+    if loaded_tokenizer is not None:
+        return loaded_tokenizer
 
-    
-    # pretrained_model_name_or_path が指定されていない場合はデフォルトのパスを利用
-    if pretrained_model_name_or_path is None:
-        assert DEFAULT_ONNX_BERT_MODEL_PATHS[language].exists(), \
-            f"The default {language.name} BERT tokenizer does not exist on the file system. Please specify the path to the pre-trained model."  # fmt: skip
-        pretrained_model_name_or_path = str(DEFAULT_ONNX_BERT_MODEL_PATHS[language])
-
-
-    # BERT トークナイザーをロードし、辞書に格納して返す
-    ## 英語のみ DebertaV2TokenizerFast でロードする必要がある
-    if language == Languages.EN:
-        __loaded_tokenizers[language] = DebertaV2TokenizerFast.from_pretrained(
-            pretrained_model_name_or_path,
-            cache_dir=cache_dir,
-            revision=revision,
+
+    # 複数のスレッドが同時に同じトークナイザーをロードしないよう、ロードは 1 つのスレッドだけが行い、他のスレッドはその完了を待つ
+    with model_registry.load_lock((__TOKENIZER_KEY, language)):
+        loaded_tokenizer = model_registry.get((__TOKENIZER_KEY, language))
+        if loaded_tokenizer is not None:
+            return loaded_tokenizer
+
+        # pretrained_model_name_or_path が指定されていない場合はデフォルトのパスを利用
+        if pretrained_model_name_or_path is None:
+            assert DEFAULT_ONNX_BERT_MODEL_PATHS[language].exists(), \
+                f"The default {language.name} BERT tokenizer does not exist on the file system. Please specify the path to the pre-trained model."  # fmt: skip
+            pretrained_model_name_or_path = str(DEFAULT_ONNX_BERT_MODEL_PATHS[language])
+
+
+        # BERT トークナイザーをロードし、レジストリに格納して返す
+        ## 英語のみ DebertaV2TokenizerFast でロードする必要がある
+        tokenizer: Union[PreTrainedTokenizer, PreTrainedTokenizerFast, DebertaV2TokenizerFast]
+        if language == Languages.EN:
+            tokenizer = DebertaV2TokenizerFast.from_pretrained(
+                pretrained_model_name_or_path,
+                cache_dir=cache_dir,
+                revision=revision,
+            )
+        else:
+            tokenizer = AutoTokenizer.from_pretrained(
+                pretrained_model_name_or_path,
+                cache_dir=cache_dir,
+                revision=revision,
+                use_fast=True,  # デフォルトで True だが念のため明示的に指定
+            )
+        logger.info(
+            f"Loaded the {language.name} ONNX BERT tokenizer from {pretrained_model_name_or_path}"
+        )
+
+        # 1 文字 = 1 トークンの日本語 BERT の場合のみ、語彙表を直接引くトークナイザーを構築する
+        if char_vocab_fast_path:
+            assert language == Languages.JP, "char_vocab_fast_path is only supported for the character-level JP BERT tokenizer"  # fmt: skip
+            __char_vocab_tokenizers[language] = CharVocabTokenizer(tokenizer)
+
+        ## トークナイザーのメモリ使用量は BERT モデルと比べて無視できるため、メモリ予算の超過時にもアンロードされないよう 0 として登録する
+        model_registry.put(
+            (__TOKENIZER_KEY, language),
+            tokenizer,
+            footprint=0,
+            load_kwargs={
+                "pretrained_model_name_or_path": pretrained_model_name_or_path,
+                "cache_dir": cache_dir,
+                "revision": revision,
+                "char_vocab_fast_path": char_vocab_fast_path,
+            },
+            on_remove=__on_tokenizer_removed,
         )
-    else:
-        __loaded_tokenizers[language] = AutoTokenizer.from_pretrained(
-            pretrained_model_name_or_path,
-            cache_dir=cache_dir,
-            revision=revision,
-            use_fast=True,  # デフォルトで True だが念のため明示的に指定
+
+        return tokenizer
+
+
+def __on_tokenizer_removed(key: tuple[str, Languages], tokenizer: Any) -> None:
+    """
+    BERT トークナイザーがアンロードされた (レジストリから削除された) 際に、関連するキャッシュを破棄する。
+    """
+
+    language = key[1]
+    __char_vocab_tokenizers.pop(language, None)
+    __discard_bert_sessions(language)
+    gc.collect()
+    logger.info(f"Unloaded the {language.name} ONNX BERT tokenizer")
+
+
+def get_session_pool(language: Languages) -> OnnxSessionPool:
+    """
+    指定された言語のロード済みの ONNX 版 BERT モデルの推論セッションのプールを返す。
+    メモリ予算の超過によってアンロードされている場合は、前回と同じ引数で再ロードする。
+
+    Args:
+        language (Languages): BERT モデルの言語
+
+    Returns:
+        OnnxSessionPool: 推論セッションのプール
+    """
+
+    model_registry = get_model_registry()
+    pool: Optional[OnnxSessionPool] = model_registry.get((__MODEL_KEY, language))
+    if pool is None:
+        load_model(language=language)
+        pool = model_registry.get((__MODEL_KEY, language))
+        assert pool is not None
+    return pool
+
+
+def get_model_id(language: Languages) -> str:
+    """
+    指定された言語のロード済みの ONNX 版 BERT モデルの識別子を返す。
+    識別子にはモデルファイルのパスが使われるため、Hugging Face からダウンロードしたモデルの場合はリビジョンごとに異なる値になる。
+    モデルの出力をキャッシュする際のキーとして利用する。
+
+    Args:
+        language (Languages): BERT モデルの言語
+
+    Returns:
+        str: モデルの識別子
+    """
+
+    ## メモリ予算の超過によってアンロードされている場合は再ロードする
+    if language not in __loaded_model_ids and get_model_registry().get_load_kwargs((__MODEL_KEY, language)) is not None:  # fmt: skip
+        get_session_pool(language)
+    assert language in __loaded_model_ids, f"The {language.name} ONNX BERT model is not loaded."  # fmt: skip
+    return __loaded_model_ids[language]
+
+
+def get_bert_session(
+    language: Languages,
+    onnx_providers: Sequence[Union[str, tuple[str, dict[str, Any]]]],
+) -> BertSession:
+    """
+    指定された言語のロード済みの ONNX 版 BERT モデル・トークナイザーをまとめた BertSession を返す。
+    BertSession は (言語, ExecutionProvider のリスト) ごとに 1 度だけ構築され、モデルかトークナイザーがアンロードされるまで再利用される。
+
+    Args:
+        language (Languages): BERT モデルの言語
+        onnx_providers (list[str]): ONNX 推論で利用する ExecutionProvider (CPUExecutionProvider, CUDAExecutionProvider など)
+
+    Returns:
+        BertSession: 推論の準備が完了した BertSession
+    """
+
+    # 推論セッションのプールを取得して BERT モデルの最終利用順を更新する (アンロードされている場合は再ロードされる)
+    pool = get_session_pool(language)
+    key = (language, repr(list(onnx_providers)))
+    if key not in __bert_sessions or __bert_sessions[key].pool is not pool:
+        __bert_sessions[key] = BertSession(
+            pool,
+            __char_vocab_tokenizers.get(language) or load_tokenizer(language),
+            onnx_providers,
         )
-    logger.info(
-        f"Loaded the {language.name} ONNX BERT tokenizer from {pretrained_model_name_or_path}"
-    )
+    return __bert_sessions[key]
 
-    return __loaded_tokenizers[language]
+
+def __discard_bert_sessions(language: Languages) -> None:
+    """
+    指定された言語の構築済みの BertSession を破棄する。
+    """
+
+    for key in [key for key in __bert_sessions if key[0] == language]:
+        del __bert_sessions[key]
 
 
 def is_model_loaded(language: Languages) -> bool:
@@ -215,7 +603,7 @@ def is_model_loaded(language: Languages) -> bool:
     指定された言語の ONNX 版 BERT モデルがロード済みかどうかを返す。
     """
 
-    return language in __loaded_models
+    return (__MODEL_KEY, language) in get_model_registry()
 
 
 def is_tokenizer_loaded(language: Languages) -> bool:
@@ -223,7 +611,7 @@ def is_tokenizer_loaded(language: Languages) -> bool:
     指定された言語の ONNX 版 BERT トークナイザーがロード済みかどうかを返す。
     """
 
-    return language in __loaded_tokenizers
+    return (__TOKENIZER_KEY, language) in get_model_registry()
 
 
 def unload_model(language: Languages) -> None:
@@ -234,10 +622,8 @@ def unload_model(language: Languages) -> None:
         language (Languages): アンロードする BERT モデルの言語
     """
 
-    if language in __loaded_models:
-        del __loaded_models[language]
-        gc.collect()
-        logger.info(f"Unloaded the {language.name} ONNX BERT model")
+    ## 関連するキャッシュの破棄は __on_model_removed() で行われる
+    get_model_registry().remove((__MODEL_KEY, language))
 
 
 def unload_tokenizer(language: Languages) -> None:
@@ -248,10 +634,8 @@ def unload_tokenizer(language: Languages) -> None:
         language (Languages): アンロードする BERT トークナイザーの言語
     """
 
-    if language in __loaded_tokenizers:
-        del __loaded_tokenizers[language]
-        gc.collect()
-        logger.info(f"Unloaded the {language.name} ONNX BERT tokenizer")
+    ## 関連するキャッシュの破棄は __on_tokenizer_removed() で行われる
+    get_model_registry().remove((__TOKENIZER_KEY, language))
 
 
 def unload_all_models() -> None:
@@ -259,8 +643,9 @@ def unload_all_models() -> None:
     すべての ONNX 版 BERT モデルをアンロードする。
     """
 
-    for language in list(__loaded_models.keys()):
-        unload_model(language)
+    for kind, language in get_model_registry().keys():
+        if kind == __MODEL_KEY:
+            unload_model(language)
     logger.info("Unloaded all ONNX BERT models")
 
 
@@ -269,6 +654,508 @@ def unload_all_tokenizers() -> None:
     すべての ONNX 版 BERT トークナイザーをアンロードする。
     """
 
-    for language in list(__loaded_tokenizers.keys()):
-        unload_tokenizer(language)
+    for kind, language in get_model_registry().keys():
+        if kind == __TOKENIZER_KEY:
+            unload_tokenizer(language)
     logger.info("Unloaded all ONNX BERT tokenizers")
+
+
+class OnnxSessionPool:
+    """
+    同じモデルをロードした複数の推論セッションをまとめ、推論のたびに 1 つを貸し出すプール。
+    複数のスレッドから同時に推論する場合に、1 つの推論セッションを奪い合わずに済むようにする。
+    """
+
+    def __init__(
+        self,
+        sessions: Sequence[onnxruntime.InferenceSession],
+        checkout_strategy: Literal["round_robin", "least_busy"] = "least_busy",
+    ) -> None:
+        """
+        Args:
+            sessions (Sequence[onnxruntime.InferenceSession]): 同じモデルをロードした推論セッションのリスト
+            checkout_strategy (Literal["round_robin", "least_busy"]): 推論セッションを選ぶ方法。
+                round_robin は順番に、least_busy は実行中の推論が最も少ない推論セッションを選ぶ (デフォルト: "least_busy")
+        """
+
+        assert len(sessions) > 0
+        assert checkout_strategy in ("round_robin", "least_busy")
+        self.sessions = list(sessions)
+        self.checkout_strategy = checkout_strategy
+        self.__lock = threading.Lock()
+        self.__next_index = 0
+        self.__in_flight = [0] * len(self.sessions)
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    @contextmanager
+    def checkout(self, index: Optional[int] = None) -> Iterator[tuple[int, onnxruntime.InferenceSession]]:  # fmt: skip
+        """
+        推論セッションを 1 つ貸し出す。with 文を抜けると返却される。
+
+        Args:
+            index (Optional[int], optional): 貸し出す推論セッションのインデックス。指定しない場合は checkout_strategy に従って選ぶ (デフォルト: None)
+
+        Yields:
+            tuple[int, onnxruntime.InferenceSession]: プール内のインデックスと推論セッション
+        """
+
+        with self.__lock:
+            ## ウォームアップなどで、特定の推論セッションを指定して推論する場合
+            if index is not None:
+                assert 0 <= index < len(self.sessions)
+            elif self.checkout_strategy == "round_robin":
+                index = self.__next_index
+                self.__next_index = (self.__next_index + 1) % len(self.sessions)
+            else:
+                index = min(range(len(self.sessions)), key=self.__in_flight.__getitem__)
+            self.__in_flight[index] += 1
+        try:
+            yield index, self.sessions[index]
+        finally:
+            with self.__lock:
+                self.__in_flight[index] -= 1
+
+
+class CharVocabTokenizer:
+    """
+    1 文字 = 1 トークンの BERT (deberta-v2-large-japanese-char-wwm など) 向けに、transformers を介さずに
+    文字 → トークン ID の対応表を直接引いてトークナイズする高速なトークナイザー。
+
+    対応表は構築時に 1 度だけ、元の BERT トークナイザーで語彙中の 1 文字のトークンをまとめてトークナイズして作成する。
+    前後の文字によってトークナイズ結果が変わりうる文字 (空白・制御文字・結合文字・半角の濁点など) や、
+    対応表にない文字を含むテキストは、安全のため元の BERT トークナイザーでトークナイズする。
+    構築時に語彙全体で元の BERT トークナイザーと結果が一致することを確認し、一致しない場合は常に元の BERT トークナイザーを利用する。
+    """
+
+    # 対応表の検証時に、1 回の呼び出しで元の BERT トークナイザーに渡す文字数
+    VERIFY_CHUNK_SIZE = 256
+
+    def __init__(
+        self,
+        tokenizer: Union[PreTrainedTokenizer, PreTrainedTokenizerFast, DebertaV2TokenizerFast],
+    ) -> None:  # fmt: skip
+        """
+        Args:
+            tokenizer (Union[PreTrainedTokenizer, PreTrainedTokenizerFast, DebertaV2TokenizerFast]): 元の BERT トークナイザー
+        """
+
+        self.tokenizer = tokenizer
+        self.pad_token_id: int = tokenizer.pad_token_id or 0  # type: ignore
+        self.model_input_names: list[str] = list(tokenizer.model_input_names)
+
+        # 語彙中の 1 文字のトークン (特殊トークンを除く) を元の BERT トークナイザーでトークナイズし、1 トークンになる文字だけを対応表に登録する
+        special_tokens = set(tokenizer.all_special_tokens)
+        candidates = sorted(
+            token
+            for token in tokenizer.get_vocab()
+            if len(token) == 1 and token not in special_tokens and self.__is_context_free_char(token)  # fmt: skip
+        )
+        self.__char_to_id: dict[str, int] = {}
+        if len(candidates) > 0:
+            for char, input_ids in zip(candidates, tokenizer(candidates, add_special_tokens=False)["input_ids"]):  # type: ignore # fmt: skip
+                if len(input_ids) == 1:
+                    self.__char_to_id[char] = input_ids[0]
+
+        # 特殊トークン ([CLS] や [SEP] など) の付加のされ方を、空文字列のトークナイズ結果から取得する
+        ## 1 文字のテキストのトークナイズ結果と矛盾する場合は、特殊トークンの付加のされ方が文字数に依存するため、常に元の BERT トークナイザーを利用する
+        self.enabled = len(self.__char_to_id) > 0
+        self.__prefix_ids: list[int] = []
+        self.__suffix_ids: list[int] = []
+        if self.enabled:
+            special_ids: list[int] = list(tokenizer("")["input_ids"])  # type: ignore
+            probe_char, probe_id = next(iter(self.__char_to_id.items()))
+            probe_ids: list[int] = list(tokenizer(probe_char)["input_ids"])  # type: ignore
+            if probe_id in probe_ids:
+                position = probe_ids.index(probe_id)
+                self.__prefix_ids = probe_ids[:position]
+                self.__suffix_ids = probe_ids[position + 1 :]
+            if probe_id not in probe_ids or self.__prefix_ids + self.__suffix_ids != special_ids:  # fmt: skip
+                logger.warning("Cannot determine how the BERT tokenizer adds special tokens. CharVocabTokenizer falls back to the original tokenizer.")  # fmt: skip
+                self.enabled = False
+
+        # 対応表の文字を連結したテキストで、元の BERT トークナイザーと結果が一致することを確認する
+        ## 1 文字ずつのトークナイズ結果が前後の文字に影響される場合 (WordPiece の ## 付きトークンなど) は、ここで検出される
+        chars = list(self.__char_to_id) if self.enabled else []
+        for start in range(0, len(chars), self.VERIFY_CHUNK_SIZE):
+            text = "".join(chars[start : start + self.VERIFY_CHUNK_SIZE])
+            if self.encode(text) != tokenizer(text)["input_ids"]:
+                logger.warning("The BERT tokenizer is not character-level. CharVocabTokenizer falls back to the original tokenizer.")  # fmt: skip
+                self.enabled = False
+                break
+
+    @staticmethod
+    def __is_context_free_char(char: str) -> bool:
+        """
+        前後の文字に関係なく、常に同じようにトークナイズされると見なせる文字かどうかを返す。
+        """
+
+        category = unicodedata.category(char)
+        # 空白・制御文字・書式文字・結合文字は、正規化や前処理で前後の文字と結合・除去されうる
+        if category[0] in ("Z", "C", "M") or unicodedata.combining(char) != 0:
+            return False
+        # 半角カタカナの濁点・半濁点や濁点・半濁点単体、ハングルの字母は、NFKC 正規化で直前・直後の文字と合成されうる
+        if char in "\uff9e\uff9f\u309b\u309c" or "\u1100" <= char <= "\u11ff" or "\ua960" <= char <= "\ua97f" or "\ud7b0" <= char <= "\ud7ff":  # fmt: skip
+            return False
+        return True
+
+    def encode(self, text: str) -> Optional[list[int]]:
+        """
+        テキストを対応表だけでトークン ID 列に変換する。対応表にない文字を含む場合は None を返す。
+        """
+
+        char_to_id = self.__char_to_id
+        try:
+            return self.__prefix_ids + [char_to_id[char] for char in text] + self.__suffix_ids  # fmt: skip
+        except KeyError:
+            return None
+
+    def __call__(
+        self,
+        text: Union[str, Sequence[str]],
+        return_tensors: Optional[str] = None,
+    ) -> dict[str, Any]:
+        """
+        テキストをトークナイズし、元の BERT トークナイザーと同じ形式の input_ids・attention_mask (・token_type_ids) を返す。
+        return_tensors="np" の場合は numpy 配列 (複数のテキストの場合はパディング済みの 2 次元配列) を、それ以外の場合はリストを返す。
+
+        Args:
+            text (Union[str, Sequence[str]]): 1 つのテキスト、またはテキストのリスト
+            return_tensors (Optional[str], optional): "np" を指定すると numpy 配列を返す (デフォルト: None)
+
+        Returns:
+            dict[str, Any]: input_ids・attention_mask などを含む辞書
+        """
+
+        is_batched = not isinstance(text, str)
+        texts: Sequence[str] = text if is_batched else [text]  # type: ignore
+
+        input_ids_list: list[list[int]] = []
+        for single_text in texts:
+            input_ids = self.encode(single_text) if self.enabled else None
+            ## 対応表だけで変換できた割合を、キャッシュのヒット率として記録する
+            get_metrics().record_cache_access("bert.char_vocab_tokenizer", input_ids is not None)  # fmt: skip
+            if input_ids is None:
+                ## 対応表だけでは変換できないテキストは、元の BERT トークナイザーでトークナイズする
+                input_ids = self.tokenizer(single_text)["input_ids"]  # type: ignore
+            input_ids_list.append(input_ids)  # type: ignore
+
+        if return_tensors == "np":
+            max_length = max((len(input_ids) for input_ids in input_ids_list), default=0)  # fmt: skip
+            input_ids_array = np.full((len(input_ids_list), max_length), self.pad_token_id, dtype=np.int64)  # fmt: skip
+            attention_mask = np.zeros((len(input_ids_list), max_length), dtype=np.int64)
+            for row, input_ids in enumerate(input_ids_list):
+                input_ids_array[row, : len(input_ids)] = input_ids
+                attention_mask[row, : len(input_ids)] = 1
+            outputs: dict[str, Any] = {"input_ids": input_ids_array, "attention_mask": attention_mask}  # fmt: skip
+            if "token_type_ids" in self.model_input_names:
+                outputs["token_type_ids"] = np.zeros_like(input_ids_array)
+            return outputs
+
+        attention_masks = [[1] * len(input_ids) for input_ids in input_ids_list]
+        outputs = {"input_ids": input_ids_list, "attention_mask": attention_masks}
+        if "token_type_ids" in self.model_input_names:
+            outputs["token_type_ids"] = [[0] * len(input_ids) for input_ids in input_ids_list]  # fmt: skip
+        if not is_batched:
+            outputs = {key: value[0] for key, value in outputs.items()}
+        return outputs
+
+
+class BertSession:
+    """
+    ONNX 版 BERT モデルの推論セッションと、推論のたびに必要になる準備処理の結果をまとめて保持するクラス。
+    入出力名・入力テンソルの転送先デバイス・実行オプション・トークナイザーを構築時に 1 度だけ取得しておき、
+    run() では入力テンソルを渡して推論するだけで済むようにする。
+    推論セッションのプールを渡した場合、run() のたびにプールから推論セッションを借りて推論する。
+    get_bert_session() から取得して利用することを想定している。
+    """
+
+    def __init__(
+        self,
+        session: Union[onnxruntime.InferenceSession, OnnxSessionPool],
+        tokenizer: Union[PreTrainedTokenizer, PreTrainedTokenizerFast, DebertaV2TokenizerFast, CharVocabTokenizer],
+        onnx_providers: Sequence[Union[str, tuple[str, dict[str, Any]]]],
+    ) -> None:  # fmt: skip
+        """
+        Args:
+            session (Union[onnxruntime.InferenceSession, OnnxSessionPool]): ONNX 版 BERT モデルの推論セッション、またはそのプール
+            tokenizer (Union[PreTrainedTokenizer, PreTrainedTokenizerFast, DebertaV2TokenizerFast, CharVocabTokenizer]): BERT トークナイザー
+            onnx_providers (list[str]): ONNX 推論で利用する ExecutionProvider (CPUExecutionProvider, CUDAExecutionProvider など)
+        """
+
+        if isinstance(session, OnnxSessionPool):
+            self.pool = session
+        else:
+            self.pool = OnnxSessionPool([session])
+        ## プール内の推論セッションはすべて同じモデルをロードしているため、入出力の情報は先頭の推論セッションから取得する
+        self.session = self.pool.sessions[0]
+        self.tokenizer = tokenizer
+        self.pad_token_id: int = tokenizer.pad_token_id or 0  # type: ignore
+        self.input_names = [input.name for input in self.session.get_inputs()]
+        self.output_name = self.session.get_outputs()[0].name
+        ## 中国語 BERT のみ、input_ids と attention_mask の間に token_type_ids を入力に取る
+        self.use_token_type_ids = len(self.input_names) == 3
+        ## 出力が (batch, 系列長, 隠れ層の次元数) の 3 次元であれば、バッチ推論に対応したモデルとみなす
+        ## Style-Bert-VITS2 の ONNX 版 BERT モデルはバッチ次元を落とした (系列長, 隠れ層の次元数) の出力を返す
+        self.is_batched_output = len(self.session.get_outputs()[0].shape) == 3
+
+        # 入力テンソルの転送に使用するデバイス種別, デバイス ID, 実行オプションを取得
+        self.device_type, self.device_id, self.run_options = get_onnx_device_options(self.session, onnx_providers)  # fmt: skip
+
+        # IOBinding はスレッドごと・推論セッションごとに 1 つ作成し、推論ごとにバインドし直して使い回す
+        self.__thread_local = threading.local()
+
+    @timed("bert.onnx_run")
+    def run(
+        self,
+        input_ids: NDArray[Any],
+        attention_mask: Optional[NDArray[Any]] = None,
+        token_type_ids: Optional[NDArray[Any]] = None,
+        session_index: Optional[int] = None,
+    ) -> NDArray[Any]:
+        """
+        トークン ID 列から BERT 特徴量を抽出する。
+
+        Args:
+            input_ids (NDArray[Any]): (batch, 系列長) のトークン ID 列
+            attention_mask (Optional[NDArray[Any]], optional): (batch, 系列長) の attention_mask。指定しない場合はすべて 1 とみなす (デフォルト: None)
+            token_type_ids (Optional[NDArray[Any]], optional): (batch, 系列長) の token_type_ids。中国語 BERT 以外では無視される (デフォルト: None)
+            session_index (Optional[int], optional): 推論に利用するプール内の推論セッションのインデックス。指定しない場合はプールの checkout_strategy に従う (デフォルト: None)
+
+        Returns:
+            NDArray[Any]: モデルの出力 (バッチ次元を持たないモデルの場合は (系列長, 隠れ層の次元数) になる)
+        """
+
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        get_metrics().increment("bert.onnx_run.tokens", input_ids.size)
+        if attention_mask is None:
+            attention_mask = np.ones_like(input_ids)
+        input_tensor = [input_ids, np.asarray(attention_mask, dtype=np.int64)]
+        if self.use_token_type_ids:
+            if token_type_ids is None:
+                token_type_ids = np.zeros_like(input_ids)
+            input_tensor.insert(1, np.asarray(token_type_ids, dtype=np.int64))
+
+        with self.pool.checkout(session_index) as (index, session):
+            # CPU 推論時はデバイス間の転送が発生しないため、IOBinding を介さずにそのまま推論する
+            if self.device_type == "cpu":
+                return session.run(
+                    [self.output_name],
+                    dict(zip(self.input_names, input_tensor)),
+                    run_options=self.run_options,
+                )[0]
+
+            # 推論デバイスに入力テンソルを割り当て
+            ## GPU 推論の場合、device_type + device_id に対応する GPU デバイスに入力テンソルが割り当てられる
+            io_bindings: dict[int, onnxruntime.IOBinding] = self.__thread_local.__dict__.setdefault("io_bindings", {})  # fmt: skip
+            io_binding = io_bindings.get(index)
+            if io_binding is None:
+                io_binding = session.io_binding()
+                io_bindings[index] = io_binding
+            else:
+                io_binding.clear_binding_inputs()
+                io_binding.clear_binding_outputs()
+            for name, value in zip(self.input_names, input_tensor):
+                gpu_tensor = onnxruntime.OrtValue.ortvalue_from_numpy(
+                    value, self.device_type, self.device_id
+                )
+                io_binding.bind_ortvalue_input(name, gpu_tensor)
+            io_binding.bind_output(self.output_name, self.device_type)
+            session.run_with_iobinding(io_binding, run_options=self.run_options)
+            return io_binding.get_outputs()[0].numpy()
+
+
+class BertFeatureStore:
+    """
+    BERT 特徴量をディスクに永続化するための、内容アドレス方式の特徴量ストア。
+    学習データの前処理などで同じ正規化済みテキストの BERT 特徴量を何度も計算し直すことを防ぐ。
+
+    特徴量は (正規化済みテキスト, word2ph, 言語, モデルの識別子, 補助テキスト, 補助テキストの重み, 出力の dtype) のハッシュ値をキーとして
+    root_dir/(キーの先頭 2 文字)/(キー).npy に保存され、root_dir/index.jsonl に 1 キーにつき 1 行のインデックスが追記される。
+    読み出し時は np.load(mmap_mode="r") でメモリマップするため、すべての特徴量を RAM に載せることなく再利用できる。
+    """
+
+    INDEX_FILENAME = "index.jsonl"
+
+    def __init__(self, root_dir: Union[str, Path]) -> None:
+        """
+        Args:
+            root_dir (Union[str, Path]): 特徴量を保存するディレクトリ (存在しない場合は作成される)
+        """
+
+        self.root_dir = Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.root_dir / self.INDEX_FILENAME
+        self.__lock = threading.Lock()
+
+        # 既存のインデックスを読み込む
+        self.__keys: set[str] = set()
+        if self.index_path.is_file():
+            with self.index_path.open(encoding="utf-8") as f:
+                for line in f:
+                    # 書き込み途中で中断された行は無視する
+                    try:
+                        self.__keys.add(json.loads(line)["key"])
+                    except (json.JSONDecodeError, KeyError):
+                        continue
+
+    @staticmethod
+    def make_key(
+        norm_text: str,
+        word2ph: Sequence[int],
+        language: Languages,
+        model_id: str,
+        assist_text: Optional[str] = None,
+        assist_text_weight: float = 0.7,
+        output_dtype: Optional[DTypeLike] = None,
+    ) -> str:
+        """
+        特徴量のキー (SHA-256 のハッシュ値) を生成する。
+        補助テキストを指定しない場合、assist_text_weight はキーに影響しない。
+        output_dtype を指定しない場合のキーは、output_dtype をキーに含める前に保存された特徴量のキーと同じになる。
+
+        Args:
+            norm_text (str): 正規化済みテキスト
+            word2ph (Sequence[int]): 元のテキストの各文字に音素が何個割り当てられるかを表すリスト
+            language (Languages): テキストの言語
+            model_id (str): BERT モデルの識別子 (get_model_id() の戻り値)
+            assist_text (Optional[str], optional): 補助テキスト (デフォルト: None)
+            assist_text_weight (float, optional): 補助テキストの重み (デフォルト: 0.7)
+            output_dtype (Optional[DTypeLike], optional): 保存する特徴量の dtype。同じ入力でも dtype が異なる特徴量は別のキーになる (デフォルト: None)
+
+        Returns:
+            str: 特徴量のキー
+        """
+
+        payload = [
+            norm_text,
+            [int(i) for i in word2ph],
+            str(language),
+            model_id,
+            assist_text or None,
+            float(assist_text_weight) if assist_text else None,
+        ]
+        if output_dtype is not None:
+            payload.append(np.dtype(output_dtype).str)
+        serialized = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def get_path(self, key: str) -> Path:
+        """
+        キーに対応する .npy ファイルのパスを返す。
+        """
+
+        return self.root_dir / key[:2] / f"{key}.npy"
+
+    def get(self, key: str) -> Optional[NDArray[Any]]:
+        """
+        キーに対応する特徴量を読み取り専用のメモリマップとして返す。存在しない場合は None を返す。
+        """
+
+        path = self.get_path(key)
+        # インデックスの有無ではなくファイルの有無で判定する
+        ## 他のプロセスが書き込んだ特徴量はインデックスになくても読み込み、
+        ## インデックスにあっても .npy ファイルが削除されている場合 (キャッシュの整理・部分的なコピーなど) は再計算させる
+        if not path.is_file():
+            return None
+        try:
+            return np.load(path, mmap_mode="r")
+        except FileNotFoundError:
+            ## 判定から読み込みまでの間に削除された場合
+            return None
+
+    def put(
+        self,
+        key: str,
+        feature: NDArray[Any],
+        metadata: Optional[dict[str, Any]] = None,
+    ) -> None:
+        """
+        特徴量を保存し、インデックスにまだないキーであれば追記する。
+        一時ファイルに書き込んでからリネームするため、書き込み途中の特徴量が読み込まれることはない。
+
+        Args:
+            key (str): 特徴量のキー
+            feature (NDArray[Any]): 保存する特徴量
+            metadata (Optional[dict[str, Any]], optional): インデックスに記録する付加情報 (デフォルト: None)
+        """
+
+        path = self.get_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{uuid.uuid4()}.tmp")
+        try:
+            with tmp_path.open("wb") as f:
+                np.save(f, np.ascontiguousarray(feature))
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+        entry = {
+            "key": key,
+            "shape": list(feature.shape),
+            "dtype": str(feature.dtype),
+            **(metadata or {}),
+        }
+        with self.__lock:
+            ## .npy ファイルが削除されて再計算された特徴量は、インデックスに重複して追記しない
+            if key in self.__keys:
+                return
+            with self.index_path.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.__keys.add(key)
+
+    def get_or_compute(
+        self,
+        norm_text: str,
+        word2ph: Sequence[int],
+        language: Languages,
+        compute: Callable[[], NDArray[Any]],
+        assist_text: Optional[str] = None,
+        assist_text_weight: float = 0.7,
+        model_id: Optional[str] = None,
+        output_dtype: Optional[DTypeLike] = None,
+    ) -> NDArray[Any]:
+        """
+        特徴量がストアにあればメモリマップして返し、なければ compute() で計算して保存してから返す。
+
+        Args:
+            norm_text (str): 正規化済みテキスト
+            word2ph (Sequence[int]): 元のテキストの各文字に音素が何個割り当てられるかを表すリスト
+            language (Languages): テキストの言語
+            compute (Callable[[], NDArray[Any]]): ストアにない場合に特徴量を計算する関数
+            assist_text (Optional[str], optional): 補助テキスト (デフォルト: None)
+            assist_text_weight (float, optional): 補助テキストの重み (デフォルト: 0.7)
+            model_id (Optional[str], optional): BERT モデルの識別子。指定しない場合はロード済みのモデルの識別子が利用される (デフォルト: None)
+            output_dtype (Optional[DTypeLike], optional): 保存・返却する特徴量の dtype。指定した場合、compute() の結果はこの dtype に変換して保存される (デフォルト: None)
+
+        Returns:
+            NDArray[Any]: BERT の特徴量
+        """
+
+        if model_id is None:
+            model_id = get_model_id(language)
+        key = self.make_key(norm_text, word2ph, language, model_id, assist_text, assist_text_weight, output_dtype)  # fmt: skip
+
+        feature = self.get(key)
+        if feature is not None:
+            return feature
+
+        feature = compute()
+        ## キーに含めた dtype と保存される特徴量の dtype を一致させる
+        if output_dtype is not None:
+            feature = feature.astype(output_dtype, copy=False)
+        self.put(
+            key,
+            feature,
+            metadata={"language": str(language), "model_id": model_id, "text": norm_text},
+        )
+        return feature
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and self.get_path(key).is_file()
+
+    def __len__(self) -> int:
+        ## get() や __contains__ と同様に、インデックスではなく .npy ファイルの有無で数える
+        return sum(1 for _ in self.root_dir.glob("??/*.npy"))
@@ -0,0 +1,279 @@
+"""
+ONNX 版 BERT モデル (model_fp16.onnx) から、CPU 推論向けの fp32 版・int8 版のモデルを生成するためのモジュール。
+
+Style-Bert-VITS2 の ONNX 版 BERT モデルは fp16 で配布されているが、CPUExecutionProvider は fp16 の演算にほとんど対応していないため、
+推論時に大量の Cast ノードが挟まり、fp32 版や int8 版よりも遅くなる。
+このモジュールで生成したモデルは元のモデルと同じディレクトリに保存され、onnx_bert_models.load_model() の variant 引数から利用できる。
+また、複数の推論セッション・ワーカープロセスで重みを共有するための、初期化子を外部データファイルに分離したモデルもこのモジュールで生成する。
+モデルの変換には onnx パッケージが必要 (推論時には不要) で、pip install kabosu-plus[cpu-variants] でインストールできる。
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Literal
+
+import numpy as np
+
+from kabosu_plus.sbv2.logging import logger
+
+
+if TYPE_CHECKING:
+    import onnx
+
+
+# 各バリアントのモデルファイル名
+MODEL_VARIANT_FILENAMES: dict[str, str] = {
+    "fp16": "model_fp16.onnx",
+    "fp32": "model_fp32.onnx",
+    "int8": "model_int8.onnx",
+}
+
+# ensure_external_data_model() で外部データファイルに分離する初期化子の最小サイズ (バイト)
+__EXTERNAL_DATA_SIZE_THRESHOLD = 1024
+
+# ensure_external_data_model() で外部データファイルに書き込む各初期化子の先頭のアラインメント (バイト)
+__EXTERNAL_DATA_ALIGNMENT = 64
+
+# ensure_external_data_model() で外部データファイルに分離できる初期化子の dtype
+__EXTERNAL_DATA_DTYPES = {np.dtype(dtype) for dtype in ("float16", "float32", "float64", "int8", "uint8", "int32", "int64")}  # fmt: skip
+
+
+def get_model_variant_path(
+    fp16_model_path: Path,
+    variant: Literal["fp16", "fp32", "int8"],
+) -> Path:
+    """
+    fp16 版のモデルのパスから、指定されたバリアントのモデルのパスを返す。
+
+    Args:
+        fp16_model_path (Path): fp16 版のモデル (model_fp16.onnx) のパス
+        variant (Literal["fp16", "fp32", "int8"]): モデルのバリアント
+
+    Returns:
+        Path: 指定されたバリアントのモデルのパス
+    """
+
+    return fp16_model_path.with_name(MODEL_VARIANT_FILENAMES[variant])
+
+
+def ensure_model_variant(
+    fp16_model_path: Path,
+    variant: Literal["fp16", "fp32", "int8"],
+) -> Path:
+    """
+    指定されたバリアントのモデルが存在しなければ fp16 版のモデルから生成し、そのパスを返す。
+    int8 版は fp32 版を動的量子化して生成するため、fp32 版も併せて生成される。
+
+    Args:
+        fp16_model_path (Path): fp16 版のモデル (model_fp16.onnx) のパス
+        variant (Literal["fp16", "fp32", "int8"]): モデルのバリアント
+
+    Returns:
+        Path: 指定されたバリアントのモデルのパス
+    """
+
+    variant_path = get_model_variant_path(fp16_model_path, variant)
+    if variant == "fp16" or variant_path.exists():
+        return variant_path
+
+    if variant == "fp32":
+        convert_fp16_to_fp32(fp16_model_path, variant_path)
+    elif variant == "int8":
+        fp32_model_path = ensure_model_variant(fp16_model_path, "fp32")
+        quantize_to_int8(fp32_model_path, variant_path)
+    else:
+        raise ValueError(f"Unknown model variant: {variant}")
+
+    return variant_path
+
+
+def convert_fp16_to_fp32(input_path: Path, output_path: Path) -> None:
+    """
+    fp16 の ONNX モデルを fp32 に変換して保存する。
+    初期化子・Constant ノード・Cast ノードの変換先・入出力と中間テンソルの型をすべて fp32 に置き換える。
+
+    Args:
+        input_path (Path): fp16 のモデルのパス
+        output_path (Path): 変換後のモデルの保存先
+    """
+
+    __require_onnx()
+    import onnx
+
+    model = onnx.load(str(input_path))
+    __convert_graph_to_fp32(model.graph)
+    __save_atomically(model, output_path)
+    logger.info(f"Converted {input_path.name} to fp32: {output_path}")
+
+
+def quantize_to_int8(input_path: Path, output_path: Path) -> None:
+    """
+    fp32 の ONNX モデルの重みを int8 に動的量子化して保存する。
+
+    Args:
+        input_path (Path): fp32 のモデルのパス
+        output_path (Path): 量子化後のモデルの保存先
+    """
+
+    ## onnxruntime.quantization も内部で onnx パッケージを利用する
+    __require_onnx()
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    tmp_path = output_path.with_suffix(f".{uuid.uuid4()}.tmp")
+    try:
+        quantize_dynamic(input_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, output_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    logger.info(f"Quantized {input_path.name} to int8: {output_path}")
+
+
+def get_external_data_model_paths(model_path: Path) -> tuple[Path, Path, Path]:
+    """
+    ensure_external_data_model() で生成されるモデル・外部データファイル・初期化子のインデックスのパスを返す。
+    例: model_fp32.onnx -> model_fp32.external.onnx / model_fp32.external.data / model_fp32.external.json
+
+    Args:
+        model_path (Path): 元のモデルファイルのパス
+
+    Returns:
+        tuple[Path, Path, Path]: (モデル, 外部データファイル, 初期化子のインデックス) のパス
+    """
+
+    return (
+        model_path.with_name(f"{model_path.stem}.external.onnx"),
+        model_path.with_name(f"{model_path.stem}.external.data"),
+        model_path.with_name(f"{model_path.stem}.external.json"),
+    )
+
+
+def ensure_external_data_model(model_path: Path) -> tuple[Path, Path]:
+    """
+    大きな初期化子 (重み) を 1 つの外部データファイルに分離したモデルが存在しなければ生成し、モデルと初期化子のインデックスのパスを返す。
+    インデックスには外部データファイル内の各初期化子のオフセット・dtype・形状が記録されており、
+    推論時は onnx パッケージなしで外部データファイルを numpy.memmap でマップし、初期化子として共有できる。
+
+    Args:
+        model_path (Path): 元のモデルファイルのパス
+
+    Returns:
+        tuple[Path, Path]: (外部データ版のモデル, 初期化子のインデックス) のパス
+    """
+
+    external_model_path, data_path, index_path = get_external_data_model_paths(model_path)  # fmt: skip
+    ## インデックスは最後に保存されるため、インデックスが存在すればモデルと外部データファイルも揃っている
+    if index_path.exists():
+        return external_model_path, index_path
+
+    __require_onnx()
+    import onnx
+    from onnx import external_data_helper, numpy_helper
+
+    model = onnx.load(str(model_path))
+    initializers: list[dict[str, Any]] = []
+    tmp_data_path = data_path.with_suffix(f".{uuid.uuid4()}.tmp")
+    try:
+        with open(tmp_data_path, "wb") as f:
+            for tensor in model.graph.initializer:
+                array = numpy_helper.to_array(tensor)
+                ## 形状テンソルなどの小さな初期化子や、numpy で扱えない型の初期化子はモデル内に残す
+                if array.nbytes < __EXTERNAL_DATA_SIZE_THRESHOLD or array.dtype not in __EXTERNAL_DATA_DTYPES:  # fmt: skip
+                    continue
+                ## memmap した配列をそのまま ONNX Runtime に渡せるよう、各初期化子の先頭をアラインメントしておく
+                offset = -(-f.tell() // __EXTERNAL_DATA_ALIGNMENT) * __EXTERNAL_DATA_ALIGNMENT  # fmt: skip
+                f.seek(offset)
+                f.write(np.ascontiguousarray(array).astype(array.dtype.newbyteorder("<"), copy=False).tobytes())  # fmt: skip
+                initializers.append({
+                    "name": tensor.name,
+                    "offset": offset,
+                    "dtype": array.dtype.newbyteorder("<").str,
+                    "shape": list(array.shape),
+                })  # fmt: skip
+                ## 外部データファイルを直接参照するモデルとしても単体でロードできるよう、外部データの所在を記録する
+                tensor.CopyFrom(numpy_helper.from_array(array, tensor.name))
+                external_data_helper.set_external_data(tensor, data_path.name, offset, array.nbytes)  # fmt: skip
+                tensor.ClearField("raw_data")
+        os.replace(tmp_data_path, data_path)
+    finally:
+        tmp_data_path.unlink(missing_ok=True)
+
+    __save_atomically(model, external_model_path)
+    tmp_index_path = index_path.with_suffix(f".{uuid.uuid4()}.tmp")
+    try:
+        tmp_index_path.write_text(json.dumps({"data": data_path.name, "initializers": initializers}), encoding="utf-8")  # fmt: skip
+        os.replace(tmp_index_path, index_path)
+    finally:
+        tmp_index_path.unlink(missing_ok=True)
+    logger.info(f"Moved {len(initializers)} initializers of {model_path.name} to external data: {data_path}")  # fmt: skip
+
+    return external_model_path, index_path
+
+
+def __require_onnx() -> None:
+    """
+    モデルの変換に必要な onnx パッケージがインストールされているかを確認し、ない場合はインストール方法を含む ImportError を送出する。
+    """
+
+    try:
+        import onnx  # noqa: F401
+    except ImportError as ex:
+        raise ImportError(
+            "The onnx package is required to generate fp32 / int8 / shared-initializer ONNX BERT models. "
+            "Install it with `pip install kabosu-plus[cpu-variants]`."
+        ) from ex
+
+
+def __convert_graph_to_fp32(graph: onnx.GraphProto) -> None:
+    """
+    グラフ (サブグラフを含む) 内の fp16 のテンソルをすべて fp32 に置き換える。
+    """
+
+    import onnx
+    from onnx import TensorProto, numpy_helper
+
+    def convert_tensor(tensor: onnx.TensorProto) -> None:
+        if tensor.data_type == TensorProto.FLOAT16:
+            array = numpy_helper.to_array(tensor).astype(np.float32)
+            tensor.CopyFrom(numpy_helper.from_array(array, tensor.name))
+
+    for initializer in graph.initializer:
+        convert_tensor(initializer)
+
+    for value_info in [*graph.input, *graph.output, *graph.value_info]:
+        tensor_type = value_info.type.tensor_type
+        if tensor_type.elem_type == TensorProto.FLOAT16:
+            tensor_type.elem_type = TensorProto.FLOAT
+
+    for node in graph.node:
+        for attribute in node.attribute:
+            ## Cast ノードの変換先が fp16 の場合は fp32 に変更する
+            if node.op_type == "Cast" and attribute.name == "to" and attribute.i == TensorProto.FLOAT16:  # fmt: skip
+                attribute.i = TensorProto.FLOAT
+            ## Constant / ConstantOfShape ノードなどが持つテンソル
+            elif attribute.type == onnx.AttributeProto.TENSOR:
+                convert_tensor(attribute.t)
+            ## If / Loop ノードなどのサブグラフ
+            elif attribute.type == onnx.AttributeProto.GRAPH:
+                __convert_graph_to_fp32(attribute.g)
+            elif attribute.type == onnx.AttributeProto.GRAPHS:
+                for subgraph in attribute.graphs:
+                    __convert_graph_to_fp32(subgraph)
+
+
+def __save_atomically(model: onnx.ModelProto, output_path: Path) -> None:
+    """
+    書き込み途中のファイルが読み込まれないよう、一時ファイルに保存してからリネームする。
+    """
+
+    import onnx
+
+    tmp_path = output_path.with_suffix(f".{uuid.uuid4()}.tmp")
+    try:
+        onnx.save(model, str(tmp_path))
+        os.replace(tmp_path, output_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
@@ -0,0 +1,109 @@
+import threading
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Generic, Optional, TypeVar
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    スレッドセーフな容量制限付きの LRU キャッシュ。
+    容量を超えた場合は、最も長い間参照されていないエントリから破棄される。
+    ヒット数・ミス数を記録しており、stats() でキャッシュの効き具合を確認できる。
+    """
+
+    def __init__(self, maxsize: int = 128) -> None:
+        """
+        Args:
+            maxsize (int): キャッシュに保持する最大エントリ数 (0 の場合はキャッシュしない)
+        """
+
+        assert maxsize >= 0
+        self.__maxsize = maxsize
+        self.__entries: OrderedDict[K, V] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+    @property
+    def maxsize(self) -> int:
+        return self.__maxsize
+
+    @property
+    def hits(self) -> int:
+        return self.__hits
+
+    @property
+    def misses(self) -> int:
+        return self.__misses
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        """
+        キーに対応する値を返す。存在しない場合は default を返す。
+        """
+
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+                self.__hits += 1
+                return self.__entries[key]
+            self.__misses += 1
+            return default
+
+    def put(self, key: K, value: V) -> None:
+        """
+        キーに対応する値を格納する。容量を超えた場合は最も古いエントリを破棄する。
+        """
+
+        with self.__lock:
+            if self.__maxsize == 0:
+                return
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__maxsize:
+                self.__entries.popitem(last=False)
+
+    def resize(self, maxsize: int) -> None:
+        """
+        キャッシュの最大エントリ数を変更する。縮小した場合は古いエントリから破棄される。
+        """
+
+        assert maxsize >= 0
+        with self.__lock:
+            self.__maxsize = maxsize
+            while len(self.__entries) > self.__maxsize:
+                self.__entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        すべてのエントリを破棄し、ヒット数・ミス数をリセットする。
+        """
+
+        with self.__lock:
+            self.__entries.clear()
+            self.__hits = 0
+            self.__misses = 0
+
+    def stats(self) -> dict[str, int]:
+        """
+        キャッシュの統計情報 (ヒット数・ミス数・現在のエントリ数・最大エントリ数) を返す。
+        """
+
+        with self.__lock:
+            return {
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "size": len(self.__entries),
+                "maxsize": self.__maxsize,
+            }
+
+    def __contains__(self, key: object) -> bool:
+        with self.__lock:
+            return key in self.__entries
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__entries)
@@ -0,0 +1,278 @@
+import functools
+import threading
+import time
+from collections.abc import Callable
+from typing import Any, TypeVar
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class _NullStage:
+    """
+    計測が無効な場合に Metrics.stage() が返す、何もしないコンテキストマネージャー。
+    """
+
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *args: Any) -> None:
+        return None
+
+
+class _StageTimer:
+    """
+    with 文の中の処理にかかった時間を計測し、Metrics に記録するコンテキストマネージャー。
+    """
+
+    __slots__ = ("metrics", "name", "start_time")
+
+    def __init__(self, metrics: "Metrics", name: str) -> None:
+        self.metrics = metrics
+        self.name = name
+        self.start_time = 0.0
+
+    def __enter__(self) -> None:
+        self.start_time = time.perf_counter()
+
+    def __exit__(self, *args: Any) -> None:
+        self.metrics.observe(self.name, time.perf_counter() - self.start_time)
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Metrics:
+    """
+    正規化・g2p・BERT 特徴量の抽出などの各処理段階 (ステージ) の所要時間・呼び出し回数、カウンター、キャッシュのヒット率を記録するスレッドセーフなレジストリ。
+    既定では無効になっており、無効な間は stage() が何もしないコンテキストマネージャーを返すだけなので、計測のオーバーヘッドはほぼ生じない。
+    記録した値は snapshot() で辞書として、to_prometheus() で Prometheus のテキスト形式として取得できる。
+    """
+
+    def __init__(self, enabled: bool = False) -> None:
+        """
+        Args:
+            enabled (bool): 計測を有効にするかどうか (デフォルト: False)
+        """
+
+        self.enabled = enabled
+        self.__lock = threading.Lock()
+        ## ステージ名 -> [呼び出し回数, 合計時間, 最大時間]
+        self.__stages: dict[str, list[float]] = {}
+        self.__counters: dict[str, float] = {}
+        ## キャッシュ名 -> [ヒット数, ミス数]
+        self.__cache_accesses: dict[str, list[int]] = {}
+        ## キャッシュ名 -> ヒット数・ミス数を返す関数 (LRUCache.stats など)
+        self.__cache_stats_getters: dict[str, Callable[[], dict[str, Any]]] = {}
+
+    def enable(self) -> None:
+        """
+        計測を有効にする。
+        """
+
+        self.enabled = True
+
+    def disable(self) -> None:
+        """
+        計測を無効にする。記録済みの値は保持される。
+        """
+
+        self.enabled = False
+
+    def stage(self, name: str) -> Any:
+        """
+        with 文の中の処理の所要時間を、指定された名前のステージとして記録するコンテキストマネージャーを返す。
+
+        使用例:
+            with get_metrics().stage("japanese.g2p.run_frontend"):
+                njd_features = run_frontend(norm_text)
+
+        Args:
+            name (str): ステージ名
+
+        Returns:
+            Any: コンテキストマネージャー (計測が無効な場合は何もしない)
+        """
+
+        if not self.enabled:
+            return _NULL_STAGE
+        return _StageTimer(self, name)
+
+    def observe(self, name: str, seconds: float) -> None:
+        """
+        指定された名前のステージの所要時間を 1 回分記録する。
+        """
+
+        with self.__lock:
+            stage = self.__stages.get(name)
+            if stage is None:
+                self.__stages[name] = [1, seconds, seconds]
+            else:
+                stage[0] += 1
+                stage[1] += seconds
+                stage[2] = max(stage[2], seconds)
+
+    def increment(self, name: str, value: float = 1) -> None:
+        """
+        指定された名前のカウンターを増やす。計測が無効な場合は何もしない。
+        """
+
+        if not self.enabled:
+            return
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def record_cache_access(self, name: str, hit: bool) -> None:
+        """
+        指定された名前のキャッシュへのアクセスを 1 回分記録する。計測が無効な場合は何もしない。
+        """
+
+        if not self.enabled:
+            return
+        with self.__lock:
+            accesses = self.__cache_accesses.setdefault(name, [0, 0])
+            accesses[0 if hit else 1] += 1
+
+    def register_cache(self, name: str, stats_getter: Callable[[], dict[str, Any]]) -> None:  # fmt: skip
+        """
+        ヒット数・ミス数を自前で数えているキャッシュを登録する。
+        登録したキャッシュの値は snapshot() の時点で stats_getter から読み出されるため、計測の有効・無効に関わらず記録のオーバーヘッドは生じない。
+
+        Args:
+            name (str): キャッシュ名
+            stats_getter (Callable[[], dict[str, Any]]): "hits" と "misses" を含む辞書を返す関数 (LRUCache.stats など)
+        """
+
+        with self.__lock:
+            self.__cache_stats_getters[name] = stats_getter
+
+    def snapshot(self) -> dict[str, Any]:
+        """
+        記録した値を JSON に変換可能な辞書として返す。
+
+        Returns:
+            dict[str, Any]: stages (ステージごとの呼び出し回数・合計時間・平均時間・最大時間) 、counters 、caches (キャッシュごとのヒット数・ミス数・ヒット率) を含む辞書
+        """
+
+        with self.__lock:
+            stages = {
+                name: {
+                    "count": int(count),
+                    "total_seconds": total,
+                    "mean_seconds": total / count,
+                    "max_seconds": maximum,
+                }
+                for name, (count, total, maximum) in self.__stages.items()
+            }
+            counters = dict(self.__counters)
+            cache_accesses = {name: tuple(accesses) for name, accesses in self.__cache_accesses.items()}  # fmt: skip
+            cache_stats_getters = dict(self.__cache_stats_getters)
+
+        ## 登録されたキャッシュの統計情報は、ロックの外で読み出す
+        for name, stats_getter in cache_stats_getters.items():
+            stats = stats_getter()
+            cache_accesses[name] = (stats["hits"], stats["misses"])
+        caches = {
+            name: {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses > 0 else 0.0,
+            }
+            for name, (hits, misses) in cache_accesses.items()
+        }
+
+        return {"stages": stages, "counters": counters, "caches": caches}
+
+    def to_prometheus(self, namespace: str = "kabosu") -> str:
+        """
+        記録した値を Prometheus のテキスト形式 (text exposition format) で返す。
+
+        Args:
+            namespace (str): メトリクス名の接頭辞 (デフォルト: "kabosu")
+
+        Returns:
+            str: Prometheus のテキスト形式のメトリクス
+        """
+
+        snapshot = self.snapshot()
+        lines: list[str] = []
+
+        def add_metric(name: str, metric_type: str, help_text: str, label: str, values: dict[str, float]) -> None:  # fmt: skip
+            if len(values) == 0:
+                return
+            lines.append(f"# HELP {namespace}_{name} {help_text}")
+            lines.append(f"# TYPE {namespace}_{name} {metric_type}")
+            for label_value, value in sorted(values.items()):
+                lines.append(f'{namespace}_{name}{{{label}="{_escape_label_value(label_value)}"}} {value}')  # fmt: skip
+
+        stages = snapshot["stages"]
+        add_metric("stage_calls_total", "counter", "Number of calls of each pipeline stage.", "stage", {name: stage["count"] for name, stage in stages.items()})  # fmt: skip
+        add_metric("stage_seconds_total", "counter", "Total wall time spent in each pipeline stage.", "stage", {name: stage["total_seconds"] for name, stage in stages.items()})  # fmt: skip
+        add_metric("stage_seconds_max", "gauge", "Maximum wall time of a single call of each pipeline stage.", "stage", {name: stage["max_seconds"] for name, stage in stages.items()})  # fmt: skip
+        add_metric("events_total", "counter", "Counters recorded by the pipeline.", "name", snapshot["counters"])  # fmt: skip
+        caches = snapshot["caches"]
+        add_metric("cache_hits_total", "counter", "Number of cache hits.", "cache", {name: cache["hits"] for name, cache in caches.items()})  # fmt: skip
+        add_metric("cache_misses_total", "counter", "Number of cache misses.", "cache", {name: cache["misses"] for name, cache in caches.items()})  # fmt: skip
+        add_metric("cache_hit_ratio", "gauge", "Cache hit ratio.", "cache", {name: cache["hit_rate"] for name, cache in caches.items()})  # fmt: skip
+
+        return "\n".join(lines) + "\n" if len(lines) > 0 else ""
+
+    def reset(self) -> None:
+        """
+        記録した値をすべて破棄する。登録されたキャッシュの登録は解除されない。
+        """
+
+        with self.__lock:
+            self.__stages.clear()
+            self.__counters.clear()
+            self.__cache_accesses.clear()
+
+
+# Metrics のメソッド内から参照され、ダブルアンダースコアの名前ではマングリングされてしまうため、アンダースコア 1 つの名前にしている
+def _escape_label_value(value: str) -> str:
+    """
+    Prometheus のラベルの値をエスケープする。
+    """
+
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# ライブラリ全体で共有されるメトリクスのレジストリ
+__metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """
+    ライブラリ全体で共有されるメトリクスのレジストリを返す。
+    get_metrics().enable() で計測を有効にすると、正規化・g2p・BERT 特徴量の抽出の各ステージの所要時間などが記録される。
+
+    Returns:
+        Metrics: メトリクスのレジストリ
+    """
+
+    return __metrics
+
+
+def timed(name: str) -> Callable[[F], F]:
+    """
+    関数の所要時間を、指定された名前のステージとして記録するデコレーター。計測が無効な場合は関数をそのまま呼び出す。
+
+    Args:
+        name (str): ステージ名
+
+    Returns:
+        Callable[[F], F]: デコレーター
+    """
+
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            metrics = get_metrics()
+            if not metrics.enabled:
+                return func(*args, **kwargs)
+            with _StageTimer(metrics, name):
+                return func(*args, **kwargs)
+
+        return wrapper  # type: ignore
+
+    return decorator
@@ -0,0 +1,239 @@
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Hashable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+
+@dataclass
+class _RegistryEntry:
+    value: Any
+    footprint: int
+    load_kwargs: dict[str, Any] = field(default_factory=dict)
+    on_remove: Optional[Callable[[Hashable, Any], None]] = None
+
+
+class ModelRegistry:
+    """
+    ロード済みのモデルを、おおよそのメモリ使用量と最終利用順とともに管理するスレッドセーフなレジストリ。
+    メモリ予算が設定されている場合、予算を超えた時点で最も長い間利用されていないモデルからアンロード (レジストリから削除) する。
+    アンロードされたモデルのロード時の引数は記録されたまま残るため、次に利用される際に同じ引数で透過的に再ロードできる。
+    """
+
+    def __init__(self, memory_budget: Optional[int] = None) -> None:
+        """
+        Args:
+            memory_budget (Optional[int]): ロード済みのモデルのメモリ使用量の合計の上限 (バイト) 。None の場合は無制限 (デフォルト: None)
+        """
+
+        assert memory_budget is None or memory_budget >= 0
+        self.__memory_budget = memory_budget
+        self.__entries: OrderedDict[Hashable, _RegistryEntry] = OrderedDict()
+        ## アンロードされたモデルのロード時の引数 (明示的にアンロードされた場合は破棄される)
+        self.__evicted_load_kwargs: dict[Hashable, dict[str, Any]] = {}
+        self.__evict_callbacks: list[Callable[[Hashable, Any], None]] = []
+        ## キーごとのロード用のロック
+        self.__load_locks: dict[Hashable, threading.Lock] = {}
+        self.__lock = threading.RLock()
+        self.__evictions = 0
+        self.__reloads = 0
+
+    @property
+    def memory_budget(self) -> Optional[int]:
+        return self.__memory_budget
+
+    @property
+    def total_footprint(self) -> int:
+        with self.__lock:
+            return sum(entry.footprint for entry in self.__entries.values())
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        キーに対応するモデルを返し、最終利用順を更新する。ロードされていない場合は None を返す。
+        """
+
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            self.__entries.move_to_end(key)
+            return entry.value
+
+    @contextmanager
+    def load_lock(self, key: Hashable) -> Iterator[None]:
+        """
+        キーごとのロード用のロックを取得する。
+        同じモデルを複数のスレッドが同時にロードしないよう、ロード処理全体をこのロックで囲み、ロックの取得後に get() でロード済みかどうかを確認し直す。
+        これにより、最初のスレッドがロードしている間に届いた他のスレッドはロードの完了を待ち、ロードされたモデルをそのまま利用する。
+
+        使用例:
+            with registry.load_lock(key):
+                model = registry.get(key)
+                if model is None:
+                    model = load()
+                    registry.put(key, model, footprint)
+        """
+
+        with self.__lock:
+            lock = self.__load_locks.setdefault(key, threading.Lock())
+        with lock:
+            yield
+
+    def put(
+        self,
+        key: Hashable,
+        value: Any,
+        footprint: int,
+        load_kwargs: Optional[dict[str, Any]] = None,
+        on_remove: Optional[Callable[[Hashable, Any], None]] = None,
+    ) -> None:
+        """
+        ロードしたモデルを登録する。メモリ予算を超えた場合は、最も長い間利用されていないモデルからアンロードする。
+
+        Args:
+            key (Hashable): モデルのキー
+            value (Any): ロードしたモデル
+            footprint (int): モデルのおおよそのメモリ使用量 (バイト) 。0 のモデルはメモリ予算の超過時にもアンロードされない
+            load_kwargs (Optional[dict[str, Any]]): アンロード後に再ロードする際に利用する、ロード時の引数 (デフォルト: None)
+            on_remove (Optional[Callable[[Hashable, Any], None]]): モデルがレジストリから削除された際に (キー, モデル) を引数に呼ばれるコールバック (デフォルト: None)
+        """
+
+        assert footprint >= 0
+        with self.__lock:
+            if self.__evicted_load_kwargs.pop(key, None) is not None:
+                self.__reloads += 1
+            self.__entries[key] = _RegistryEntry(value, footprint, dict(load_kwargs or {}), on_remove)  # fmt: skip
+            self.__entries.move_to_end(key)
+            evicted = self.__collect_evictions(keep=key)
+        self.__notify_evicted(evicted)
+
+    def remove(self, key: Hashable) -> Optional[Any]:
+        """
+        モデルをレジストリから明示的に削除し、削除したモデルを返す。ロード時の引数の記録も破棄される。
+        """
+
+        with self.__lock:
+            self.__evicted_load_kwargs.pop(key, None)
+            entry = self.__entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry.on_remove is not None:
+            entry.on_remove(key, entry.value)
+        return entry.value
+
+    def get_load_kwargs(self, key: Hashable) -> Optional[dict[str, Any]]:
+        """
+        ロード済み、またはメモリ予算の超過によってアンロードされたモデルのロード時の引数を返す。記録がない場合は None を返す。
+        """
+
+        with self.__lock:
+            if key in self.__entries:
+                return dict(self.__entries[key].load_kwargs)
+            if key in self.__evicted_load_kwargs:
+                return dict(self.__evicted_load_kwargs[key])
+            return None
+
+    def set_memory_budget(self, memory_budget: Optional[int]) -> None:
+        """
+        メモリ予算 (バイト) を変更する。縮小した場合は、予算内に収まるまで最も長い間利用されていないモデルからアンロードする。
+        """
+
+        assert memory_budget is None or memory_budget >= 0
+        with self.__lock:
+            self.__memory_budget = memory_budget
+            evicted = self.__collect_evictions(keep=None)
+        self.__notify_evicted(evicted)
+
+    def add_evict_callback(self, callback: Callable[[Hashable, Any], None]) -> None:
+        """
+        メモリ予算の超過によってモデルがアンロードされた際に、(キー, モデル) を引数に呼ばれるコールバックを登録する。
+        """
+
+        with self.__lock:
+            self.__evict_callbacks.append(callback)
+
+    def keys(self) -> list[Hashable]:
+        """
+        ロード済みのモデルのキーを、最も長い間利用されていない順に返す。
+        """
+
+        with self.__lock:
+            return list(self.__entries.keys())
+
+    def stats(self) -> dict[str, Any]:
+        """
+        レジストリの統計情報 (ロード済みのモデル数・メモリ使用量の合計・メモリ予算・アンロード回数・再ロード回数) を返す。
+        """
+
+        with self.__lock:
+            return {
+                "size": len(self.__entries),
+                "total_footprint": sum(entry.footprint for entry in self.__entries.values()),
+                "memory_budget": self.__memory_budget,
+                "evictions": self.__evictions,
+                "reloads": self.__reloads,
+            }
+
+    def __contains__(self, key: object) -> bool:
+        with self.__lock:
+            return key in self.__entries
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__entries)
+
+    def __collect_evictions(self, keep: Optional[Hashable]) -> list[tuple[Hashable, _RegistryEntry]]:  # fmt: skip
+        """
+        メモリ予算に収まるまで、最も長い間利用されていないモデルからレジストリから取り除き、取り除いたエントリのリストを返す。
+        ロックを保持した状態で呼び出す必要がある。
+        """
+
+        evicted: list[tuple[Hashable, _RegistryEntry]] = []
+        if self.__memory_budget is None:
+            return evicted
+
+        total_footprint = sum(entry.footprint for entry in self.__entries.values())
+        for key in list(self.__entries.keys()):
+            if total_footprint <= self.__memory_budget:
+                break
+            ## 登録したばかりのモデルと、メモリ使用量を持たないモデル (トークナイザーなど) はアンロードしない
+            entry = self.__entries[key]
+            if key == keep or entry.footprint == 0:
+                continue
+            del self.__entries[key]
+            self.__evicted_load_kwargs[key] = entry.load_kwargs
+            self.__evictions += 1
+            total_footprint -= entry.footprint
+            evicted.append((key, entry))
+        return evicted
+
+    def __notify_evicted(self, evicted: list[tuple[Hashable, _RegistryEntry]]) -> None:
+        """
+        アンロードしたモデルの削除時のコールバックと、登録済みのアンロード時のコールバックを呼び出す。
+        コールバック内からレジストリを操作できるよう、ロックの外で呼び出す。
+        """
+
+        for key, entry in evicted:
+            if entry.on_remove is not None:
+                entry.on_remove(key, entry.value)
+            for callback in list(self.__evict_callbacks):
+                callback(key, entry.value)
+
+
+# ONNX 版 BERT モデル・llama.cpp の埋め込みモデルなど、ライブラリ全体でロード済みのモデルを管理するレジストリ
+## メモリ予算は、すべての種類のモデルの合計に対して適用される
+__model_registry = ModelRegistry()
+
+
+def get_model_registry() -> ModelRegistry:
+    """
+    ライブラリ全体で共有されるモデルのレジストリを返す。
+    get_model_registry().set_memory_budget() でメモリ予算を設定すると、ロード済みのモデルのメモリ使用量の合計が予算を超えた時点で
+    最も長い間利用されていないモデルがアンロードされ、次に利用される際に同じ引数で再ロードされる。
+
+    Returns:
+        ModelRegistry: モデルのレジストリ
+    """
+
+    return __model_registry
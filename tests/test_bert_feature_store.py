@@ -0,0 +1,73 @@
+import numpy as np
+
+from kabosu_plus.sbv2.constants import Languages
+from kabosu_plus.sbv2.nlp.onnx_bert_models import BertFeatureStore
+
+
+def test_bert_feature_store(tmp_path):
+    store = BertFeatureStore(tmp_path)
+    feature = np.arange(12, dtype=np.float32).reshape(3, 4)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return feature
+
+    args = ("こんにちは", [1, 2, 1], Languages.JP)
+    first = store.get_or_compute(*args, compute, model_id="model")
+    second = store.get_or_compute(*args, compute, model_id="model")
+    assert len(calls) == 1
+    assert np.array_equal(first, feature)
+    assert isinstance(second, np.memmap)
+    assert np.array_equal(second, feature)
+
+    # word2ph やモデルが異なれば別のキーになる
+    assert BertFeatureStore.make_key("こんにちは", [1, 2, 1], Languages.JP, "model") != BertFeatureStore.make_key("こんにちは", [2, 1, 1], Languages.JP, "model")  # fmt: skip
+    assert BertFeatureStore.make_key("こんにちは", [1, 2, 1], Languages.JP, "model") != BertFeatureStore.make_key("こんにちは", [1, 2, 1], Languages.JP, "other")  # fmt: skip
+
+    # インデックスから再構築しても同じ特徴量を参照できる
+    reopened = BertFeatureStore(tmp_path)
+    assert len(reopened) == 1
+    assert reopened.get_or_compute(*args, compute, model_id="model") is not None
+    assert len(calls) == 1
+
+
+def test_bert_feature_store_recomputes_deleted_shard(tmp_path):
+    store = BertFeatureStore(tmp_path)
+    feature = np.ones((2, 3), dtype=np.float32)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return feature
+
+    args = ("こんにちは", [1, 1], Languages.JP)
+    store.get_or_compute(*args, compute, model_id="model")
+    key = BertFeatureStore.make_key(*args, "model")
+
+    # インデックスにはあるが .npy ファイルが削除された場合は、例外ではなく再計算になる
+    store.get_path(key).unlink()
+    reopened = BertFeatureStore(tmp_path)
+    assert reopened.get(key) is None
+    assert key not in reopened
+    assert len(reopened) == 0
+    assert np.array_equal(reopened.get_or_compute(*args, compute, model_id="model"), feature)  # fmt: skip
+    assert len(calls) == 2
+    assert reopened.get_path(key).is_file()
+    assert len(reopened) == 1
+    # 再計算してもインデックスの行は重複しない
+    assert len(reopened.index_path.read_text(encoding="utf-8").splitlines()) == 1
+
+
+def test_bert_feature_store_separates_output_dtypes(tmp_path):
+    store = BertFeatureStore(tmp_path)
+    feature = np.full((2, 3), 1 / 3, dtype=np.float32)
+    args = ("こんにちは", [1, 1], Languages.JP)
+
+    float32_feature = store.get_or_compute(*args, lambda: feature, model_id="model", output_dtype=np.float32)  # fmt: skip
+    float16_feature = store.get_or_compute(*args, lambda: feature, model_id="model", output_dtype=np.float16)  # fmt: skip
+    # 同じ入力でも dtype ごとに別のエントリとして保存され、それぞれの dtype で返される
+    assert float32_feature.dtype == np.float32 and float16_feature.dtype == np.float16
+    assert store.get_or_compute(*args, lambda: feature, model_id="model", output_dtype=np.float32).dtype == np.float32  # fmt: skip
+    assert len(store) == 2
+    assert BertFeatureStore.make_key(*args, "model", output_dtype=np.float16) != BertFeatureStore.make_key(*args, "model")  # fmt: skip
@@ -0,0 +1,144 @@
+import numpy as np
+
+from kabosu_plus.sbv2.constants import Languages
+from kabosu_plus.sbv2.nlp import onnx_bert_models
+from kabosu_plus.sbv2.nlp.bert_feature_utils import (
+    SparsePhoneLevelFeature,
+    bucket_indices_by_length,
+    clear_assist_text_embedding_cache,
+    expand_word2ph_feature,
+    get_assist_text_embedding,
+    pad_token_batch,
+    run_onnx_bert_batch,
+    split_sliding_windows,
+)
+
+
+def test_bucket_indices_by_length():
+    lengths = [3, 2, 10, 2, 9]
+    batches = bucket_indices_by_length(lengths, bucket_width=4, max_batch_size=2)
+    assert batches == [[1, 3], [0], [4, 2]]
+    # すべてのインデックスがちょうど 1 回ずつ含まれる
+    assert sorted(index for batch in batches for index in batch) == list(range(len(lengths)))
+
+
+def test_pad_token_batch():
+    input_ids, attention_mask = pad_token_batch([[1, 2, 3], [4]], pad_token_id=0)
+    assert input_ids.dtype == np.int64
+    assert input_ids.tolist() == [[1, 2, 3], [4, 0, 0]]
+    assert attention_mask.tolist() == [[1, 1, 1], [1, 0, 0]]
+
+
+def __expand_with_loop(res, word2ph, style_res_mean=None, assist_text_weight=0.7):
+    # リファクタリング前の np.tile() による展開処理
+    phone_level_feature = []
+    for i in range(len(word2ph)):
+        if style_res_mean is not None:
+            repeat_feature = (
+                np.tile(res[i], (word2ph[i], 1)) * (1 - assist_text_weight)
+                + np.tile(style_res_mean, (word2ph[i], 1)) * assist_text_weight
+            )
+        else:
+            repeat_feature = np.tile(res[i], (word2ph[i], 1))
+        phone_level_feature.append(repeat_feature)
+    return np.concatenate(phone_level_feature, axis=0).T
+
+
+def test_expand_word2ph_feature():
+    rng = np.random.default_rng(0)
+    res = rng.standard_normal((6, 16)).astype(np.float32)
+    style_res_mean = rng.standard_normal(16).astype(np.float32)
+    word2ph = [1, 2, 0, 3, 1, 1]
+
+    expected = __expand_with_loop(res, word2ph)
+    assert np.array_equal(expand_word2ph_feature(res, word2ph), expected)
+
+    expected = __expand_with_loop(res, word2ph, style_res_mean, 0.7)
+    actual = expand_word2ph_feature(res, word2ph, style_res_mean, 0.7)
+    assert np.array_equal(actual, expected)
+
+    # 事前確保したバッファに直接書き込む
+    out = np.empty((16, sum(word2ph)), dtype=np.float16)
+    actual = expand_word2ph_feature(res, word2ph, style_res_mean, 0.7, out=out)
+    assert actual is out
+    assert out.flags.c_contiguous
+    assert np.array_equal(out, expected.astype(np.float16))
+
+
+def test_split_sliding_windows():
+    # 短い系列は分割しない
+    assert split_sliding_windows(10, max_length=12, window_overlap=2) == [(0, 8)]
+    spans = split_sliding_windows(22, max_length=8, window_overlap=2)
+    assert spans == [(0, 6), (4, 10), (8, 14), (12, 18), (14, 20)]
+    # すべての窓は max_length - 2 トークンで、先頭から末尾までを覆う
+    assert all(end - start == 6 for start, end in spans)
+    assert spans[0][0] == 0 and spans[-1][1] == 20
+
+
+class __TokenwiseBertSession:
+    # 各トークンの特徴量がそのトークン自身のみで決まる、位置に依存しないダミーの BertSession
+    pad_token_id = 0
+    is_batched_output = True
+
+    def run(self, input_ids, attention_mask=None):
+        return np.stack([input_ids * 1.0, input_ids * 2.0], axis=-1)
+
+
+def test_run_onnx_bert_batch_sliding_window():
+    bert_session = __TokenwiseBertSession()
+    input_ids_list = [[1, *range(10, 40), 2], [1, 5, 6, 2]]
+    expected = run_onnx_bert_batch(bert_session, input_ids_list)
+    actual = run_onnx_bert_batch(bert_session, input_ids_list, max_length=8, window_overlap=3)
+    for a, b in zip(actual, expected):
+        assert np.array_equal(a, b)
+
+
+def test_expand_word2ph_feature_contiguous_output():
+    rng = np.random.default_rng(0)
+    res = rng.standard_normal((4, 16)).astype(np.float32)
+    word2ph = [1, 3, 2, 1]
+    expected = __expand_with_loop(res, word2ph)
+
+    actual = expand_word2ph_feature(res, word2ph, contiguous=True)
+    assert actual.flags.c_contiguous and actual.dtype == np.float32
+    assert np.array_equal(actual, expected)
+
+    actual = expand_word2ph_feature(res, word2ph, output_dtype=np.float16)
+    assert actual.flags.c_contiguous and actual.dtype == np.float16
+    assert actual.shape == (16, sum(word2ph))
+    assert np.array_equal(actual, expected.astype(np.float16))
+
+
+def test_sparse_phone_level_feature_matches_dense_expansion():
+    rng = np.random.default_rng(0)
+    edge_feature = rng.standard_normal(8).astype(np.float32)
+    word2ph = [1, 2, 3, 1, 2]
+    token_feature = np.zeros((len(word2ph), 8), dtype=np.float32)
+    token_feature[0] = edge_feature
+    token_feature[-1] = edge_feature
+
+    sparse = SparsePhoneLevelFeature.from_word2ph(edge_feature, word2ph)
+    assert sparse.shape == (8, 9)
+    for kwargs in ({}, {"contiguous": True}, {"output_dtype": np.float16}):
+        expected = expand_word2ph_feature(token_feature, word2ph, **kwargs)
+        actual = sparse.to_dense(**kwargs)
+        assert actual.dtype == expected.dtype
+        assert actual.flags.c_contiguous == expected.flags.c_contiguous
+        np.testing.assert_array_equal(actual, expected)
+
+
+def test_assist_text_embedding_cache_is_keyed_by_window_settings(monkeypatch):
+    monkeypatch.setattr(onnx_bert_models, "get_model_id", lambda language: "model")
+    clear_assist_text_embedding_cache()
+    try:
+        unwindowed = get_assist_text_embedding(Languages.JP, "補助テキスト", lambda: np.zeros(4))
+        # 窓の設定が異なる場合は、キャッシュされた平均を使わずに計算し直す
+        windowed = get_assist_text_embedding(Languages.JP, "補助テキスト", lambda: np.ones(4), max_length=8, window_overlap=3)  # fmt: skip
+        assert np.all(unwindowed == 0) and np.all(windowed == 1)
+        assert np.all(get_assist_text_embedding(Languages.JP, "補助テキスト", lambda: np.full(4, 2.0), max_length=8, window_overlap=2) == 2)  # fmt: skip
+        # 同じ窓の設定ならキャッシュから返す
+        assert np.all(get_assist_text_embedding(Languages.JP, "補助テキスト", lambda: np.full(4, 3.0), max_length=8, window_overlap=3) == 1)  # fmt: skip
+        # 窓に分割しない場合、window_overlap はキーに影響しない
+        assert np.all(get_assist_text_embedding(Languages.JP, "補助テキスト", lambda: np.full(4, 3.0), window_overlap=3) == 0)  # fmt: skip
+    finally:
+        clear_assist_text_embedding_cache()
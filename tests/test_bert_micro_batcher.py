@@ -0,0 +1,82 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+from kabosu_plus.sbv2.constants import Languages
+from kabosu_plus.sbv2.nlp import bert_micro_batcher
+from kabosu_plus.sbv2.nlp.bert_micro_batcher import BertMicroBatcher
+
+
+def test_bert_micro_batcher(monkeypatch):
+    batch_sizes = []
+
+    def fake_extract_batch(batch, onnx_providers, assist_text_weight=0.7, **kwargs):
+        batch_sizes.append(len(batch))
+        if any(text == "error" for text, _, _ in batch):
+            raise ValueError("error")
+        return [np.full((2, sum(word2ph)), len(text)) for text, word2ph, _ in batch]
+
+    monkeypatch.setattr(bert_micro_batcher, "get_batch_extractor", lambda language: fake_extract_batch)  # fmt: skip
+
+    with BertMicroBatcher(Languages.EN, ["CPUExecutionProvider"], max_batch_size=4, max_wait_ms=50) as batcher:  # fmt: skip
+        results = [None] * 8
+        barrier = threading.Barrier(8)
+
+        def worker(index):
+            barrier.wait()
+            results[index] = batcher.submit("a" * (index + 1), [1, 2]).result()
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for index, result in enumerate(results):
+            assert result.shape == (2, 3) and result[0, 0] == index + 1
+        assert max(batch_sizes) > 1 and max(batch_sizes) <= 4
+
+        # 不正なリクエストだけが失敗し、同じバッチの他のリクエストは成功する
+        ok = batcher.submit("ok", [1])
+        error = batcher.submit("error", [1])
+        assert ok.result().shape == (2, 1)
+        with pytest.raises(ValueError):
+            error.result()
+
+        assert asyncio.run(batcher.extract("abc", [2])).shape == (2, 2)
+
+
+def test_bert_micro_batcher_submit_racing_close(monkeypatch):
+    def fake_extract_batch(batch, onnx_providers, assist_text_weight=0.7, **kwargs):
+        return [np.zeros((2, sum(word2ph))) for _, word2ph, _ in batch]
+
+    monkeypatch.setattr(bert_micro_batcher, "get_batch_extractor", lambda language: fake_extract_batch)  # fmt: skip
+
+    for _ in range(20):
+        batcher = BertMicroBatcher(Languages.EN, ["CPUExecutionProvider"], max_batch_size=4, max_wait_ms=0)  # fmt: skip
+        futures = []
+        barrier = threading.Barrier(5)
+
+        def worker():
+            barrier.wait()
+            for _ in range(50):
+                try:
+                    futures.append(batcher.submit("a", [1]))
+                except RuntimeError:
+                    return
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        batcher.close()
+        for thread in threads:
+            thread.join()
+
+        # close() と競合した submit() も、例外になるか結果が返るかのどちらかで、待ち続けることはない
+        for future in futures:
+            assert future.result(timeout=5).shape == (2, 1)
+        with pytest.raises(RuntimeError):
+            batcher.submit("a", [1])
@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import pytest
+
+from kabosu_plus.sbv2.constants import Languages
+from kabosu_plus.sbv2.nlp import bert_process_pool
+from kabosu_plus.sbv2.nlp.bert_process_pool import BertProcessPool, read_shared_feature, write_shared_feature
+
+
+def test_shared_feature_round_trip():
+    feature = np.arange(24, dtype=np.float32).reshape(4, 6).T
+    handle = write_shared_feature(np.ascontiguousarray(feature))
+    assert handle.shape == (6, 4)
+
+    restored = read_shared_feature(handle)
+    assert restored.dtype == np.float32
+    assert np.array_equal(restored, feature)
+
+    # 読み出し後は共有メモリが解放されている
+    with pytest.raises(FileNotFoundError):
+        read_shared_feature(handle)
+
+    # Python オブジェクトの配列は書き込めない
+    with pytest.raises(TypeError):
+        write_shared_feature(np.array([None], dtype=object))
+
+
+class _BrokenFeature:
+    def __array__(self, *args, **kwargs):
+        raise ValueError("broken feature")
+
+
+def _stub_init_worker(language, onnx_providers, pretrained_model_name_or_path, load_model_kwargs):  # fmt: skip
+    # ワーカープロセス内で、BERT モデルをロードする代わりに BERT 特徴量の抽出処理を差し替える
+    from kabosu_plus.sbv2.nlp import bert_micro_batcher
+
+    scale = load_model_kwargs["scale"]
+
+    def stub_extract_batch(batch, onnx_providers, **extract_kwargs):
+        return [
+            _BrokenFeature() if text == "error" else np.full((4, sum(word2ph)), len(text) * scale, dtype=np.float32)  # fmt: skip
+            for text, word2ph, _ in batch
+        ]
+
+    bert_micro_batcher.get_batch_extractor = lambda language: stub_extract_batch
+
+
+def _list_shared_memory() -> set[str]:
+    # multiprocessing.shared_memory の共有メモリの名前は psm_ から始まる
+    return {name for name in os.listdir("/dev/shm") if name.startswith("psm_")}
+
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="requires /dev/shm to list shared memory segments")  # fmt: skip
+def test_bert_process_pool(monkeypatch):
+    # spawn されたワーカープロセスには、このテストモジュールの関数が初期化処理として渡される
+    monkeypatch.setattr(bert_process_pool, "_init_worker", _stub_init_worker)
+    before = _list_shared_memory()
+
+    with BertProcessPool(Languages.EN, ["CPUExecutionProvider"], num_workers=2, load_model_kwargs={"scale": 2}) as pool:  # fmt: skip
+        batch = [("a" * (index + 1), [1, index + 1], None) for index in range(10)]
+        features = pool.map(batch, chunk_size=3)
+        assert len(features) == len(batch)
+        for (text, word2ph, _), feature in zip(batch, features):
+            assert feature.shape == (4, sum(word2ph))
+            assert np.all(feature == len(text) * 2)
+
+        # 途中の特徴量の書き込みに失敗した場合は、書き込み済みの共有メモリも解放してから例外になる
+        with pytest.raises(ValueError, match="broken feature"):
+            pool.submit([("a", [1], None), ("error", [1], None), ("b", [1], None)]).result()
+
+    assert _list_shared_memory() - before == set()
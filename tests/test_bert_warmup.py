@@ -0,0 +1,127 @@
+from types import SimpleNamespace
+
+import numpy as np
+import onnxruntime
+import pytest
+
+from kabosu_plus.sbv2.constants import Languages
+from kabosu_plus.sbv2.nlp import bert_warmup, onnx_bert_models
+from kabosu_plus.sbv2.nlp.onnx_bert_models import BertSession, OnnxSessionPool
+
+
+class _StubSession:
+    """
+    推論した入力の形状を記録する、onnxruntime.InferenceSession の代わりのスタブ。
+    """
+
+    def __init__(self):
+        self.shapes = []
+
+    def get_inputs(self):
+        return [SimpleNamespace(name="input_ids"), SimpleNamespace(name="attention_mask")]
+
+    def get_outputs(self):
+        return [SimpleNamespace(name="output", shape=["seq", 8])]
+
+    def get_session_options(self):
+        return onnxruntime.SessionOptions()
+
+    def get_providers(self):
+        return ["CPUExecutionProvider"]
+
+    def run(self, output_names, input_feed, run_options=None):
+        self.shapes.append(input_feed["input_ids"].shape)
+        return [np.zeros((input_feed["input_ids"].shape[1], 8), dtype=np.float32)]
+
+
+class _StubTokenizer:
+    pad_token_id = 0
+    unk_token_id = 1
+
+    def __call__(self, text):
+        return {"input_ids": [2, 3]}
+
+
+def test_warmup_runs_dummy_inferences_on_every_pooled_session(monkeypatch):
+    sessions = [_StubSession(), _StubSession(), _StubSession()]
+    bert_session = BertSession(OnnxSessionPool(sessions, checkout_strategy="least_busy"), _StubTokenizer(), ["CPUExecutionProvider"])  # type: ignore # fmt: skip
+    monkeypatch.setattr(onnx_bert_models, "load_tokenizer", lambda *args, **kwargs: None)  # fmt: skip
+    monkeypatch.setattr(onnx_bert_models, "load_model", lambda *args, **kwargs: None)  # fmt: skip
+    monkeypatch.setattr(onnx_bert_models, "get_bert_session", lambda *args: bert_session)  # fmt: skip
+
+    handle = bert_warmup.warmup([Languages.JP], ["CPUExecutionProvider"], sequence_lengths=(8, 32))  # fmt: skip
+    assert handle.wait(timeout=10)
+    # 推論セッションのプール内のすべての推論セッションで、すべての系列長が推論される
+    for session in sessions:
+        assert session.shapes == [(1, 8), (1, 32)]
+    report = handle.report()["JP"]
+    assert report["state"] == "ready"
+    assert report["load_seconds"] is not None and report["warmup_seconds"] is not None
+
+
+def test_warmup_reports_failure(monkeypatch):
+    def load_tokenizer(*args, **kwargs):
+        raise RuntimeError("model not found")
+
+    monkeypatch.setattr(onnx_bert_models, "load_tokenizer", load_tokenizer)
+    handle = bert_warmup.warmup([Languages.EN], ["CPUExecutionProvider"], background=False)  # fmt: skip
+    assert handle.is_done() and not handle.is_ready(Languages.EN)
+    assert handle.report()["EN"]["state"] == "failed"
+    assert handle.report()["EN"]["error"] == "model not found"
+
+
+class _StubLlama:
+    """
+    埋め込みの計算がロックで直列化されているかを記録する、llama_cpp.Llama の代わりのスタブ。
+    """
+
+    model_path = "stub.gguf"
+
+    def __init__(self, embed_lock):
+        self.embed_lock = embed_lock
+        self.inputs = []
+
+    def embed(self, input):
+        self.inputs.append((input, self.embed_lock.locked()))
+        return [[0.0, 1.0] for _ in input]
+
+
+def test_warmup_embeds_through_locked_embed_texts(monkeypatch):
+    pytest.importorskip("llama_cpp")
+    from kabosu_plus.sbv2.nlp import llamacpp_embedding_models
+
+    model = _StubLlama(llamacpp_embedding_models.__embed_lock)
+    monkeypatch.setattr(llamacpp_embedding_models, "load_model", lambda *args, **kwargs: model)  # fmt: skip
+    cache_size = llamacpp_embedding_models.__embedding_cache.stats()["size"]
+
+    handle = bert_warmup.warmup([Languages.MULTI], ["CPUExecutionProvider"], sequence_lengths=(8, 32), background=False)  # fmt: skip
+    assert handle.is_ready(Languages.MULTI)
+    # リクエストの処理と同じロックを保持した状態で推論され、ダミーのテキストはキャッシュされない
+    assert model.inputs == [(["あ" * 8], True), (["あ" * 32], True)]
+    assert llamacpp_embedding_models.__embedding_cache.stats()["size"] == cache_size
+
+
+def test_warmup_passes_llamacpp_load_model_kwargs(monkeypatch):
+    pytest.importorskip("llama_cpp")
+    from kabosu_plus.sbv2.nlp import llamacpp_embedding_models
+
+    model = _StubLlama(llamacpp_embedding_models.__embed_lock)
+    load_calls = []
+
+    def load_model(*args, **kwargs):
+        load_calls.append((args, kwargs))
+        return model
+
+    monkeypatch.setattr(llamacpp_embedding_models, "load_model", load_model)
+
+    handle = bert_warmup.warmup(
+        [Languages.MULTI],
+        ["CPUExecutionProvider"],
+        sequence_lengths=(8,),
+        load_model_kwargs={"num_sessions": 2},
+        llamacpp_load_model_kwargs={"n_gpu_layers": 0, "n_threads": 4},
+        background=False,
+    )
+    assert handle.is_ready(Languages.MULTI)
+    # ONNX 版 BERT モデル向けの引数ではなく、llama.cpp 向けの引数でロードされる
+    assert load_calls[0] == ((Languages.MULTI, None), {"n_gpu_layers": 0, "n_threads": 4})
@@ -0,0 +1,139 @@
+import random
+
+import numpy as np
+import pytest
+from tokenizers import Tokenizer, models, normalizers, pre_tokenizers, processors
+from transformers import PreTrainedTokenizerFast
+
+from kabosu_plus.sbv2.nlp.onnx_bert_models import CharVocabTokenizer
+
+
+SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]"]
+
+
+def __make_tokenizer(vocab_tokens, char_level=True):
+    vocab = {token: index for index, token in enumerate(SPECIAL_TOKENS + vocab_tokens)}
+    if char_level:
+        tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+        tokenizer.pre_tokenizer = pre_tokenizers.Sequence(
+            [pre_tokenizers.WhitespaceSplit(), pre_tokenizers.Split("", "isolated")]
+        )
+    else:
+        tokenizer = Tokenizer(models.WordPiece(vocab, unk_token="[UNK]"))
+        tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer.normalizer = normalizers.NFKC()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="[CLS] $A [SEP]",
+        special_tokens=[("[CLS]", 2), ("[SEP]", 3)],
+    )
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        pad_token="[PAD]",
+        unk_token="[UNK]",
+        cls_token="[CLS]",
+        sep_token="[SEP]",
+    )
+
+
+def test_char_vocab_tokenizer_matches_hf_tokenizer():
+    hf_tokenizer = __make_tokenizer(list("こんにちは世界今日いい天気ですねガカ、。!?ABab12"))
+    tokenizer = CharVocabTokenizer(hf_tokenizer)
+    assert tokenizer.enabled
+
+    texts = [
+        "こんにちは、世界!",
+        "今日はいい天気ですね。",
+        "ＡＢｃ１２",  # NFKC で正規化される全角英数字
+        "ｶﾞガ",  # 半角の濁点は直前の文字と合成される
+        "未知の文字",  # 語彙にない文字
+        "世界 今日",  # 空白
+        "",
+    ]
+    for text in texts:
+        expected = hf_tokenizer(text, return_tensors="np")
+        actual = tokenizer(text, return_tensors="np")
+        assert np.array_equal(actual["input_ids"], expected["input_ids"]), text
+        assert np.array_equal(actual["attention_mask"], expected["attention_mask"]), text
+
+    assert tokenizer(texts)["input_ids"] == hf_tokenizer(texts)["input_ids"]
+
+
+def test_char_vocab_tokenizer_falls_back_for_subword_vocab():
+    # 複数文字のトークンを持つ語彙では、1 文字ずつの変換結果が一致しないため無効化される
+    hf_tokenizer = __make_tokenizer(["a", "b", "##a", "##b", "ab"], char_level=False)
+    tokenizer = CharVocabTokenizer(hf_tokenizer)
+    assert not tokenizer.enabled
+    assert tokenizer(["ab", "ba"])["input_ids"] == hf_tokenizer(["ab", "ba"])["input_ids"]
+
+
+class _InconsistentSpecialTokensTokenizer:
+    """
+    1 文字以上のテキストにだけ余分な特殊トークンを付加する (または文字のトークンを落とす) トークナイザー。
+    """
+
+    def __init__(self, tokenizer, mode):
+        self.tokenizer = tokenizer
+        self.mode = mode
+
+    def __getattr__(self, name):
+        return getattr(self.tokenizer, name)
+
+    def __call__(self, text, **kwargs):
+        outputs = self.tokenizer(text, **kwargs)
+        if isinstance(text, str) and text != "" and kwargs.get("add_special_tokens", True):
+            input_ids = list(outputs["input_ids"])
+            if self.mode == "extra":
+                input_ids = input_ids + [1]
+            else:
+                input_ids = [input_ids[0], input_ids[-1]]
+            outputs = {"input_ids": input_ids, "attention_mask": [1] * len(input_ids)}
+        return outputs
+
+
+@pytest.mark.parametrize("mode", ["extra", "missing"])
+def test_char_vocab_tokenizer_disables_on_special_token_mismatch(mode):
+    # 特殊トークンの付加のされ方が特定できない場合は、例外を送出せずに無効化される
+    hf_tokenizer = _InconsistentSpecialTokensTokenizer(__make_tokenizer(list("こんにちは")), mode)  # fmt: skip
+    tokenizer = CharVocabTokenizer(hf_tokenizer)  # type: ignore
+    assert not tokenizer.enabled
+    assert tokenizer("こんにちは")["input_ids"] == hf_tokenizer("こんにちは")["input_ids"]
+
+
+def test_char_vocab_tokenizer_matches_real_japanese_bert_tokenizer():
+    # 実際の日本語 BERT (deberta-v2-large-japanese-char-wwm) のトークナイザーがローカルにある場合のみ実行する
+    from transformers import AutoTokenizer
+
+    from kabosu_plus.sbv2.constants import DEFAULT_ONNX_BERT_MODEL_PATHS, Languages
+
+    candidates = [str(DEFAULT_ONNX_BERT_MODEL_PATHS[Languages.JP]), "tsukumijima/deberta-v2-large-japanese-char-wwm-onnx"]  # fmt: skip
+    hf_tokenizer = None
+    for candidate in candidates:
+        try:
+            hf_tokenizer = AutoTokenizer.from_pretrained(candidate, local_files_only=True, use_fast=True)  # fmt: skip
+            break
+        except (OSError, ValueError):
+            continue
+    if hf_tokenizer is None:
+        pytest.skip("deberta-v2-large-japanese-char-wwm tokenizer is not cached")
+
+    tokenizer = CharVocabTokenizer(hf_tokenizer)
+    assert tokenizer.enabled
+
+    texts = [
+        "こんにちは、世界！",
+        "吾輩は猫である。名前はまだ無い。どこで生れたかとんと見当がつかぬ。",
+        "音声合成の品質は、テキスト処理の精度に大きく左右されます。",
+        "えっ、本当に？それは知らなかった……",
+        "ＡＢＣ１２３とabc123、ｶﾞｷﾞｸﾞ",
+        "「鬱」「𠮷野家」「髙島屋」👍",
+        "全角　空白と 半角 空白",
+        "",
+    ]
+    ## 語彙中の文字をランダムに連結したテキストでも一致することを確認する
+    vocab_chars = sorted(token for token in hf_tokenizer.get_vocab() if len(token) == 1)
+    rng = random.Random(0)
+    texts += ["".join(rng.choice(vocab_chars) for _ in range(rng.randint(1, 100))) for _ in range(200)]  # fmt: skip
+
+    for text in texts:
+        assert tokenizer(text)["input_ids"] == hf_tokenizer(text)["input_ids"], text
+    assert np.array_equal(tokenizer(texts, return_tensors="np")["input_ids"], hf_tokenizer(texts, return_tensors="np", padding=True)["input_ids"])  # fmt: skip
@@ -0,0 +1,30 @@
+from kabosu_plus.sbv2.constants import Languages
+from kabosu_plus.sbv2.nlp import g2p_cache
+
+
+def test_g2p_cache_returns_copies_and_is_invalidated_by_dict_update(monkeypatch):
+    # 既定ではキャッシュは無効
+    assert g2p_cache.make_g2p_cache_key(Languages.JP, "こんにちは") is None
+
+    g2p_cache.set_g2p_cache_size(4)
+    try:
+        key = g2p_cache.make_g2p_cache_key(Languages.JP, "こんにちは", True, False)
+        assert g2p_cache.get_cached_g2p(key) is None
+        g2p_cache.put_cached_g2p(key, ("こんにちは", ["_", "k", "o", "_"], [0, 0, 0, 0]))
+
+        result = g2p_cache.get_cached_g2p(key)
+        assert result == ("こんにちは", ["_", "k", "o", "_"], [0, 0, 0, 0])
+        # 返されたリストを書き換えても、キャッシュには影響しない
+        result[1].append("x")  # type: ignore
+        assert g2p_cache.get_cached_g2p(key)[1] == ["_", "k", "o", "_"]  # type: ignore
+        # オプションが異なる場合はヒットしない
+        assert g2p_cache.get_cached_g2p(g2p_cache.make_g2p_cache_key(Languages.JP, "こんにちは", False, False)) is None  # fmt: skip
+
+        # 辞書が差し替えられると、それ以前のエントリにはヒットしなくなる
+        monkeypatch.setattr(g2p_cache, "get_user_dict_version", lambda: -1)
+        assert g2p_cache.get_cached_g2p(g2p_cache.make_g2p_cache_key(Languages.JP, "こんにちは", True, False)) is None  # fmt: skip
+
+        assert g2p_cache.get_g2p_cache_stats() == {"hits": 2, "misses": 3, "size": 1, "maxsize": 4}  # fmt: skip
+    finally:
+        g2p_cache.set_g2p_cache_size(0)
+        g2p_cache.clear_g2p_cache()
@@ -0,0 +1,28 @@
+from kabosu_plus.sbv2.utils.lru_cache import LRUCache
+
+
+def test_lru_cache_eviction():
+    cache: LRUCache[str, int] = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # "a" が最近使われたので "b" が破棄される
+    cache.put("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.get("b") is None
+    assert cache.stats() == {"hits": 3, "misses": 1, "size": 2, "maxsize": 2}
+
+
+def test_lru_cache_resize_and_clear():
+    cache: LRUCache[str, int] = LRUCache(maxsize=3)
+    for i, key in enumerate("abc"):
+        cache.put(key, i)
+    cache.resize(1)
+    assert len(cache) == 1
+    assert "c" in cache
+    cache.resize(0)
+    cache.put("d", 4)
+    assert len(cache) == 0
+    cache.clear()
+    assert cache.stats()["hits"] == 0
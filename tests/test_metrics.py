@@ -0,0 +1,46 @@
+from kabosu_plus.sbv2.utils.lru_cache import LRUCache
+from kabosu_plus.sbv2.utils.metrics import Metrics
+
+
+def test_metrics_is_noop_when_disabled():
+    metrics = Metrics()
+    with metrics.stage("g2p"):
+        pass
+    metrics.increment("tokens", 10)
+    metrics.record_cache_access("cache", True)
+    assert metrics.snapshot() == {"stages": {}, "counters": {}, "caches": {}}
+    assert metrics.to_prometheus() == ""
+
+
+def test_metrics_records_stages_counters_and_caches():
+    metrics = Metrics(enabled=True)
+    for _ in range(3):
+        with metrics.stage("g2p"):
+            pass
+    metrics.increment("tokens", 10)
+    metrics.record_cache_access("tokenizer", True)
+    metrics.record_cache_access("tokenizer", False)
+    cache: LRUCache[str, int] = LRUCache(maxsize=4)
+    cache.put("a", 1)
+    cache.get("a")
+    cache.get("b")
+    cache.get("a")
+    metrics.register_cache("embedding", cache.stats)
+
+    snapshot = metrics.snapshot()
+    assert snapshot["stages"]["g2p"]["count"] == 3
+    assert snapshot["stages"]["g2p"]["max_seconds"] >= snapshot["stages"]["g2p"]["mean_seconds"]  # fmt: skip
+    assert snapshot["counters"] == {"tokens": 10}
+    assert snapshot["caches"]["tokenizer"]["hit_rate"] == 0.5
+    assert snapshot["caches"]["embedding"] == {"hits": 2, "misses": 1, "hit_rate": 2 / 3}
+
+    text = metrics.to_prometheus(namespace="test")
+    assert '# TYPE test_stage_calls_total counter' in text
+    assert 'test_stage_calls_total{stage="g2p"} 3' in text
+    assert 'test_events_total{name="tokens"} 10' in text
+    assert 'test_cache_hits_total{cache="embedding"} 2' in text
+
+    # リセットしても、登録されたキャッシュは残る
+    metrics.reset()
+    assert metrics.snapshot()["stages"] == {}
+    assert "embedding" in metrics.snapshot()["caches"]
@@ -0,0 +1,98 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from kabosu_plus.sbv2.utils.model_registry import ModelRegistry
+
+
+def test_model_registry_evicts_least_recently_used():
+    registry = ModelRegistry(memory_budget=100)
+    removed = []
+    evicted = []
+    registry.add_evict_callback(lambda key, value: evicted.append(key))
+    for key in ("a", "b"):
+        registry.put(key, key.upper(), footprint=40, load_kwargs={"path": key}, on_remove=lambda key, value: removed.append(key))  # fmt: skip
+    # トークナイザーなど、メモリ使用量を持たないモデルはアンロードされない
+    registry.put("tokenizer", "T", footprint=0)
+    assert registry.get("a") == "A"
+    # 予算を超えたため、最も長い間利用されていない b がアンロードされる
+    registry.put("c", "C", footprint=40)
+    assert registry.keys() == ["tokenizer", "a", "c"]
+    assert removed == ["b"] and evicted == ["b"]
+    # アンロードされたモデルのロード時の引数は残っており、再ロードを数える
+    assert registry.get("b") is None
+    assert registry.get_load_kwargs("b") == {"path": "b"}
+    registry.put("b", "B", footprint=40)
+    assert registry.stats()["evictions"] == 2 and registry.stats()["reloads"] == 1
+
+
+def test_model_registry_remove_forgets_load_kwargs():
+    registry = ModelRegistry()
+    removed = []
+    registry.put("a", "A", footprint=10, load_kwargs={"path": "a"}, on_remove=lambda key, value: removed.append(value))  # fmt: skip
+    assert registry.remove("a") == "A"
+    assert removed == ["A"]
+    assert registry.get_load_kwargs("a") is None and "a" not in registry
+    # 予算を縮小すると、予算内に収まるまでアンロードされる
+    registry.put("b", "B", footprint=10)
+    registry.put("c", "C", footprint=10)
+    registry.set_memory_budget(15)
+    assert registry.keys() == ["c"]
+
+
+def _load_concurrently(load_model, num_threads=8):
+    barrier = threading.Barrier(num_threads)
+
+    def load(_):
+        barrier.wait()
+        return load_model()
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(load, range(num_threads)))
+
+
+def test_onnx_bert_model_is_loaded_once_by_concurrent_callers(tmp_path, monkeypatch):
+    from kabosu_plus.sbv2.constants import Languages
+    from kabosu_plus.sbv2.nlp import onnx_bert_models
+
+    (tmp_path / "model_fp16.onnx").write_bytes(b"stub")
+    constructions = []
+
+    class CountingInferenceSession:
+        def __init__(self, model_path, sess_options, providers):
+            constructions.append(model_path)
+            # ロード中に他のスレッドが load_model() に到達するよう、ロードに時間がかかるようにする
+            time.sleep(0.05)
+
+    monkeypatch.setattr(onnx_bert_models.onnxruntime, "InferenceSession", CountingInferenceSession)  # fmt: skip
+    try:
+        results = _load_concurrently(lambda: onnx_bert_models.load_model(Languages.JP, str(tmp_path), onnx_providers=["CPUExecutionProvider"]))  # fmt: skip
+    finally:
+        onnx_bert_models.unload_model(Languages.JP)
+    # 同時に呼ばれても 1 回だけロードされ、全員が同じ推論セッションを受け取る
+    assert len(constructions) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_llamacpp_embedding_model_is_loaded_once_by_concurrent_callers(tmp_path, monkeypatch):
+    pytest.importorskip("llama_cpp")
+    from kabosu_plus.sbv2.constants import Languages
+    from kabosu_plus.sbv2.nlp import llamacpp_embedding_models
+
+    (tmp_path / llamacpp_embedding_models.DEFAULT_MODEL_FILENAME).write_bytes(b"stub")
+    constructions = []
+
+    class CountingLlama:
+        def __init__(self, model_path, **kwargs):
+            constructions.append(model_path)
+            time.sleep(0.05)
+
+    monkeypatch.setattr(llamacpp_embedding_models, "Llama", CountingLlama)
+    try:
+        results = _load_concurrently(lambda: llamacpp_embedding_models.load_model(Languages.MULTI, str(tmp_path)))  # fmt: skip
+    finally:
+        llamacpp_embedding_models.unload_model(Languages.MULTI)
+    assert len(constructions) == 1
+    assert all(result is results[0] for result in results)
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from kabosu_plus.sbv2.constants import Languages
+
+
+pytest.importorskip("llama_cpp")
+
+from kabosu_plus.sbv2.nlp import llamacpp_embedding_models, onnx_bert_models  # noqa: E402
+from kabosu_plus.sbv2.nlp.multiringual import bert_feature  # noqa: E402
+
+
+def _fail(*args, **kwargs):
+    raise AssertionError("must not be called when the language is given by g2p")
+
+
+def test_extract_bert_feature_from_g2p_reuses_g2p_language(monkeypatch):
+    monkeypatch.setattr(llamacpp_embedding_models, "embed_texts", lambda texts, language: [np.full(4, index + 1, dtype=np.float32) for index in range(len(texts))])  # fmt: skip
+    # g2p() で判定済みの言語が渡されるため、言語の判定もトークナイザーのロードも行われない
+    monkeypatch.setattr(bert_feature, "language_selector", _fail)
+    monkeypatch.setattr(onnx_bert_models, "load_tokenizer", _fail)
+
+    g2p_result = (Languages.EN, "hello world", ["_", "h", "w", "_"], [0, 0, 0, 0], [1, 1, 1, 1], None, None, None)  # fmt: skip
+    feature = bert_feature.extract_bert_feature_from_g2p(g2p_result, assist_text="style", assist_text_weight=0.5)  # fmt: skip
+    assert feature.shape == (4, 4)
+    # 先頭と終端の音素にだけ、テキストと補助テキストの埋め込みを混ぜた特徴量が入る
+    assert np.all(feature[:, 0] == 1.5) and np.all(feature[:, -1] == 1.5)
+    assert np.all(feature[:, 1:-1] == 0)
+
+
+def test_extract_bert_feature_lammacpp_validates_word2ph_without_language(monkeypatch):
+    monkeypatch.setattr(llamacpp_embedding_models, "embed_texts", lambda texts, language: [np.ones(4, dtype=np.float32) for _ in texts])  # fmt: skip
+
+    # 言語が渡されない場合は、テキストから言語を判定して word2ph の長さを検証する
+    assert bert_feature.extract_bert_feature_lammacpp("あい", [1, 1, 1, 1]).shape == (4, 4)
+    with pytest.raises(AssertionError):
+        bert_feature.extract_bert_feature_lammacpp("あい", [1, 1, 1])
@@ -0,0 +1,53 @@
+import random
+
+import pytest
+
+import kabosu_plus
+from kabosu_plus.sbv2.nlp.japanese import g2p as japanese_g2p
+from kabosu_plus.sbv2.nlp.japanese.njd_prosody import njd_features_to_prosody
+
+
+# フルコンテキストラベルを経由する従来の実装
+_label_prosody = getattr(japanese_g2p, "__pyopenjtalk_g2p_prosody")
+
+_SENTENCES = [
+    "",
+    "、",
+    "こんにちは、世界。元気ですか？",
+    "えっ、本当に？それは知らなかった！",
+    "吾輩は猫である。名前はまだ無い。どこで生れたかとんと見当がつかぬ。",
+    "ヴァイオリンとフィギュアスケートを、ティーパーティーで。",
+    "「こんにちは」と彼は言った。",
+    "？はじめまして",
+    "ー、ーあ？？！！、、",
+    "東京特許許可局長今日急遽休暇許可拒否",
+    "１２３４５円です。",
+    "abcdefg ABC です",
+    "ぁぃぅぇぉっっっー",
+    "明日の会議は午後三時から第二会議室で行われる予定です。",
+    # アクセント句のモーラ数がフルコンテキストラベルの上限 (49) を超える場合
+    "カタカナ" * 20,
+]
+
+_CHARACTERS = list(
+    "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん"
+    "がぎぐげござじずぜぞだぢづでどばびぶべぼぱぴぷぺぽぁぃぅぇぉゃゅょっー"
+    "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワヲン"
+    "ヴァィゥェォャュョッ"
+    "日本語東京大学学生先生今日明日会議時間電話番号新聞天気雨雪花山川海空人名前猫犬本当知行来見言思食飲書読話聞"
+    "、。？！「」…・ 　０１２３abcXYZ"
+)
+
+
+def _random_corpus(size: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    return ["".join(rng.choice(_CHARACTERS) for _ in range(rng.randint(1, 60))) for _ in range(size)]  # fmt: skip
+
+
+@pytest.mark.parametrize("drop_unvoiced_vowels", [True, False])
+def test_njd_prosody_matches_full_context_labels(drop_unvoiced_vowels: bool):
+    for text in _SENTENCES + _random_corpus(2000):
+        njd_features = kabosu_plus.run_frontend(text)
+        expected = _label_prosody(njd_features, drop_unvoiced_vowels=drop_unvoiced_vowels)  # fmt: skip
+        actual = njd_features_to_prosody(njd_features, drop_unvoiced_vowels=drop_unvoiced_vowels)  # fmt: skip
+        assert actual == expected, text
@@ -0,0 +1,121 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from kabosu_plus.sbv2.constants import Languages
+from kabosu_plus.sbv2.nlp import onnx_bert_models
+
+
+def _write_tiny_model(model_dir):
+    """
+    input_ids を埋め込みに変換して線形変換するだけの、BERT モデルの代わりの小さな ONNX モデルを書き出し、その重みを返す。
+    """
+
+    onnx = pytest.importorskip("onnx")
+    from onnx import TensorProto, helper, numpy_helper
+
+    rng = np.random.default_rng(0)
+    embedding = rng.standard_normal((32, 16)).astype(np.float32)
+    weight = rng.standard_normal((16, 16)).astype(np.float32)
+    graph = helper.make_graph(
+        [
+            helper.make_node("Gather", ["embedding", "input_ids"], ["hidden"]),
+            helper.make_node("MatMul", ["hidden", "weight"], ["output"]),
+        ],
+        "tiny_bert",
+        [helper.make_tensor_value_info("input_ids", TensorProto.INT64, [1, "seq"])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, [1, "seq", 16])],
+        [numpy_helper.from_array(embedding, "embedding"), numpy_helper.from_array(weight, "weight")],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)])
+    model.ir_version = 8
+    onnx.save(model, str(model_dir / "model_fp16.onnx"))
+    return embedding, weight
+
+
+def _run_all_sessions(language):
+    input_ids = np.array([[3, 1, 4, 1, 5]], dtype=np.int64)
+    return [session.run(None, {"input_ids": input_ids})[0] for session in onnx_bert_models.get_session_pool(language).sessions]  # fmt: skip
+
+
+@pytest.fixture
+def unload_jp_model():
+    yield
+    onnx_bert_models.unload_model(Languages.JP)
+
+
+@pytest.mark.parametrize("num_sessions", [1, 2])
+def test_load_model_with_default_options(tmp_path, unload_jp_model, num_sessions):
+    embedding, weight = _write_tiny_model(tmp_path)
+
+    onnx_bert_models.load_model(Languages.JP, str(tmp_path), onnx_providers=["CPUExecutionProvider"], num_sessions=num_sessions)  # fmt: skip
+    outputs = _run_all_sessions(Languages.JP)
+    assert len(outputs) == num_sessions
+    for output in outputs:
+        assert np.allclose(output, embedding[[3, 1, 4, 1, 5]][None] @ weight, atol=1e-5)
+    # 最適化済みのモデルは保存されない
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["model_fp16.onnx"]
+
+
+@pytest.mark.parametrize("writable", [True, False])
+def test_load_model_with_graph_optimization(tmp_path, monkeypatch, unload_jp_model, writable):
+    embedding, weight = _write_tiny_model(tmp_path)
+    if not writable:
+        monkeypatch.setattr(onnx_bert_models.os, "access", lambda path, mode: False)
+
+    onnx_bert_models.load_model(Languages.JP, str(tmp_path), onnx_providers=["CPUExecutionProvider"], graph_optimization_level="all", num_sessions=2)  # fmt: skip
+    # 2 つ目の推論セッションも、保存された最適化済みのモデル (保存できない場合は元のモデル) からロードされる
+    for output in _run_all_sessions(Languages.JP):
+        assert np.allclose(output, embedding[[3, 1, 4, 1, 5]][None] @ weight, atol=1e-5)
+    optimized_model_path = onnx_bert_models.get_optimized_model_path(tmp_path / "model_fp16.onnx", "all", "CPUExecutionProvider")  # fmt: skip
+    assert optimized_model_path.exists() == writable
+    assert list(tmp_path.glob("*.tmp")) == []
+
+
+def test_load_model_removes_optimized_model_tmp_file_on_failure(tmp_path, monkeypatch):
+    (tmp_path / "model_fp16.onnx").write_bytes(b"")
+
+    # 最適化済みのモデルを書き出した後に失敗する推論セッション
+    def failing_inference_session(model_path, sess_options, providers):
+        Path(sess_options.optimized_model_filepath).write_bytes(b"partial")
+        raise RuntimeError("failed to create a session")
+
+    monkeypatch.setattr(onnx_bert_models.onnxruntime, "InferenceSession", failing_inference_session)  # fmt: skip
+
+    with pytest.raises(RuntimeError):
+        onnx_bert_models.load_model(
+            Languages.JP,
+            str(tmp_path),
+            onnx_providers=["CPUExecutionProvider"],
+            graph_optimization_level="all",
+        )
+
+    assert not onnx_bert_models.is_model_loaded(Languages.JP)
+    assert list(tmp_path.glob("*.tmp")) == []
+
+
+def test_model_variant_conversion_names_the_extra_when_onnx_is_missing(tmp_path, monkeypatch):
+    from kabosu_plus.sbv2.nlp import onnx_bert_variants
+
+    # onnx パッケージがインストールされていない環境を再現する
+    monkeypatch.setitem(sys.modules, "onnx", None)
+    with pytest.raises(ImportError, match=r"kabosu-plus\[cpu-variants\]"):
+        onnx_bert_variants.ensure_model_variant(tmp_path / "model_fp16.onnx", "fp32")
+
+
+def test_load_model_with_shared_initializers(tmp_path, unload_jp_model):
+    _write_tiny_model(tmp_path)
+
+    onnx_bert_models.load_model(Languages.JP, str(tmp_path), onnx_providers=["CPUExecutionProvider"], num_sessions=2)  # fmt: skip
+    expected = _run_all_sessions(Languages.JP)[0]
+    onnx_bert_models.unload_model(Languages.JP)
+
+    onnx_bert_models.load_model(Languages.JP, str(tmp_path), onnx_providers=["CPUExecutionProvider"], num_sessions=2, share_initializers=True)  # fmt: skip
+    # 重みを共有した 2 つの推論セッションは、どちらも通常のロードと同じ結果を返す
+    outputs = _run_all_sessions(Languages.JP)
+    assert len(outputs) == 2
+    for output in outputs:
+        assert np.array_equal(output, expected)
+    assert len(onnx_bert_models.__shared_initializers) == 1
@@ -0,0 +1,33 @@
+from kabosu_plus.sbv2.nlp.onnx_bert_models import OnnxSessionPool
+
+
+def test_onnx_session_pool_round_robin():
+    pool = OnnxSessionPool(["a", "b", "c"], checkout_strategy="round_robin")  # type: ignore
+    checked_out = []
+    for _ in range(4):
+        with pool.checkout() as (_, session):
+            checked_out.append(session)
+    assert checked_out == ["a", "b", "c", "a"]
+
+
+def test_onnx_session_pool_least_busy():
+    pool = OnnxSessionPool(["a", "b", "c"], checkout_strategy="least_busy")  # type: ignore
+    # 貸し出し中の推論セッションは選ばれない
+    with pool.checkout() as (_, first):
+        with pool.checkout() as (_, second):
+            with pool.checkout() as (_, third):
+                assert {first, second, third} == {"a", "b", "c"}
+        # 返却された推論セッションが再び選ばれる
+        with pool.checkout() as (_, fourth):
+            assert fourth == second
+
+
+def test_onnx_session_pool_checkout_by_index():
+    pool = OnnxSessionPool(["a", "b", "c"], checkout_strategy="least_busy")  # type: ignore
+    # インデックスを指定した場合は、checkout_strategy に関わらずその推論セッションが貸し出される
+    for index, expected in enumerate(["a", "b", "c"]):
+        with pool.checkout(index) as (checked_out_index, session):
+            assert (checked_out_index, session) == (index, expected)
+            # 貸し出し中の推論セッションは least_busy で選ばれない
+            with pool.checkout() as (_, other):
+                assert other != expected